@@ -1,17 +1,4 @@
-import numpy as np
 import time
-import datetime as dt
-import scipy.interpolate as spint
-import argparse
-'''
-import ocs
-from ocs import matched_client
-#import gevent.monkey
-#gevent.monkey.patch_all(aggressive=False, thread=False)
-from ocs.ocs_widgets import TaskWidget, ProcessWidget
-from twisted.python import log
-from twisted.logger import formatEvent, FileLogObserver
-'''
 
 from xy_agent.xy_scan import XY_Scan
 
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 VERSION = '0.1'
 
@@ -10,5 +10,13 @@ setup(name='xy_stage_control',
       package_dir={'xy_wing':'xy_stage', 
                     'xy_agent':'xy_agent'},
       packages=['xy_wing', 'xy_agent'],
+      entry_points={
+          'console_scripts': [
+              'xy_server = xy_wing.cli:main',
+              'xy_client = xy_agent.cli:client_main',
+              'xy_scan = xy_agent.cli:scan_main',
+              'xy_replay = xy_wing.replay:main',
+              'xy_jobs = xy_agent.cli:jobs_main',
+          ],
+      },
      )
-
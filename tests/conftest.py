@@ -0,0 +1,52 @@
+"""
+Fixtures running the stage on simulated pins (see sim_gpio). The carriages
+start in the middle of their travel and step in real time, so moves are
+kept to a few mm.
+"""
+from threading import Thread
+
+import pytest
+
+from xy_stage.cli import simulate_latrt, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+from xy_stage.xy_stage import XY_Stage as Stage
+from xy_stage.server import XY_Server
+from xy_agent.xy_connect import XY_Stage
+from xy_agent.xy_scan import XY_Scan
+
+
+@pytest.fixture
+def sim():
+    return simulate_latrt(travel_cm=4)
+
+
+@pytest.fixture
+def stage(sim):
+    return Stage(LATRT_XPINS, LATRT_YPINS, STEP_PER_CM)
+
+
+@pytest.fixture
+def server(sim, tmp_path):
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       log_dir=str(tmp_path))
+    server.init_stages()
+    Thread(target=server.work, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def address(server):
+    return server.server.getsockname()
+
+
+@pytest.fixture
+def client(address):
+    client = XY_Stage(*address)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def scan(address):
+    scan = XY_Scan(with_ocs=False, host=address[0], port=address[1])
+    yield scan
+    scan.xy_stage.close()
@@ -0,0 +1,38 @@
+import argparse
+
+import pytest
+
+from xy_stage.cli import axis_kwargs, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+from xy_stage.xy_stage import XY_Stage
+from xy_stage.server import XY_Server
+
+
+def test_xy_stage_passes_settings_to_each_axis(sim):
+    stage = XY_Stage(LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                     x_axis_kwargs={'dir_settle': 0.001, 'decel': 8},
+                     y_axis_kwargs={'enable_settle': 0.002})
+    assert stage.x_axis.dir_settle == 0.001
+    assert stage.x_axis.decel == 8
+    assert stage.y_axis.enable_settle == 0.002
+    assert stage.y_axis.decel == 5.0
+
+
+def test_server_builds_the_xy_stage_with_the_settings(sim, tmp_path):
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       log_dir=str(tmp_path), x_axis_kwargs={'decel': 2},
+                       y_axis_kwargs={'stop_velocity': 0.1})
+    try:
+        server.init_stages()
+        stage = server.get_stage()
+        assert stage.x_axis.decel == 2
+        assert stage.y_axis.stop_velocity == 0.1
+    finally:
+        server.close()
+
+
+def test_axis_kwargs_from_the_command_line():
+    assert axis_kwargs('{"dir_settle": 0.001, "decel": 8}') == {
+                'dir_settle': 0.001, 'decel': 8}
+    for text in ('[1]', '{"decel": ', '{"steps_per_cm": 10}', '{"speed": 1}'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            axis_kwargs(text)
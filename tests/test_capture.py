@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from xy_stage.capture import CaptureBuffer
+
+
+def test_buffer_keeps_the_newest_samples():
+    buffer = CaptureBuffer(size=4)
+    for i in range(6):
+        buffer.record(float(i), 10*i)
+    assert buffer.count == 4
+    assert [list(steps) for times, steps in buffer.views()] == [[20, 30], [40, 50]]
+    times, steps = buffer.window()
+    assert list(times) == [2, 3, 4, 5]
+    times, steps = buffer.window(2.5, 4)
+    assert list(steps) == [30, 40]
+
+
+def test_buffer_decimates():
+    buffer = CaptureBuffer(size=10, decimation=3)
+    for i in range(9):
+        buffer.record(float(i), i)
+    assert list(buffer.window()[1]) == [2, 5, 8]
+
+
+def test_views_do_not_copy():
+    buffer = CaptureBuffer(size=4)
+    buffer.record(1.0, 1)
+    times, steps = buffer.views()[0]
+    assert np.shares_memory(steps, buffer.steps)
+
+
+def test_bad_sizes_are_refused():
+    for kwargs in ({'size': 0}, {'decimation': 0}):
+        with pytest.raises(ValueError):
+            CaptureBuffer(**kwargs)
+
+
+def test_capture_window_over_the_network(client):
+    client.enable_capture(size=1000, axes=['X'])
+    start = time.time()
+    client.move_x_cm(0.02)
+    client.wait()
+    window = client.capture_window('X', start=start)
+    steps = window['steps']
+    assert steps == list(range(1, len(steps) + 1))
+    assert len(steps) == round(0.02*window['steps_per_cm'])
+    assert window['times'] == sorted(window['times'])
+    assert start <= window['times'][0] <= window['times'][-1] <= time.time()
+    with pytest.raises(Exception, match='not enabled'):
+        client.capture_window('Y')
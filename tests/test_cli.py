@@ -0,0 +1,45 @@
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from xy_agent import cli
+from xy_agent.xy_connect import wait_until_ready
+
+
+def imported_by(module):
+    code = ('import sys, {}; print(" ".join(sorted(sys.modules)))'.format(module))
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    return set(out.split())
+
+
+@pytest.mark.parametrize('module', ['xy_agent.cli', 'xy_stage.cli'])
+def test_commands_start_without_the_heavy_imports(module):
+    modules = imported_by(module)
+    for heavy in ('numpy', 'ocs', 'xy_agent.xy_scan', 'xy_agent.scan_plan',
+                  'xy_agent.job_queue', 'RPi'):
+        assert heavy not in modules
+
+
+def closed_port():
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def test_probe_answers_once_the_server_is_up(address, capsys):
+    host, port = address
+    assert wait_until_ready(host, port, timeout=1) < 1
+    assert cli.client_main(['--host', host, '--port', str(port), '--probe']) == 0
+    assert 'Server ready' in capsys.readouterr().out
+
+
+def test_probe_gives_up(capsys):
+    port = closed_port()
+    with pytest.raises(TimeoutError):
+        wait_until_ready('127.0.0.1', port, timeout=0.2, interval=0.05)
+    assert cli.client_main(['--host', '127.0.0.1', '--port', str(port),
+                            '--probe', '--ready-timeout', '0.2']) == 1
@@ -0,0 +1,65 @@
+import pytest
+
+from xy_stage import sim_gpio
+from xy_stage.cli import simulate_latrt, LATRT_XPINS
+
+FAST = {'backoff': 0.02, 'slow_vel': 0.5}
+LOST = 20
+
+
+@pytest.fixture
+def sim():
+    return simulate_latrt(travel_cm=1)
+
+
+@pytest.fixture
+def homed(stage):
+    stage.home(axes=['X'], **FAST)
+    return stage
+
+
+def lose_steps(steps):
+    ## the carriage ends up further out than the axis counted
+    sim_gpio._pulses[LATRT_XPINS['pul']].position += steps
+
+
+def return_home(stage):
+    stage.move_x_cm(0.2)
+    stage.wait()
+    lose_steps(LOST)
+    stage.move_x_cm(-0.5)
+    stage.wait()
+
+
+def test_trips_measure_the_drift(homed):
+    return_home(homed)
+    report = homed.drift_report()['X']
+    assert report['drift'] == -LOST
+    assert report['trips'][-1]['corrected'] is False
+    assert homed.get_position()[0] == pytest.approx(-LOST/homed.x_axis.steps_per_cm)
+    assert not homed.x_axis.needs_home
+
+
+def test_small_drift_is_corrected(homed):
+    homed.set_auto_correct(True)
+    return_home(homed)
+    assert homed.drift_report()['X']['trips'][-1]['corrected']
+    assert homed.get_position()[0] == 0
+
+
+def test_large_drift_needs_homing(homed):
+    homed.set_auto_correct(True, tolerance=0.005)
+    return_home(homed)
+    assert homed.drift_report()['X']['trips'][-1]['corrected'] is False
+    assert homed.x_axis.needs_home
+    stats = homed.home_if_needed(**FAST)
+    assert list(stats['axes']) == ['X', 'Y']
+    assert not homed.x_axis.needs_home
+
+
+def test_far_switch_is_learned_on_the_first_trip(homed):
+    homed.move_x_cm(2)
+    homed.wait()
+    refs = homed.drift_report()['X']['refs']
+    assert refs['ccw'] == round(homed.x_axis.steps_per_cm)
+    assert homed.drift_report()['X']['drift'] == 0
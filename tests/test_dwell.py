@@ -0,0 +1,66 @@
+import itertools
+import random
+import statistics
+
+import pytest
+
+from xy_agent import dwell
+
+
+def test_running_stats_match_the_batch_formulas():
+    rng = random.Random(0)
+    values = [rng.gauss(5, 2) for _ in range(200)]
+    stats = dwell.RunningStats()
+    for value in values:
+        stats.add(value)
+    assert stats.n == 200
+    assert stats.mean == pytest.approx(statistics.mean(values))
+    assert stats.variance == pytest.approx(statistics.variance(values))
+    assert stats.snr == pytest.approx(abs(stats.mean)/
+                                      (statistics.stdev(values)/200**0.5))
+
+
+def test_running_stats_edge_cases():
+    stats = dwell.RunningStats()
+    stats.add(3.0)
+    assert stats.variance == 0 and stats.snr == 0
+    stats.add(3.0)
+    assert stats.snr == float('inf')
+    zero = dwell.RunningStats()
+    zero.add(0.0)
+    zero.add(0.0)
+    assert zero.snr == 0
+
+
+def test_strong_signal_stops_early():
+    values = itertools.cycle([10.0, 10.1, 9.9])
+    result = dwell.adaptive_dwell(lambda: next(values), target_snr=50,
+                                  max_dwell=5, min_samples=3)
+    assert result['reached']
+    assert result['samples'] == 3
+    assert result['value'] == pytest.approx(10.0)
+    assert result['dwell'] < 0.1
+
+
+def test_noise_uses_the_whole_dwell():
+    rng = random.Random(1)
+    result = dwell.adaptive_dwell(lambda: rng.gauss(0, 1), target_snr=50,
+                                  max_dwell=0.05)
+    assert not result['reached']
+    assert result['samples'] > 3
+    ## the next acquisition is predicted, so allow one to overrun on jitter
+    assert 0.04 <= result['dwell'] <= 0.05 + result['dwell']/result['samples']
+
+
+def test_scan_records_the_dwell_per_point(scan, tmp_path):
+    values = itertools.cycle([1.0, 1.01, 0.99])
+    scan.load_definition({'distance_x': 0.02, 'n_x': 3, 'target_snr': 20,
+                          'max_dwell': 1, 'min_samples': 3,
+                          'hooks': {'acquire': 'random:random'}},
+                         cache_dir=str(tmp_path))
+    scan.set_adaptive_dwell(lambda: next(values), target_snr=20, max_dwell=1)
+    results = scan.execute_plan()
+    assert [point['samples'] for point in results] == [3, 3, 3]
+    report = scan.dwell_report()
+    assert report['points'] == 3 and report['reached'] == 3
+    assert report['total'] == pytest.approx(sum(p['dwell'] for p in results))
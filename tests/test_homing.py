@@ -0,0 +1,69 @@
+import time
+from threading import Thread
+
+import pytest
+
+from xy_stage.cli import simulate_latrt
+
+FAST = {'backoff': 0.02, 'slow_vel': 0.5}
+
+
+@pytest.fixture
+def sim():
+    ## the carriages start 0.5 cm from home
+    return simulate_latrt(travel_cm=1)
+
+
+def test_homing_finds_the_switch(stage, sim):
+    stage.set_position((3.0, 3.0))
+    stats = stage.home(checks=3, **FAST)
+    assert stage.homed
+    assert stage.get_position() == (0, 0)
+    for name, axis_stats in stats['axes'].items():
+        assert len(axis_stats['slow_trips']) == 3
+        assert axis_stats['spread'] == 0
+    ## the switch trips at the end of the simulated travel
+    assert stage.x_axis.limits[0] and stage.y_axis.limits[0]
+
+
+def test_parallel_homing_is_faster(stage, sim):
+    stats = stage.home(parallel=False, **FAST)
+    sequential = stats['time']
+    stage.move_x_cm(0.5)
+    stage.move_y_cm(0.5)
+    stage.wait()
+    stats = stage.home(**FAST)
+    assert stats['time'] < 0.75*sequential
+    assert stats['time'] > max(axis['time'] for axis in stats['axes'].values()) - 0.05
+
+
+def test_homing_refuses_fewer_than_one_check(stage):
+    with pytest.raises(ValueError):
+        stage.home(checks=0)
+    assert not stage.homed
+
+
+def test_homing_fails_without_reaching_the_switch(stage):
+    with pytest.raises(ValueError, match='did not reach the home limit'):
+        stage.home(max_dist=0.1, axes=['X'], **FAST)
+    assert not stage.x_axis.homed
+
+
+def test_only_axes_that_need_it_are_homed(stage):
+    stage.home(axes=['Y'], **FAST)
+    stats = stage.home_if_needed(**FAST)
+    assert list(stats['axes']) == ['X']
+    assert stage.homed
+
+
+def test_moves_sent_while_homing_wait_for_it(stage):
+    homing = Thread(target=stage.home, kwargs=dict(axes=['X'], **FAST))
+    homing.start()
+    time.sleep(0.05)
+    with pytest.raises(ValueError):
+        stage.home(**FAST)
+    stage.move_x_cm(0.1)
+    homing.join()
+    stage.wait()
+    assert stage.x_axis.homed
+    assert stage.get_position()[0] == pytest.approx(0.1, abs=1e-3)
@@ -0,0 +1,120 @@
+import time
+from threading import Thread
+
+import pytest
+
+from xy_agent import job_queue
+from xy_agent.job_queue import JobQueue, JobDaemon, JobClient
+
+LINE = {'distance_x': 0.02, 'n_x': 3, 'hooks': {'during': 'time:time'}}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.json'), nearby=0.01)
+
+
+def test_jobs_run_by_priority_then_in_order(queue):
+    first = queue.submit(LINE)
+    urgent = queue.submit(LINE, priority=2)
+    second = queue.submit(LINE)
+    order = []
+    for _ in range(3):
+        job = queue.take(None, [0, 0], block=False)
+        order.append(job['id'])
+        queue.finish(job, 'done')
+    assert order == [urgent, first, second]
+    assert queue.take(None, [0, 0], block=False) is None
+
+
+def test_a_job_starting_nearby_goes_first(queue):
+    queue.submit(LINE, center=[1, 1])
+    near = queue.submit(LINE, center=[0.02, 0])
+    ## the stage is where the near job starts
+    assert queue.next_job([0.01, 0], [0, 0])['id'] == near
+    assert queue.next_job([0.5, 0.5], [0, 0])['id'] == near - 1
+
+
+def test_queue_survives_a_restart(queue):
+    done = queue.submit(LINE, name='done')
+    running = queue.submit(LINE, name='running')
+    job = queue.take(None, [0, 0], block=False)
+    queue.finish(job, 'done', results=[{'value': 1}])
+    queue.take(None, [0, 0], block=False)
+
+    restarted = JobQueue(queue.path)
+    assert restarted.status(done)['status'] == 'done'
+    assert restarted.results(done) == [{'value': 1}]
+    assert restarted.status(running)['status'] == 'pending'
+    assert restarted.status(running)['restarts'] == 1
+    assert restarted.submit(LINE) == running + 1
+
+
+def test_cancel_and_release(queue):
+    job_id = queue.submit(LINE)
+    other = queue.submit(LINE)
+    queue.cancel(job_id)
+    job = queue.take(None, [0, 0], block=False)
+    assert job['id'] == other
+    with pytest.raises(ValueError):
+        queue.cancel(other)
+    queue.release(job)
+    assert queue.status(other)['status'] == 'pending'
+    assert 'definition' not in queue.status(other)
+
+
+def test_bad_definitions_are_refused(queue):
+    with pytest.raises(ValueError):
+        queue.submit({'n_x': 2})
+    assert queue.status() == []
+
+
+def test_daemon_runs_jobs_back_to_back(scan, queue, tmp_path):
+    daemon = JobDaemon(scan, queue, port=0, center=[0, 0],
+                       cache_dir=str(tmp_path / 'plans'))
+    Thread(target=daemon.work, daemon=True).start()
+    client = JobClient(*daemon.server.getsockname())
+    try:
+        first = client.submit(LINE)
+        ## starts where the first one ends
+        direct = client.submit(LINE, center=[0.02, 0])
+        far = client.submit(LINE, center=[0.2, 0.2])
+        statuses = [client.wait(job_id, interval=0.1, timeout=30)
+                        for job_id in (first, direct, far)]
+        assert [status['status'] for status in statuses] == ['done']*3
+        assert [status['direct'] for status in statuses] == [False, True, False]
+        ## positions are relative to the job's center
+        points = client.results(direct)
+        assert [point['position'] for point in points] == [
+                    pytest.approx(p) for p in ([-0.01, 0], [0, 0], [0.01, 0])]
+        assert all(isinstance(point['value'], float) for point in points)
+        ## back to the center of the last scan once the queue is empty
+        deadline = time.monotonic() + 10
+        while scan.xy_stage.moving or daemon.previous is not None:
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+        assert scan.xy_stage.position == pytest.approx([0.2, 0.2], abs=1e-3)
+    finally:
+        daemon.server.close()
+
+
+def test_runner_retries_when_the_stage_fails(scan, queue, tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, 'RETRY_WAIT', 0.05)
+    daemon = JobDaemon(scan, queue, port=0, center=[0, 0],
+                       cache_dir=str(tmp_path / 'plans'))
+    position = daemon.position
+    failures = []
+    def flaky_position():
+        if len(failures) < 2:
+            failures.append(1)
+            raise ConnectionError('stage went away')
+        return position()
+    daemon.position = flaky_position
+    job_id = queue.submit(LINE)
+    Thread(target=daemon.run, daemon=True).start()
+    deadline = time.monotonic() + 30
+    while queue.status(job_id)['status'] != 'done':
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    assert len(failures) == 2
+    daemon.server.close()
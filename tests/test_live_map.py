@@ -0,0 +1,62 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from xy_agent import scan_plan
+from xy_agent.live_map import LiveMap
+
+
+def test_a_sample_fills_the_cells_around_it():
+    live_map = LiveMap((0, 1), (0, 1), 0.1)
+    rows, cols = live_map.add(0.5, 0.5, 2.0)
+    assert live_map.image[5, 5] == pytest.approx(2.0)
+    changed = np.zeros(live_map.image.shape, dtype=bool)
+    changed[rows, cols] = True
+    assert np.all(live_map.image[changed] == pytest.approx(2.0))
+    assert np.all(np.isnan(live_map.image[~changed]))
+    assert 0 < changed.sum() < changed.size
+
+
+def test_samples_are_weighted_by_distance():
+    live_map = LiveMap((0, 1), (0, 1), 0.1)
+    live_map.add(0.4, 0.5, 0.0)
+    live_map.add(0.6, 0.5, 1.0)
+    row = live_map.image[5]
+    assert row[5] == pytest.approx(0.5)
+    assert row[4] < 0.5 < row[6]
+
+
+def test_map_covers_the_plan():
+    definition = scan_plan.validate({'distance_x': 2, 'distance_y': 1,
+                                     'n_x': 3, 'n_y': 3})
+    plan = scan_plan.compile_plan(definition)
+    live_map = LiveMap.from_plan(plan, resolution=0.5)
+    assert live_map.extent == (-1.75, 1.75, -1.25, 1.25)
+    assert live_map.image.shape == (5, 7)
+
+
+def test_snapshot_and_clear():
+    live_map = LiveMap((0, 1), (0, 1), 0.1)
+    live_map.add(0.5, 0.5, 1.0)
+    image = live_map.snapshot()
+    live_map.clear()
+    assert live_map.n_points == 0
+    assert np.all(np.isnan(live_map.image))
+    assert image[5, 5] == pytest.approx(1.0)
+
+
+def test_scan_fills_the_map(scan, tmp_path):
+    scan.load_definition({'distance_x': 0.04, 'distance_y': 0.04,
+                          'n_x': 3, 'n_y': 3}, cache_dir=str(tmp_path))
+    live_map = LiveMap.from_plan(scan.plan, resolution=0.02, sigma=0.005)
+    scan.attach_map(live_map)
+    values = iter([1.0, 2.0, 3.0, None, 5.0, 6.0, 7.0, 8.0, 'saturated'])
+    scan.during_function = lambda: next(values)
+    scan.execute_plan()
+    ## only the numbers go on the map, at the commanded positions
+    assert live_map.n_points == 7
+    image = live_map.snapshot()[1:-1, 1:-1]
+    assert image[0] == pytest.approx([1, 2, 3])
+    assert np.isnan(image[1, 0])
+    assert image[2, :2] == pytest.approx([7, 8])
+    assert np.isnan(image[2, 2])
@@ -0,0 +1,66 @@
+import urllib.request
+
+import pytest
+
+from xy_stage import metrics
+
+
+def test_counters_are_labelled():
+    registry = metrics.Registry()
+    counter = registry.counter('requests_total', 'Requests', ('command',))
+    counter.inc(1, 'moving')
+    counter.inc(2, 'moving')
+    counter.inc(1, 'limits')
+    assert counter.value('moving') == 3
+    assert registry.exposition().splitlines() == [
+                '# HELP requests_total Requests',
+                '# TYPE requests_total counter',
+                'requests_total{command="limits"} 1',
+                'requests_total{command="moving"} 3']
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = metrics.Registry()
+    histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 5):
+        histogram.observe(value)
+    lines = registry.exposition().splitlines()[2:]
+    assert lines == ['latency_seconds_bucket{le="0.1"} 1',
+                     'latency_seconds_bucket{le="1"} 3',
+                     'latency_seconds_bucket{le="+Inf"} 4',
+                     'latency_seconds_sum 6.25',
+                     'latency_seconds_count 4']
+
+
+def test_names_are_registered_once():
+    registry = metrics.Registry()
+    registry.counter('total', 'Total')
+    with pytest.raises(ValueError):
+        registry.counter('total', 'Total')
+
+
+def test_requests_and_moves_are_counted(client):
+    requests = metrics.REQUESTS.value('moving')
+    moves = metrics.MOVES.value('xy', 'X')
+    steps = metrics.STEPS.value('X')
+    client.moving
+    client.move_x_cm(0.01)
+    client.wait()
+    assert metrics.REQUESTS.value('moving') == requests + 1
+    assert metrics.MOVES.value('xy', 'X') == moves + 1
+    assert metrics.STEPS.value('X') == steps + 16
+    text = client.metrics()
+    assert 'xy_request_latency_seconds_bucket{command="moving",le="+Inf"}' in text
+    assert 'xy_uptime_seconds' in text
+
+
+def test_metrics_over_http():
+    httpd = metrics.serve(0)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(httpd.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert '# TYPE xy_requests_total counter' in response.read().decode()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
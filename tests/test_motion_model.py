@@ -0,0 +1,112 @@
+import pytest
+
+from xy_stage import metrics
+from xy_stage.cli import simulate_latrt
+from xy_agent.motion_model import MotionModel
+from xy_agent.xy_connect import XY_Stage
+
+
+@pytest.fixture
+def sim():
+    ## short travel so a move runs into the limit quickly
+    return simulate_latrt(travel_cm=1)
+
+
+def test_extrapolates_a_move():
+    model = MotionModel(settle=0, uncalibrated_error=0.05)
+    model.sync({'X': 0.0, 'Y': 0.0}, False, now=0)
+    model.add_move('X', 1.0, velocity=1.0, now=0)
+    positions, bounds, moving = model.estimate(now=0.5)
+    assert positions['X'] == pytest.approx(0.5)
+    assert bounds['X'] == pytest.approx(0.025)
+    assert moving
+    positions, bounds, moving = model.estimate(now=2)
+    assert positions['X'] == 1.0 and bounds['X'] == 0 and not moving
+
+
+def test_uncalibrated_until_speeds_agree():
+    model = MotionModel(settle=0, timing_error=0.01, uncalibrated_error=0.5)
+    model.sync({'X': 0.0}, False, now=0)
+    model.add_move('X', 10.0, velocity=1.0, now=0)
+    ## the axis runs at half the commanded speed
+    model.sync({'X': 0.25}, True, now=0.5)
+    model.sync({'X': 0.5}, True, now=1.0)
+    assert model.speed_scale['X'] == pytest.approx(0.5)
+    assert 'X' not in model.calibrated
+    positions, bounds, _ = model.estimate(now=1.5)
+    assert abs(positions['X'] - 0.75) <= bounds['X']
+    model.sync({'X': 0.75}, True, now=1.5)
+    assert 'X' in model.calibrated
+
+
+def test_finish_anchors_on_reported_positions():
+    model = MotionModel()
+    model.sync({'X': 0.0, 'Y': 0.0}, False, now=0)
+    model.add_move('X', 2.0, now=0)
+    model.finish({'X': 0.5, 'Y': 0.0}, now=10)
+    positions, bounds, moving = model.estimate(now=10)
+    assert positions == {'X': 0.5, 'Y': 0.0}
+    assert not moving
+
+
+def test_wait_after_limit_stop_reports_real_position(address):
+    client = XY_Stage(*address, motion_model=True)
+    try:
+        client.sync_model()
+        client.move_x_cm(2.0)
+        client.wait()
+        real = client.snapshot().position
+        assert real[0] < 1.0
+        positions, bounds = client.position_estimate()
+        assert positions[0] == pytest.approx(real[0], abs=1e-6)
+        assert client.position[0] == pytest.approx(real[0], abs=1e-6)
+    finally:
+        client.close()
+
+
+def test_stop_invalidates_the_model(address):
+    client = XY_Stage(*address, motion_model=True)
+    try:
+        client.sync_model()
+        client.move_x_cm(0.3)
+        client.stop()
+        assert client.position_estimate() is None
+    finally:
+        client.close()
+
+
+def test_queued_moves_run_one_after_the_other():
+    model = MotionModel(settle=0.5, uncalibrated_error=0)
+    model.sync({'X': 0.0, 'Y': 0.0}, False, now=0)
+    model.add_move('X', 1.0, velocity=1.0, now=0)
+    model.add_move('Y', 1.0, velocity=1.0, now=0)
+    ## X settles and runs, then Y settles and runs
+    assert model.estimate(now=1.0)[0] == {'X': 0.5, 'Y': 0.0}
+    assert model.estimate(now=2.5)[0] == {'X': 1.0, 'Y': 0.5}
+    ## done once the guessed settles are over too
+    assert model.estimate(now=3.5)[2] is None
+    assert model.estimate(now=4.5) == ({'X': 1.0, 'Y': 1.0},
+                                       {'X': 0.0, 'Y': 0.0}, False)
+
+
+def test_moves_are_ignored_until_the_first_sync():
+    model = MotionModel()
+    model.add_move('X', 1.0)
+    assert model.estimate() is None
+
+
+def test_position_reads_skip_the_server_within_tolerance(address):
+    client = XY_Stage(*address, motion_model=True, position_tolerance=10)
+    try:
+        client.sync_model()
+        client.move_x_cm(0.1)
+        snapshots = metrics.REQUESTS.value('snapshot')
+        positions = metrics.REQUESTS.value('get_position')
+        for _ in range(5):
+            client.position
+            client.moving
+        assert metrics.REQUESTS.value('snapshot') == snapshots
+        assert metrics.REQUESTS.value('get_position') == positions
+        client.wait()
+    finally:
+        client.close()
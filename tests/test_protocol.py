@@ -0,0 +1,107 @@
+import json
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from xy_stage.cli import LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+from xy_stage.server import XY_Server
+from xy_agent import protocol, tracing
+from xy_agent.xy_connect import XY_Stage
+
+
+def test_json_request_over_several_reads_is_traced(address):
+    tracing.tracer.start('test')
+    try:
+        with socket.create_connection(address, timeout=5) as sock:
+            data = bytes(json.dumps({'function': 'get_position', 'kwargs': {}}), 'utf-8')
+            sock.sendall(data[:5])
+            time.sleep(0.2)
+            sock.sendall(data[5:])
+            message = protocol.recv_json(sock)
+    finally:
+        tracing.tracer.stop()
+    assert message is not None and 'resp' in message[0]
+    decode = [event for event in tracing.tracer.events
+                if event['name'] == 'decode']
+    assert len(decode) == 1
+    assert decode[0]['args'] == {'encoding': 'json'}
+    ## the span times the parse, not the wait for the rest of the request
+    assert decode[0]['dur'] < 0.1e6
+
+
+def test_fixed_layout_responses_decode_like_json():
+    cases = [({'function': 'get_position', 'kwargs': {}}, [1.5, -2.25]),
+             ({'property': 'limits'}, [[True, False], [False, True]]),
+             ({'property': 'moving'}, True)]
+    for request, value in cases:
+        opcode = protocol.encode_request(request)[1]
+        out = protocol.encode_response(opcode, {'resp': value})
+        assert opcode != protocol.OP_JSON
+        assert protocol.decode_response(opcode, out[protocol.HEADER.size:]) \
+                    == json.loads(json.dumps({'resp': value}))
+
+
+def test_binary_and_json_clients_agree(address):
+    clients = [XY_Stage(*address, encoding=encoding)
+                    for encoding in ('json', 'binary')]
+    try:
+        assert clients[1].encoding == 'binary'
+        clients[0].move_x_cm(0.02)
+        clients[0].wait()
+        for name in ('position', 'limits', 'moving'):
+            values = [getattr(client, name) for client in clients]
+            assert values[0] == values[1]
+            assert type(values[0]) is type(values[1])
+    finally:
+        for client in clients:
+            client.close()
+
+
+@pytest.mark.parametrize('message', [
+    {'function': 'get_position', 'kwargs': {}},
+    {'property': 'moving'},
+    {'property': 'limits'},
+    {'function': 'move_x_cm', 'kwargs': {'distance': -1.5, 'velocity': 0.5}},
+    {'function': 'move_y_cm', 'kwargs': {'distance': 2.0, 'velocity': None}},
+    {'function': 'move_x_cm', 'kwargs': {'distance': 1, 'velocity': 1,
+                                         'extra': 1}},
+    {'function': 'home', 'kwargs': {'checks': 2}},
+    {'property': 'homed', 'stage': 'rot'},
+])
+def test_requests_decode_to_the_same_message(message):
+    data = protocol.encode_request(message)
+    magic, opcode, length = protocol.HEADER.unpack(data[:protocol.HEADER.size])
+    assert magic == protocol.MAGIC
+    assert length == len(data) - protocol.HEADER.size
+    assert protocol.decode_request(opcode, data[protocol.HEADER.size:]) == message
+
+
+def test_fixed_layout_requests_are_compact():
+    message = {'function': 'move_x_cm', 'kwargs': {'distance': 1, 'velocity': 1}}
+    assert len(protocol.encode_request(message)) == protocol.HEADER.size + 16
+    assert len(protocol.encode_request({'property': 'moving'})) == \
+                protocol.HEADER.size
+
+
+def test_errors_are_sent_as_error_frames():
+    out = protocol.encode_response(protocol.OP_POSITION, {'error': 'not homed'})
+    opcode = out[1]
+    assert opcode == protocol.OP_ERROR
+    assert protocol.decode_response(opcode, out[protocol.HEADER.size:]) == \
+                {'error': 'not homed'}
+
+
+def test_server_can_refuse_the_binary_encoding(sim, tmp_path):
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       encodings=('json',), log_dir=str(tmp_path))
+    server.init_stages()
+    Thread(target=server.work, daemon=True).start()
+    client = XY_Stage(*server.server.getsockname(), encoding='binary')
+    try:
+        assert client.encoding == 'json'
+        assert client.moving is False
+    finally:
+        client.close()
+        server.close()
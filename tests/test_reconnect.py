@@ -0,0 +1,100 @@
+import json
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from xy_agent import protocol
+from xy_agent.xy_connect import Channel
+
+
+def drop(channel):
+    ## as if the network went away under an open connection
+    channel.comm.shutdown(socket.SHUT_RDWR)
+
+
+def flaky_server(drops):
+    '''
+    Server closing each of its first drops connections after reading one
+    request, then answering every request with {'resp': n_connections}
+
+    Returns: (address, list of connections accepted so far)
+    '''
+    listener = socket.create_server(('127.0.0.1', 0))
+    accepted = []
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            accepted.append(conn)
+            if len(accepted) <= drops:
+                protocol.recv_json(conn)
+                conn.close()
+                continue
+            Thread(target=answer, args=(conn,), daemon=True).start()
+
+    def answer(conn):
+        while protocol.recv_json(conn) is not None:
+            conn.sendall(bytes(json.dumps({'resp': len(accepted)}), 'utf-8'))
+
+    Thread(target=serve, daemon=True).start()
+    return listener.getsockname(), accepted
+
+
+def test_idempotent_requests_are_sent_again_after_a_drop():
+    address, accepted = flaky_server(drops=1)
+    channel = Channel(*address, backoff=0.01)
+    assert channel.request({'property': 'moving'}) == {'resp': 2}
+    channel.close()
+
+
+def test_other_requests_are_not_sent_twice():
+    address, accepted = flaky_server(drops=1)
+    channel = Channel(*address, backoff=0.01)
+    with pytest.raises(ConnectionError):
+        channel.request({'function': 'move_x_cm', 'kwargs': {'distance': 1}},
+                        idempotent=False)
+    ## the channel is connected again for the next request
+    assert channel.request({'property': 'moving'}) == {'resp': 2}
+    channel.close()
+
+
+def test_connect_gives_up_after_the_retries():
+    listener = socket.create_server(('127.0.0.1', 0))
+    address = listener.getsockname()
+    listener.close()
+    start = time.monotonic()
+    with pytest.raises(OSError):
+        Channel(*address, backoff=0.01, max_backoff=0.02, retries=3)
+    assert time.monotonic() - start < 1
+
+
+def test_reconnect_replays_the_encoding(address):
+    channel = Channel(*address, encoding='binary', backoff=0.01)
+    assert channel.encoding == 'binary'
+    drop(channel)
+    assert channel.request({'property': 'moving'}) == {'resp': False}
+    assert channel.encoding == 'binary'
+    channel.close()
+
+
+def test_client_survives_dropped_channels(client):
+    for channel in client.channels:
+        drop(channel)
+    client.move_x_cm(0.01)
+    client.wait()
+    assert client.get_positions()['X'] == pytest.approx(0.01, abs=1e-3)
+
+
+def test_status_is_answered_during_a_wait(client):
+    client.move_x_cm(0.3)
+    waiting = Thread(target=client.wait)
+    waiting.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    assert client.moving
+    client.position
+    assert time.monotonic() - start < 0.1
+    waiting.join()
+    assert not client.moving
@@ -0,0 +1,92 @@
+import json
+import socket
+
+import pytest
+
+from xy_stage import recorder, replay
+from xy_agent import protocol
+from xy_agent.xy_connect import XY_Stage
+
+
+def record_session(path):
+    server = replay.start_simulated_server(travel_cm=4, record=path)
+    try:
+        for encoding in ('json', 'binary'):
+            client = XY_Stage(*server.server.getsockname(), encoding=encoding)
+            client.move_x_cm(0.05)
+            client.wait()
+            client.get_positions()
+            client.close()
+    finally:
+        server.close()
+    return recorder.read_log(path)
+
+
+@pytest.mark.parametrize('speed', [None, 10.0])
+def test_replay_sends_every_recorded_request(tmp_path, speed):
+    records = record_session(str(tmp_path / 'log.xyrec'))
+    assert {record['encoding'] for record in records} == {'json', 'binary'}
+    server = replay.start_simulated_server(travel_cm=4)
+    try:
+        results, duration = replay.replay(records, *server.server.getsockname(),
+                                          speed=speed)
+    finally:
+        server.close()
+    assert len(results) == len(records)
+    report = replay.compare(records, results, duration)
+    assert sum(row['errors'] for row in report['commands'].values()) == 0
+    assert report['commands']['move_x_cm']['count'] == 2
+
+
+@pytest.mark.parametrize('encoding', ['json', 'binary'])
+def test_receive_raises_when_the_server_closes(encoding):
+    sock, server_end = socket.socketpair()
+    server_end.close()
+    with pytest.raises(ConnectionError):
+        replay._receive(sock, encoding)
+    sock.close()
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / 'log.xyrec')
+    log = recorder.CommandRecorder(path)
+    conn = log.new_connection()
+    log.record(1.0, 0.001, conn, 'json', protocol.OP_JSON,
+               b'{"property": "moving"}', b'{"resp": false}')
+    log.record(2.0, 0.002, log.new_connection(), 'binary', protocol.OP_MOVING,
+               b'', b'\x00')
+    assert log.close() == 2
+    records = recorder.read_log(path)
+    assert [recorder.command_name(record) for record in records] == \
+                ['moving', 'moving']
+    assert [record['connection'] for record in records] == [0, 1]
+    assert records[1]['encoding'] == 'binary'
+    assert records[0]['response'] == b'{"resp": false}'
+
+
+def test_truncated_logs_keep_the_whole_records(tmp_path):
+    path = tmp_path / 'log.xyrec'
+    log = recorder.CommandRecorder(str(path))
+    for i in range(3):
+        log.record(float(i), 0.0, 0, 'json', protocol.OP_JSON, b'{}', b'{}')
+    log.close()
+    path.write_bytes(path.read_bytes()[:-1])
+    assert len(recorder.read_log(str(path))) == 2
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / 'log.xyrec'
+    path.write_bytes(b'NOTALOG')
+    with pytest.raises(ValueError):
+        recorder.read_log(str(path))
+
+
+def test_replay_command(tmp_path, capsys):
+    records = record_session(str(tmp_path / 'log.xyrec'))
+    report_path = str(tmp_path / 'report.json')
+    assert replay.main([str(tmp_path / 'log.xyrec'), '--fast', '--travel', '4',
+                        '--json', report_path]) == 0
+    assert 'Replaying {} requests'.format(len(records)) in capsys.readouterr().out
+    with open(report_path) as report_file:
+        report = json.load(report_file)
+    assert sum(row['count'] for row in report['commands'].values()) == len(records)
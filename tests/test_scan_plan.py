@@ -0,0 +1,107 @@
+import json
+import math
+import os
+
+import pytest
+
+from xy_agent import scan_plan
+
+GRID = {'distance_x': 2, 'distance_y': 1, 'n_x': 3, 'n_y': 3,
+        'hooks': {'during': 'math:sqrt'}}
+
+
+def moves(plan):
+    return [entry for entry in plan['entries'] if entry['type'] == 'move']
+
+
+def total(entries, axis):
+    return sum(entry['distance'] for entry in entries
+                    if entry['type'] == 'move' and entry['axis'] == axis)
+
+
+def test_validate_fills_in_the_defaults():
+    definition = scan_plan.validate({'x_vel': 2})
+    assert definition['pattern'] == 'grid'
+    assert definition['x_vel_reset'] == 2
+    assert definition['y_vel_reset'] == definition['y_vel']
+
+
+def test_validate_reports_every_problem():
+    with pytest.raises(ValueError) as err:
+        scan_plan.validate({'n_x': 2, 'x_vel': 0, 'speed': 1,
+                            'hooks': {'during': 'no_colon'}})
+    message = str(err.value)
+    for problem in ('unknown keys', 'n_x must be odd', 'x_vel must be',
+                    'hook during'):
+        assert problem in message
+
+
+def test_adaptive_dwell_needs_an_acquire_hook():
+    with pytest.raises(ValueError, match='acquire hook'):
+        scan_plan.validate({'target_snr': 10, 'max_dwell': 1})
+
+
+def test_grid_plan_visits_every_point_and_returns():
+    plan = scan_plan.compile_plan(scan_plan.validate(GRID), {'X': 100, 'Y': 50})
+    points = [entry for entry in plan['entries'] if entry['type'] == 'point']
+    assert [point['position'] for point in points] == [
+                [x, y] for y in (-0.5, 0, 0.5) for x in (-1, 0, 1)]
+    assert total(plan['entries'], 'x') == pytest.approx(0)
+    assert total(plan['entries'], 'y') == pytest.approx(0)
+    for move in moves(plan):
+        steps_per_cm = {'x': 100, 'y': 50}[move['axis']]
+        assert move['steps'] == round(abs(move['distance'])*steps_per_cm)
+
+
+def test_lead_in_and_lead_out_mark_the_scan():
+    plan = scan_plan.compile_plan(scan_plan.validate(GRID))
+    entries = plan['entries']
+    assert plan['start'] == [-1, -0.5]
+    assert plan['end'] == [1, 0.5]
+    assert [total(entries[:plan['lead_in']], axis) for axis in 'xy'] == \
+                plan['start']
+    assert [-total(entries[plan['lead_out']:], axis) for axis in 'xy'] == \
+                plan['end']
+    assert entries[plan['lead_in']]['type'] == 'point'
+
+
+def test_step_raster_turns_around():
+    plan = scan_plan.compile_plan(scan_plan.validate(dict(GRID, step_raster=True)))
+    indexes = [entry['index'] for entry in plan['entries']
+                    if entry['type'] == 'point']
+    assert indexes[:6] == [[0, 0], [1, 0], [2, 0], [2, 1], [1, 1], [0, 1]]
+
+
+def test_plan_key_covers_definition_calibration_and_version(monkeypatch):
+    definition = scan_plan.validate(GRID)
+    key = scan_plan.plan_key(definition, {'X': 100})
+    assert key == scan_plan.plan_key(dict(definition), {'X': 100})
+    assert key != scan_plan.plan_key(dict(definition, n_x=5), {'X': 100})
+    assert key != scan_plan.plan_key(definition, {'X': 101})
+    monkeypatch.setattr(scan_plan, 'PLAN_VERSION', scan_plan.PLAN_VERSION + 1)
+    assert key != scan_plan.plan_key(definition, {'X': 100})
+
+
+def test_plans_are_compiled_once(tmp_path, monkeypatch):
+    definition = scan_plan.validate(GRID)
+    plan = scan_plan.get_plan(definition, {'X': 100}, str(tmp_path))
+    assert os.listdir(str(tmp_path)) == [plan['key'] + '.json']
+
+    def compile_plan(*args):
+        raise AssertionError('compiled again')
+    monkeypatch.setattr(scan_plan, 'compile_plan', compile_plan)
+    assert scan_plan.get_plan(definition, {'X': 100}, str(tmp_path)) == plan
+
+
+def test_definitions_load_from_json_and_toml(tmp_path):
+    json_path = tmp_path / 'scan.json'
+    json_path.write_text(json.dumps(GRID))
+    toml_path = tmp_path / 'scan.toml'
+    toml_path.write_text('distance_x = 2\ndistance_y = 1\nn_x = 3\nn_y = 3\n'
+                         '[hooks]\nduring = "math:sqrt"\n')
+    assert scan_plan.load_definition(str(json_path)) == \
+                scan_plan.load_definition(str(toml_path))
+
+
+def test_hooks_resolve_to_functions():
+    assert scan_plan.resolve_hook('math:sqrt') is math.sqrt
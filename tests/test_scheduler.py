@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+STEP = 1/1574.80316
+
+
+def test_moves_return_before_they_run(stage):
+    start = time.monotonic()
+    stage.move_x_cm(0.2)
+    assert time.monotonic() - start < 0.05
+    assert stage.moving
+    stage.wait()
+    assert not stage.moving
+
+
+def test_queued_moves_blend(stage):
+    stage.move_y_cm(0.1)
+    for _ in range(3):
+        stage.move_x_cm(0.02)
+    stage.move_x_cm(0.02, velocity=0.5)
+    stage.move_x_cm(-0.02)
+    queue = stage.queue
+    assert [(move['axis'], move['merged']) for move in queue] == \
+                [('Y', 1), ('X', 3), ('X', 1), ('X', 1)]
+    assert queue[1]['distance'] == pytest.approx(0.06)
+    stage.wait()
+    assert stage.get_position() == (pytest.approx(0.06, abs=2*STEP),
+                                    pytest.approx(0.1, abs=STEP))
+
+
+def test_clear_queue_keeps_the_running_move(stage):
+    stage.move_x_cm(0.1)
+    stage.move_y_cm(0.1)
+    stage.move_x_cm(0.1)
+    time.sleep(0.05)
+    assert stage.clear_queue() == 2
+    stage.wait()
+    assert stage.get_position() == (pytest.approx(0.1, abs=STEP), 0)
+
+
+def test_exclusive_jobs_refused_while_moving(stage):
+    stage.move_x_cm(0.1)
+    with pytest.raises(ValueError, match='while the stage is moving'):
+        stage.move_to_cm([0, 0], require_home=False)
+    stage.wait()
+
+
+def test_a_failed_move_does_not_stop_the_queue(stage):
+    stage.move_x_cm(0.02)
+    ## a speed the step loop can't run at
+    stage.move_y_cm(0.02, velocity=0)
+    stage.wait()
+    assert isinstance(stage.scheduler.last_error, ZeroDivisionError)
+    assert stage.get_position() == (pytest.approx(0.02, abs=STEP), 0)
+    stage.move_x_cm(-0.02)
+    stage.wait()
+    assert stage.scheduler.last_error is None
@@ -0,0 +1,73 @@
+import pytest
+
+from xy_stage import sim_gpio
+from xy_stage.axis import FIXED_SETTLE
+from xy_stage.cli import LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+from xy_stage.xy_stage import XY_Stage
+
+SETTLE = {'enable_settle': 0.05, 'dir_settle': 0.02}
+
+
+@pytest.fixture
+def stage(sim):
+    return XY_Stage(LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                    x_axis_kwargs=SETTLE, y_axis_kwargs=SETTLE)
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    '''
+    Records every write to an output pin, changed or not
+    '''
+    writes = []
+    output = sim_gpio.output
+    def record(pin, value):
+        writes.append((pin, value))
+        output(pin, value)
+    monkeypatch.setattr(sim_gpio, 'output', record)
+    return writes
+
+
+def control_writes(writes, pins):
+    return [(pin, int(value)) for pin, value in writes
+                if pin in (pins['ena'], pins['dir'])]
+
+
+def run(stage, *distances):
+    ## one at a time, queued moves would be merged into one
+    for distance in distances:
+        stage.move_x_cm(distance)
+        stage.wait()
+
+
+def test_only_the_first_move_settles_while_enabled(stage, writes):
+    stage.enable()
+    stage.reset_settle_stats()
+    run(stage, 0.01, 0.01, 0.01, 0.01)
+    stats = stage.settle_stats()['X']
+    assert stats['moves'] == 4
+    assert stats['spent'] <= SETTLE['enable_settle']
+    assert stats['saved'] >= 4*FIXED_SETTLE - SETTLE['enable_settle']
+    ## enabled once, the direction set once (away from home)
+    assert control_writes(writes, LATRT_XPINS) == [(LATRT_XPINS['ena'], 0),
+                                                   (LATRT_XPINS['dir'], 0)]
+
+
+def test_a_direction_change_settles(stage, writes):
+    stage.enable()
+    run(stage, 0.01)
+    stage.reset_settle_stats()
+    run(stage, -0.01, -0.01)
+    stats = stage.settle_stats()['X']
+    assert stats['spent'] == pytest.approx(SETTLE['dir_settle'], abs=0.01)
+    assert control_writes(writes, LATRT_XPINS)[2:] == [(LATRT_XPINS['dir'], 1)]
+
+
+def test_released_driver_settles_after_every_enable(stage, writes):
+    run(stage, 0.01, 0.01)
+    stats = stage.settle_stats()['X']
+    assert stats['spent'] == pytest.approx(2*SETTLE['enable_settle'], abs=0.02)
+    assert control_writes(writes, LATRT_XPINS) == [
+                (LATRT_XPINS['ena'], 0), (LATRT_XPINS['dir'], 0),
+                (LATRT_XPINS['ena'], 1), (LATRT_XPINS['ena'], 0),
+                (LATRT_XPINS['ena'], 1)]
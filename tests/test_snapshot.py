@@ -0,0 +1,46 @@
+import pytest
+
+from xy_agent.xy_connect import Snapshot
+
+
+def test_idle_snapshot_agrees_with_the_single_queries(client):
+    client.move_x_cm(0.02)
+    client.wait()
+    state = client.snapshot()
+    assert state.stage == 'xy'
+    assert list(state.axes) == ['X', 'Y']
+    assert list(state.position) == client.position
+    assert [list(limits) for limits in state.limits] == client.limits
+    assert state.moving is client.moving is False
+    assert state.homed is client.build_text('homed', prop=True)
+    assert state.queue == []
+    assert state.last_error is None
+    x = state.axes['X']
+    assert x.step_position == round(0.02*x.steps_per_cm)
+    assert x.target_step is None and x.velocity == 0
+
+
+def test_snapshot_of_a_move_in_progress(client):
+    client.move_x_cm(0.2, velocity=0.5)
+    client.move_y_cm(0.01)
+    ## past the settle, into the step loop
+    state = client.snapshot()
+    while not state.axes['X'].velocity:
+        state = client.snapshot()
+    x = state.axes['X']
+    assert state.moving
+    assert x.velocity == pytest.approx(0.5, rel=0.01)
+    assert x.target_step == round(0.2*x.steps_per_cm)
+    assert [move['axis'] for move in state.queue] == ['X', 'Y']
+    assert x.driver_enabled
+    client.wait()
+
+
+def test_snapshot_reads_newer_and_older_servers():
+    axis = {'position': 1.0, 'limits': {'cw': False, 'ccw': False},
+            'added_later': 1}
+    state = Snapshot.from_dict({'time': 0, 'stage': 'xy', 'moving': False,
+                                'axes': {'X': axis}, 'extra': True})
+    assert state.position == (1.0,)
+    assert state.axes['X'].homed is None
+    assert state.queue is None
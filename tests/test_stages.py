@@ -0,0 +1,95 @@
+import argparse
+import json
+import time
+from threading import Thread
+
+import pytest
+
+from xy_stage.cli import stage_configs, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+from xy_stage.server import XY_Server
+from xy_agent.xy_connect import XY_Stage
+
+ROT_PINS = {'ena': 5, 'pul': 6, 'dir': 12, 'eot_ccw': 13, 'eot_cw': 22}
+
+
+@pytest.fixture
+def rot_server(sim, tmp_path):
+    sim.add_axis(ROT_PINS, 100, 4)
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       stage_configs={'rot': [{'name': 'R', 'pin_list': ROT_PINS,
+                                               'steps_per_cm': 100}]},
+                       log_dir=str(tmp_path))
+    server.init_stages()
+    Thread(target=server.work, daemon=True).start()
+    yield server
+    server.close()
+
+
+def write_config(tmp_path, configs):
+    path = tmp_path / 'stages.json'
+    path.write_text(json.dumps(configs))
+    return str(path)
+
+
+def test_server_hosts_the_stages_of_a_config_file(sim, tmp_path):
+    sim.add_axis(ROT_PINS, 100, 4)
+    path = write_config(tmp_path, {'rot': [
+                {'name': 'R', 'pin_list': ROT_PINS, 'steps_per_cm': 100,
+                 'enable_settle': 0.01}]})
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       stage_configs=stage_configs(path), log_dir=str(tmp_path))
+    server.init_stages()
+    Thread(target=server.work, daemon=True).start()
+    client = XY_Stage(*server.server.getsockname(), stage='rot')
+    try:
+        assert sorted(server.list_stages()) == ['rot', 'xy']
+        assert server.get_stage('rot').axis('R').enable_settle == 0.01
+        client.move_cm('R', 0.1)
+        client.wait()
+        assert client.get_positions() == {'R': pytest.approx(0.1)}
+    finally:
+        client.close()
+        server.close()
+
+
+@pytest.mark.parametrize('configs', [[], {'rot': {}}, {'rot': [{'name': 'R'}]}])
+def test_bad_config_files_are_refused(tmp_path, configs):
+    with pytest.raises(argparse.ArgumentTypeError):
+        stage_configs(write_config(tmp_path, configs))
+
+
+def test_missing_config_file_is_refused(tmp_path):
+    with pytest.raises(argparse.ArgumentTypeError):
+        stage_configs(str(tmp_path / 'missing.json'))
+
+
+def test_stages_move_in_parallel(rot_server):
+    address = rot_server.server.getsockname()
+    xy, rot = XY_Stage(*address), XY_Stage(*address, stage='rot')
+    try:
+        rot.move_cm('R', 0.5, 0.5)
+        start = time.monotonic()
+        xy.move_x_cm(0.05)
+        xy.wait()
+        assert time.monotonic() - start < 0.5
+        assert rot.moving
+        assert xy.get_positions()['X'] == pytest.approx(0.05, abs=1e-3)
+        rot.wait()
+        assert rot.get_positions() == {'R': pytest.approx(0.5)}
+    finally:
+        xy.close()
+        rot.close()
+
+
+def test_messages_name_their_stage(rot_server):
+    assert rot_server.list_stages() == {'xy': ['X', 'Y'], 'rot': ['R']}
+    assert rot_server.dispatch({'property': 'axis_names', 'stage': 'rot'}) == \
+                {'resp': ['R']}
+    assert 'error' in rot_server.dispatch({'property': 'axis_names',
+                                           'stage': 'tilt'})
+
+
+def test_extra_stages_cannot_take_the_xy_stage_id(sim, tmp_path):
+    with pytest.raises(ValueError):
+        XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                  stage_configs={'xy': []}, log_dir=str(tmp_path))
@@ -0,0 +1,102 @@
+import time
+from threading import Thread
+
+import pytest
+
+
+def test_stop_ramps_down_and_reports(stage):
+    stage.move_x_cm(2, 1.27)
+    time.sleep(0.4)
+    report = stage.stop()
+    assert report['latency'] is not None and report['latency'] < 0.05
+    assert report['axes']['X']['ramp_steps'] > 0
+    assert not stage.moving
+    assert 0 < stage.get_position()[0] < 2
+    assert stage.queue == []
+
+
+def test_stop_while_idle_does_not_block_next_move(stage):
+    report = stage.stop()
+    assert report['axes'] == {}
+    stage.move_x_cm(0.1)
+    stage.wait()
+    assert stage.get_position()[0] == pytest.approx(0.1, abs=1e-3)
+
+
+def test_stop_drops_queued_moves(stage):
+    stage.move_x_cm(1, 1.27)
+    stage.move_y_cm(1, 1.27)
+    time.sleep(0.4)
+    stage.stop()
+    assert stage.get_position()[1] == 0
+
+
+def test_stop_during_move_to_cm_skips_remaining_axes(stage):
+    thread = Thread(target=stage.move_to_cm, args=([1, 1],),
+                    kwargs={'require_home': False})
+    thread.start()
+    time.sleep(0.5)
+    report = stage.stop()
+    thread.join()
+    assert 0 < report['position'][0] < 1
+    assert report['position'][1] == 0
+    time.sleep(0.3)
+    assert stage.get_position()[1] == 0
+
+
+def test_stop_during_sequential_home_raises_stopped(stage):
+    errors = []
+    def home():
+        try:
+            stage.home(parallel=False)
+        except ValueError as err:
+            errors.append(err)
+    thread = Thread(target=home)
+    thread.start()
+    time.sleep(0.5)
+    stage.stop()
+    thread.join()
+    assert len(errors) == 1
+    assert 'stopped' in str(errors[0])
+    assert not stage.y_axis.homed
+    assert stage.get_position()[1] == 0
+
+
+def stopped_move(stage, velocity, delay=0.4):
+    stage.move_x_cm(2, velocity)
+    time.sleep(delay)
+    return stage.stop()['axes']['X']
+
+
+@pytest.mark.parametrize('decel', [5.0, 20.0])
+def test_ramp_length_follows_decel(stage, decel):
+    axis = stage.x_axis
+    axis.decel = decel
+    ramp = axis.decel_ramp(1.0/(2*1.27*axis.steps_per_cm))
+    expected = (1.27**2 - axis.stop_velocity**2)/(2*decel)*axis.steps_per_cm
+    assert len(ramp) == pytest.approx(expected, abs=1)
+    assert ramp == sorted(ramp)
+    assert stopped_move(stage, 1.27)['ramp_steps'] == len(ramp)
+
+
+def test_slow_moves_stop_at_once(stage):
+    assert stopped_move(stage, stage.x_axis.stop_velocity)['ramp_steps'] == 0
+
+
+def test_stop_while_settling(stage):
+    report = stopped_move(stage, 1.27, delay=0.05)
+    assert report['ramp_steps'] == 0
+    assert stage.get_position()[0] == 0
+
+
+def test_stop_is_not_held_up_by_a_wait(client):
+    client.move_x_cm(2, 1.27)
+    waiting = Thread(target=client.wait)
+    waiting.start()
+    time.sleep(0.4)
+    start = time.monotonic()
+    report = client.stop()
+    waiting.join()
+    assert report['latency'] < 0.05
+    assert time.monotonic() - start < report['stop_time'] + 0.1
+    assert not client.moving
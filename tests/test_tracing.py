@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from xy_agent import tracing
+
+
+@pytest.fixture
+def tracer():
+    tracer = tracing.Tracer('test')
+    yield tracer
+    tracer.stop()
+
+
+def test_spans_are_free_while_tracing_is_off(tracer):
+    assert tracer.span('idle') is tracing.NULL_SPAN
+    with tracer.span('idle'):
+        pass
+    assert tracer.events == []
+
+
+def test_spans_nest_and_inherit_the_trace_id(tracer):
+    tracer.start()
+    with tracer.span('outer', trace_id='t1', size=3):
+        assert tracer.current_id == 't1'
+        with tracer.span('inner'):
+            pass
+    assert tracer.current_id is None
+    spans = {event['name']: event for event in tracer.events
+                if event['ph'] == 'X'}
+    assert spans['outer']['args'] == {'size': 3, 'trace_id': 't1'}
+    assert spans['outer']['ts'] <= spans['inner']['ts']
+    assert spans['inner']['ts'] + spans['inner']['dur'] <= \
+                spans['outer']['ts'] + spans['outer']['dur']
+    names = [event['args']['name'] for event in tracer.events
+                if event['ph'] == 'M']
+    assert names[0] == 'test'
+
+
+def test_a_request_is_traced_through_every_layer(client, tmp_path):
+    path = str(tmp_path / 'trace.json')
+    ## client and server share one tracer in this process
+    client.trace_start(server=False)
+    client.move_x_cm(0.01)
+    client.wait()
+    count = client.export_trace(path, server=False)
+    with open(path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    assert len(events) == count
+    rpc = [event for event in events if event['name'] == 'rpc:move_x_cm']
+    trace_id = rpc[0]['args']['trace_id']
+    flows = [event['ph'] for event in events
+                if event.get('cat') == 'rpc' and event['id'] == trace_id]
+    assert flows == ['s', 't', 'f']
+    traced = {event['name'] for event in events
+                if event.get('args', {}).get('trace_id') == trace_id}
+    assert {'rpc:move_x_cm', 'dispatch:move_x_cm', 'move'} <= traced
+    names = {event['name'] for event in events}
+    assert {'settle', 'step_loop', 'decode', 'encode'} <= names
@@ -0,0 +1,95 @@
+import pytest
+
+from xy_stage import sim_gpio
+from xy_stage.cli import simulate_latrt, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+from xy_stage.xy_stage import XY_Stage
+from xy_stage.server import XY_Server
+from xy_stage.trigger import Trigger
+
+PIN = 5
+
+
+def rising_edges(pin):
+    return sum(level == 1 for _, level in sim_gpio.edges(pin))
+
+
+def test_position_triggers_fire_at_their_steps(stage):
+    stage.set_trigger(PIN)
+    sim_gpio.watch(PIN)
+    positions = [0.1, 0.2]
+    stage.set_trigger_positions('X', positions)
+    stage.move_x_cm(0.3)
+    stage.wait()
+    log = stage.trigger_log()
+    fired = [entry['step_position'] for entry in log
+                if entry['source'] == 'position']
+    assert fired == [int(round(p*STEP_PER_CM)) for p in positions]
+    assert [entry['source'] for entry in log][-1] == 'move_end'
+    assert rising_edges(PIN) == 3
+
+
+def test_position_triggers_after_setting_the_position(stage):
+    stage.set_trigger(PIN)
+    stage.set_position((1.0, 1.0))
+    stage.set_trigger_positions('X', [1.1])
+    stage.move_x_cm(0.2)
+    stage.wait()
+    assert [entry['source'] for entry in stage.trigger_log()] == \
+                ['position', 'move_end']
+
+
+def test_no_move_end_pulse_after_a_limit_stop():
+    simulate_latrt(travel_cm=1)
+    stage = XY_Stage(LATRT_XPINS, LATRT_YPINS, STEP_PER_CM)
+    stage.set_trigger(PIN)
+    stage.move_x_cm(2)
+    stage.wait()
+    assert stage.get_position()[0] < 1
+    assert stage.trigger_log() == []
+
+
+def test_move_to_cm_pulses_when_it_arrives(stage):
+    stage.set_trigger(PIN)
+    assert stage.move_to_cm([0.1, 0.1], require_home=False)
+    log = stage.trigger_log()
+    assert [entry['source'] for entry in log] == ['move_end']
+    assert log[0]['axis'] == 'Y'
+
+
+def test_pulse_width_and_polarity(sim):
+    sim_gpio.watch(PIN)
+    trigger = Trigger(PIN, width=0.01, active_high=False)
+    trigger.pulse('move_end')
+    (start, low), (end, high) = sim_gpio.edges(PIN)[-2:]
+    assert (low, high) == (0, 1)
+    assert end - start >= 0.01
+    assert sim_gpio.input(PIN) == 1
+
+
+def test_log_since_an_index(sim):
+    trigger = Trigger(PIN)
+    for _ in range(3):
+        trigger.pulse('position', 'X', 0)
+    assert [entry['index'] for entry in trigger.entries(since=1)] == [2, 3]
+
+
+def test_trigger_over_the_network(client):
+    client.set_trigger(PIN)
+    client.set_trigger_positions('X', [0.01])
+    client.move_x_cm(0.02)
+    client.wait()
+    log = client.trigger_log()
+    assert [entry['source'] for entry in log] == ['position', 'move_end']
+    assert client.trigger_log(since=log[0]['index']) == log[1:]
+    client.set_trigger(None)
+    assert client.trigger_log() == []
+
+
+def test_server_sets_up_the_trigger_pin(sim, tmp_path):
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       log_dir=str(tmp_path), trigger_pin=PIN)
+    try:
+        server.init_stages()
+        assert server.get_stage().trigger.pin == PIN
+    finally:
+        server.close()
@@ -0,0 +1,33 @@
+import pytest
+
+GRID = [[x, y] for y in (-0.02, 0, 0.02) for x in (-0.02, 0, 0.02)]
+
+
+def positions(results):
+    return [point['position'] for point in results]
+
+
+def set_functions(scan):
+    scan.set_before_scan_function(lambda: None)
+    scan.set_during_scan_function(lambda: 1.0)
+    scan.set_after_scan_function(lambda: None)
+
+
+def test_repeated_grid_scans_start_from_the_center(scan):
+    set_functions(scan)
+    scan.setup_scan(0.04, 0.04, 3, 3)
+    ## left over from a scan that failed part way
+    scan.offset = [1.0, 1.0]
+    for _ in range(2):
+        scan.execute()
+        assert positions(scan.results) == [pytest.approx(p) for p in GRID]
+        assert scan.offset == pytest.approx([0, 0])
+
+
+def test_repeated_plans_start_from_the_center(scan, tmp_path):
+    scan.load_definition({'distance_x': 0.04, 'distance_y': 0.04,
+                          'n_x': 3, 'n_y': 3}, cache_dir=str(tmp_path))
+    scan.offset = [1.0, 1.0]
+    for _ in range(2):
+        results = scan.execute_plan()
+        assert positions(results) == [pytest.approx(p) for p in GRID]
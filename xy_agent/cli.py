@@ -0,0 +1,181 @@
+"""
+Entry points for the xy_client, xy_scan and xy_jobs commands.
+
+Only the standard library is imported here, the scan machinery is loaded
+once a command actually needs it.
+"""
+import time
+
+from . import xy_connect as connect
+
+
+def _connection_args(parser):
+    parser.add_argument('--host', default=connect.LATRT_HOST)
+    parser.add_argument('--port', type=int, default=connect.LATRT_PORT)
+    parser.add_argument('--encoding', default='json', choices=('json', 'binary'))
+    parser.add_argument('--ready-timeout', type=float, default=60,
+                        help='seconds to wait for the server to answer')
+
+
+def client_main(args=None):
+    start = time.perf_counter()
+    import argparse
+    parser = argparse.ArgumentParser(description='Connect to the XY stage server')
+    _connection_args(parser)
+    parser.add_argument('--probe', action='store_true',
+                        help='only check that the server is ready, then exit')
+    args = parser.parse_args(args)
+
+    try:
+        waited = connect.wait_until_ready(args.host, args.port, args.ready_timeout)
+    except TimeoutError as err:
+        print(err)
+        return 1
+    if args.probe:
+        print('Server ready (waited {:.3f} s)'.format(waited))
+        return 0
+
+    xy_stage = connect.XY_Stage.latrt_xy_stage(args.host, args.port,
+                                               encoding=args.encoding)
+    print('Connected in {:.3f} s, position {}'.format(
+            time.perf_counter() - start, xy_stage.position))
+
+    import code
+    code.interact(local={'xy_stage': xy_stage})
+    xy_stage.close()
+    return 0
+
+
+def scan_main(args=None):
+    start = time.perf_counter()
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a grid scan with the XY stage')
+    _connection_args(parser)
+    parser.add_argument('--distance-x', type=float, default=10)
+    parser.add_argument('--distance-y', type=float, default=10)
+    parser.add_argument('--n-x', type=int, default=3)
+    parser.add_argument('--n-y', type=int, default=3)
+    parser.add_argument('--x-vel', type=float, default=0.5)
+    parser.add_argument('--y-vel', type=float, default=0.5)
+    parser.add_argument('--scan-dir', default='x', choices=('x', 'y'))
+    parser.add_argument('--raster', action='store_true')
+    parser.add_argument('--dwell', type=float, default=1,
+                        help='seconds to sit at each point')
+    parser.add_argument('--definition',
+                        help='scan definition file (.json or .toml), overrides '
+                             'the grid options')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='recompile the definition even if a plan is cached')
+    parser.add_argument('--trace',
+                        help='write a Chrome trace of the scan to this file')
+    args = parser.parse_args(args)
+
+    try:
+        connect.wait_until_ready(args.host, args.port, args.ready_timeout)
+    except TimeoutError as err:
+        print(err)
+        return 1
+
+    from .xy_scan import XY_Scan
+    scan = XY_Scan(with_ocs=False, host=args.host, port=args.port,
+                   encoding=args.encoding)
+    if args.trace is not None:
+        scan.xy_stage.trace_start()
+    if args.definition is not None:
+        from . import scan_plan
+        cache_dir = None if args.no_cache else scan_plan.DEFAULT_CACHE_DIR
+        scan.load_definition(args.definition, cache_dir)
+        print('Scan ready in {:.3f} s'.format(time.perf_counter() - start))
+        scan.execute_plan()
+    else:
+        _grid_scan(scan, args, start)
+    if args.trace is not None:
+        count = scan.xy_stage.export_trace(args.trace)
+        print('Wrote {} trace events to {}'.format(count, args.trace))
+    return 0
+
+
+def _grid_scan(scan, args, start):
+    scan.setup_scan(total_distance_x=args.distance_x,
+                    total_distance_y=args.distance_y,
+                    N_pts_x=args.n_x, N_pts_y=args.n_y,
+                    x_vel=args.x_vel, y_vel=args.y_vel,
+                    scan_dir=args.scan_dir, step_raster=args.raster)
+
+    def during():
+        x, y = scan.xy_stage.position
+        print('Position: {}, {}'.format(x, y))
+        time.sleep(args.dwell)
+
+    scan.set_before_scan_function(lambda: None)
+    scan.set_during_scan_function(during)
+    scan.set_after_scan_function(lambda: None)
+    print('Scan ready in {:.3f} s'.format(time.perf_counter() - start))
+    scan.execute()
+
+
+def jobs_main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Queue scans and run them back to back')
+    parser.add_argument('--jobs-host', default='127.0.0.1',
+                        help='host of the job daemon')
+    parser.add_argument('--jobs-port', type=int, default=3020)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='run the job daemon')
+    _connection_args(serve)
+    serve.add_argument('--state', help='file the queue is saved to')
+    serve.add_argument('--nearby', type=float, default=5,
+                       help='cm, move straight to jobs starting this close')
+    serve.add_argument('--center', type=float, nargs=2,
+                       help='absolute center of jobs without one, defaults '
+                            'to the current position')
+
+    submit = commands.add_parser('submit', help='queue a scan definition')
+    submit.add_argument('definition', help='scan definition file (.json or .toml)')
+    submit.add_argument('--priority', type=int, default=0)
+    submit.add_argument('--name')
+    submit.add_argument('--center', type=float, nargs=2)
+    submit.add_argument('--test', action='store_true',
+                        help='sleep at each point instead of running the hooks')
+
+    status = commands.add_parser('status', help='show the jobs')
+    status.add_argument('job_id', type=int, nargs='?')
+
+    cancel = commands.add_parser('cancel', help='cancel a pending job')
+    cancel.add_argument('job_id', type=int)
+    args = parser.parse_args(args)
+
+    from . import job_queue
+    if args.command == 'serve':
+        try:
+            connect.wait_until_ready(args.host, args.port, args.ready_timeout)
+        except TimeoutError as err:
+            print(err)
+            return 1
+        from .xy_scan import XY_Scan
+        scan = XY_Scan(with_ocs=False, host=args.host, port=args.port,
+                       encoding=args.encoding)
+        state = job_queue.DEFAULT_STATE if args.state is None else args.state
+        queue = job_queue.JobQueue(state, args.nearby)
+        daemon = job_queue.JobDaemon(scan, queue, args.jobs_host, args.jobs_port,
+                                     args.center)
+        print('Serving jobs on {}:{}, center {}'.format(
+                args.jobs_host, args.jobs_port, daemon.center))
+        daemon.work()
+        return 0
+
+    client = job_queue.JobClient(args.jobs_host, args.jobs_port)
+    if args.command == 'submit':
+        print('Job', client.submit(args.definition, args.priority, args.center,
+                                   args.name, args.test))
+    elif args.command == 'cancel':
+        client.cancel(args.job_id)
+    else:
+        jobs = client.status(args.job_id)
+        if args.job_id is not None:
+            jobs = [jobs]
+        for job in jobs:
+            print('{id:>4} {status:<10} priority {priority:<3} {name} '
+                  'duration {duration}'.format(**job))
+    return 0
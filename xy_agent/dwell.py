@@ -0,0 +1,76 @@
+"""
+Adaptive dwell at a scan point.
+
+Instead of integrating for a fixed time, the point is measured with
+repeated short acquisitions. A running mean and variance (Welford's
+algorithm, one update per acquisition, no samples kept) give the
+signal-to-noise ratio of the mean, and the point is done as soon as it
+reaches the target or the maximum dwell runs out. Strong signals finish
+after a few acquisitions, points near the noise floor use the full dwell.
+"""
+import math
+import time
+
+
+class RunningStats(object):
+    """Streaming mean and variance of the values added"""
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta/self.n
+        self._m2 += delta*(value - self.mean)
+
+    @property
+    def variance(self):
+        '''
+        Sample variance, 0 until there are two values
+        '''
+        if self.n < 2:
+            return 0.0
+        return self._m2/(self.n - 1)
+
+    @property
+    def snr(self):
+        '''
+        Mean over its standard error. Infinite if the values don't scatter.
+        '''
+        if self.n < 2:
+            return 0.0
+        error = math.sqrt(self.variance/self.n)
+        if error == 0:
+            return math.inf if self.mean != 0 else 0.0
+        return abs(self.mean)/error
+
+
+def adaptive_dwell(acquire, target_snr, max_dwell, min_samples=3):
+    '''
+    Acquire until the mean reaches target_snr or max_dwell is spent
+
+    Args:
+        acquire -- function taking one short acquisition, returns a number
+        target_snr -- stop once the mean over its standard error is this
+        max_dwell -- seconds, no acquisition is started that would likely
+            end after this
+        min_samples -- acquisitions taken before the SNR is trusted
+
+    Returns: dictionary with the mean ('value'), its 'snr', the number of
+        'samples', the 'dwell' used in seconds and whether the target was
+        'reached'
+    '''
+    stats = RunningStats()
+    start = time.monotonic()
+    reached = False
+    while not reached:
+        stats.add(acquire())
+        elapsed = time.monotonic() - start
+        reached = stats.n >= min_samples and stats.snr >= target_snr
+        ## stop early rather than overrun by one acquisition
+        if elapsed + elapsed/stats.n > max_dwell:
+            break
+    return {'value': stats.mean, 'snr': stats.snr, 'samples': stats.n,
+            'dwell': elapsed, 'reached': reached}
@@ -0,0 +1,429 @@
+"""
+Queue of scan jobs run back to back by a daemon.
+
+Jobs are scan definitions (see scan_plan) with a priority and the absolute
+stage position of their center. The daemon holds the stage connection and
+runs the jobs on its own thread, so a client only has to stay connected
+long enough to submit a job or ask for its status.
+
+The next job is the pending job with the highest priority. Among those,
+a job that starts within `nearby` cm of where the stage is wins over the
+oldest one, and the stage moves straight there instead of returning to
+the center of the last scan and running the next scan's moves out from
+its center. With nothing pending the stage returns to the center, like a
+single scan does.
+
+Every job keeps its status, timing and the values the during hook
+returned at each point. The queue is saved to a JSON file on every change
+so pending jobs and results survive a restart of the daemon.
+"""
+import os
+import json
+import math
+import time
+import socket
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from . import scan_plan
+
+JOBS_PORT = 3020
+DEFAULT_STATE = os.path.join(os.path.expanduser('~'), '.cache', 'xy_stage',
+                             'jobs.json')
+## job fields left out of status, they can be large
+DETAIL_FIELDS = ('definition', 'results')
+## cm, moves shorter than this are skipped
+RESOLUTION = 0.001
+## seconds, first and longest wait before retrying after the runner failed
+RETRY_WAIT = 1
+MAX_RETRY_WAIT = 60
+
+
+def _distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+class JobQueue(object):
+    def __init__(self, path=DEFAULT_STATE, nearby=5.0):
+        '''
+        Args:
+            path -- JSON file the jobs are saved to, None to keep them in
+                memory only
+            nearby -- cm, jobs starting closer than this to the stage are
+                run next (within a priority) and moved to directly
+        '''
+        self.path = path
+        self.nearby = nearby
+        self.changed = Condition()
+        self.jobs = OrderedDict()
+        self.next_id = 1
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'r') as state_file:
+            state = json.load(state_file)
+        self.next_id = state['next_id']
+        for job in state['jobs']:
+            if job['status'] == 'running':
+                ## the daemon stopped in the middle of it
+                job['status'] = 'pending'
+                job['restarts'] += 1
+            self.jobs[job['id']] = job
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        ## write then rename so a crash never leaves half a queue
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as state_file:
+            json.dump({'next_id': self.next_id,
+                       'jobs': list(self.jobs.values())}, state_file,
+                      default=str)
+        os.replace(tmp, self.path)
+
+    def submit(self, definition, priority=0, center=None, name=None,
+               test=False):
+        '''
+        Add a job
+
+        Args:
+            definition -- scan definition dictionary
+            priority -- higher priorities run first
+            center -- absolute [x, y] of the scan center, None for the
+                daemon's center
+            test -- run without the hooks, sleeping a second per point
+
+        Returns: the job id
+        '''
+        definition = scan_plan.validate(definition)
+        plan = scan_plan.compile_plan(definition)
+        with self.changed:
+            job_id = self.next_id
+            self.next_id += 1
+            self.jobs[job_id] = {
+                'id': job_id, 'name': name, 'priority': priority,
+                'center': None if center is None else list(center),
+                'test': test, 'definition': definition,
+                'start': plan['start'], 'points': sum(
+                        entry['type'] == 'point' for entry in plan['entries']),
+                'status': 'pending', 'error': None, 'restarts': 0,
+                'submitted': time.time(), 'started': None, 'finished': None,
+                'positioning': None, 'duration': None, 'direct': None,
+                'results': None}
+            self.save()
+            self.changed.notify_all()
+        return job_id
+
+    def start_of(self, job, center):
+        '''
+        Returns: absolute position of a job's first point
+        '''
+        if job['center'] is not None:
+            center = job['center']
+        return [c + s for c, s in zip(center, job['start'])]
+
+    def next_job(self, position, center):
+        '''
+        Returns: the job to run next with the stage at position, or None
+        '''
+        pending = [job for job in self.jobs.values() if job['status'] == 'pending']
+        if not pending:
+            return None
+        top = max(job['priority'] for job in pending)
+        pending = [job for job in pending if job['priority'] == top]
+        if position is not None:
+            near = [(_distance(position, self.start_of(job, center)), job)
+                        for job in pending]
+            near = [pair for pair in near if pair[0] <= self.nearby]
+            if near:
+                return min(near, key=lambda pair: pair[0])[1]
+        return pending[0]
+
+    def take(self, position, center, block=True):
+        '''
+        Mark the next job running and return it. Waits for a job if block
+        is true, otherwise returns None if nothing is pending.
+        '''
+        with self.changed:
+            job = self.next_job(position, center)
+            while job is None and block:
+                self.changed.wait()
+                job = self.next_job(position, center)
+            if job is not None:
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self.save()
+            return job
+
+    def release(self, job):
+        '''
+        Put a job that could not be run back in the queue
+        '''
+        with self.changed:
+            if job['status'] == 'running':
+                job['status'] = 'pending'
+                job['started'] = None
+                job['restarts'] += 1
+                self.save()
+            self.changed.notify_all()
+
+    def finish(self, job, status, **fields):
+        with self.changed:
+            job.update(fields)
+            job['status'] = status
+            job['finished'] = time.time()
+            job['duration'] = job['finished'] - job['started']
+            self.save()
+            self.changed.notify_all()
+
+    def _get(self, job_id):
+        if job_id not in self.jobs:
+            raise KeyError("No job {}".format(job_id))
+        return self.jobs[job_id]
+
+    def cancel(self, job_id):
+        '''
+        Cancel a pending job. A running job can't be cancelled.
+        '''
+        with self.changed:
+            job = self._get(job_id)
+            if job['status'] != 'pending':
+                raise ValueError("Job {} is {}".format(job_id, job['status']))
+            job['status'] = 'cancelled'
+            self.save()
+            self.changed.notify_all()
+
+    def set_priority(self, job_id, priority):
+        with self.changed:
+            self._get(job_id)['priority'] = priority
+            self.save()
+            self.changed.notify_all()
+
+    def status(self, job_id=None):
+        '''
+        Returns: one job, or every job in submission order, without the
+            definition and results
+        '''
+        with self.changed:
+            if job_id is not None:
+                jobs = [self._get(job_id)]
+            else:
+                jobs = list(self.jobs.values())
+            summary = [{key: value for key, value in job.items()
+                            if key not in DETAIL_FIELDS} for job in jobs]
+        return summary[0] if job_id is not None else summary
+
+    def results(self, job_id):
+        '''
+        Returns: list of points with the value the during hook returned
+        '''
+        with self.changed:
+            return self._get(job_id)['results']
+
+
+class JobDaemon(object):
+    """
+    Runs the jobs of a JobQueue on a stage and answers clients. Requests
+    and responses are one JSON message per line, {'function': name,
+    'kwargs': {...}} answered with {'resp': value} or {'error': message}.
+    """
+    FUNCTIONS = ('submit', 'status', 'results', 'cancel', 'set_priority')
+
+    def __init__(self, scan, queue, host='127.0.0.1', port=JOBS_PORT,
+                 center=None, cache_dir=scan_plan.DEFAULT_CACHE_DIR):
+        '''
+        Args:
+            scan -- XY_Scan connected to the stage, not using ocs
+            queue -- the JobQueue
+            center -- absolute [x, y] of jobs submitted without a center,
+                None for the stage position when the daemon starts
+        '''
+        self.scan = scan
+        self.queue = queue
+        self.cache_dir = cache_dir
+        if center is None:
+            center = list(self.scan.xy_stage.position)
+        self.center = list(center)
+        ## plan and center of the last scan, until it returns to its center
+        self.previous = None
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(5)
+
+    def work(self):
+        '''
+        Run jobs on a daemon thread and accept clients forever
+        '''
+        Thread(target=self.run, name='xy-jobs', daemon=True).start()
+        while True:
+            conn, addr = self.server.accept()
+            Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        with conn, conn.makefile('rwb') as stream:
+            for line in stream:
+                try:
+                    msg = json.loads(line.decode('utf-8'))
+                    if msg['function'] not in self.FUNCTIONS:
+                        raise ValueError("Unknown function {}".format(msg['function']))
+                    f = getattr(self.queue, msg['function'])
+                    resp = {'resp': f(**msg.get('kwargs', {}))}
+                except Exception as err:
+                    resp = {'error': '{}: {}'.format(type(err).__name__, err)}
+                stream.write(bytes(json.dumps(resp, default=str) + '\n', 'utf-8'))
+                stream.flush()
+
+    def position(self):
+        return list(self.scan.xy_stage.position)
+
+    def run(self):
+        '''
+        Run jobs forever. A failure outside a job, like a dropped stage
+        connection, is retried with a growing wait so the queue keeps going
+        once the stage is back.
+        '''
+        wait = RETRY_WAIT
+        while True:
+            job = None
+            try:
+                job = self.queue.take(self.position(), self.center, block=False)
+                if job is None:
+                    self.return_to_center()
+                    job = self.queue.take(self.position(), self.center)
+                self.run_job(job)
+                wait = RETRY_WAIT
+            except Exception as err:
+                print('Job runner failed: {}, retrying in {} s'.format(err, wait))
+                ## where the stage is is unknown
+                self.previous = None
+                if job is not None:
+                    self.queue.release(job)
+                time.sleep(wait)
+                wait = min(2*wait, MAX_RETRY_WAIT)
+
+    def move_to(self, target, velocity):
+        here = self.position()
+        if abs(target[0] - here[0]) > RESOLUTION:
+            self.scan.move_x(target[0] - here[0], velocity[0])
+        if abs(target[1] - here[1]) > RESOLUTION:
+            self.scan.move_y(target[1] - here[1], velocity[1])
+
+    def return_to_center(self):
+        '''
+        Finish the last scan with its moves back to the center
+        '''
+        if self.previous is None:
+            return
+        plan, center = self.previous
+        self.previous = None
+        for entry in plan['entries'][plan['lead_out']:]:
+            self.scan.run_move(entry)
+
+    def run_job(self, job):
+        center = job['center'] if job['center'] is not None else self.center
+        start = time.time()
+        print('Starting job {} ({})'.format(job['id'], job['name']))
+        self.scan.results = []
+        try:
+            previous = self.previous
+            self.scan.load_definition(job['definition'], self.cache_dir)
+            plan = self.scan.plan
+            definition = job['definition']
+            velocity = (definition['x_vel_reset'], definition['y_vel_reset'])
+            target = self.queue.start_of(job, center)
+            direct = previous is not None and \
+                        _distance(self.position(), target) <= self.queue.nearby
+            if direct:
+                self.previous = None
+                self.move_to(target, velocity)
+            else:
+                self.return_to_center()
+                self.move_to(center, velocity)
+                for entry in plan['entries'][:plan['lead_in']]:
+                    self.scan.run_move(entry)
+            positioning = time.time() - start
+            self.scan.offset = list(plan['start'])
+            results = self.scan.execute_plan(test_scan=job['test'],
+                                             lead_in=False, lead_out=False)
+        except Exception as err:
+            ## where a failed scan left the stage is unknown, the next job
+            ## moves to its center first
+            self.previous = None
+            print('Job {} failed: {}'.format(job['id'], err))
+            self.queue.finish(job, 'failed', error=str(err),
+                              results=self.scan.results)
+            return
+        self.previous = (plan, center)
+        self.queue.finish(job, 'done', results=results, direct=direct,
+                          positioning=positioning)
+        print('Finished job {} in {:.1f} s'.format(job['id'], job['duration']))
+
+
+class JobClient(object):
+    """
+    Talks to a JobDaemon. Every request uses its own connection, so jobs
+    never depend on a client staying connected.
+    """
+    def __init__(self, host='127.0.0.1', port=JOBS_PORT, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def request(self, function, **kwargs):
+        message = json.dumps({'function': function, 'kwargs': kwargs}) + '\n'
+        with socket.create_connection((self.host, self.port),
+                                      timeout=self.timeout) as comm:
+            with comm.makefile('rwb') as stream:
+                stream.write(bytes(message, 'utf-8'))
+                stream.flush()
+                resp = json.loads(stream.readline().decode('utf-8'))
+        if 'error' in resp:
+            raise ValueError(resp['error'])
+        return resp['resp']
+
+    def submit(self, definition, priority=0, center=None, name=None,
+               test=False):
+        '''
+        Queue a scan. definition is a definition dictionary or the path of
+        a definition file, which is read here.
+
+        Returns: the job id
+        '''
+        if isinstance(definition, str):
+            if name is None:
+                name = os.path.basename(definition)
+            definition = scan_plan.load_definition(definition)
+        return self.request('submit', definition=definition, priority=priority,
+                            center=center, name=name, test=test)
+
+    def status(self, job_id=None):
+        return self.request('status', job_id=job_id)
+
+    def results(self, job_id):
+        return self.request('results', job_id=job_id)
+
+    def cancel(self, job_id):
+        return self.request('cancel', job_id=job_id)
+
+    def set_priority(self, job_id, priority):
+        return self.request('set_priority', job_id=job_id, priority=priority)
+
+    def wait(self, job_id, interval=1, timeout=None):
+        '''
+        Block until a job is no longer pending or running
+
+        Returns: the job's status
+        '''
+        start = time.monotonic()
+        while True:
+            status = self.status(job_id)
+            if status['status'] not in ('pending', 'running'):
+                return status
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Job {} is still {}".format(job_id,
+                                                               status['status']))
+            time.sleep(interval)
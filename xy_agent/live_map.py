@@ -0,0 +1,118 @@
+"""
+Live 2D map of scan results.
+
+Every point taken by the scan is spread onto a fixed grid with a Gaussian
+kernel. The grid keeps the weighted sum and the total weight per cell, so
+adding a point only touches the cells within `radius` of it and the map
+for those cells is recomputed in place. An update costs the same whether
+it is the first point of the scan or the ten thousandth.
+
+    live_map = LiveMap.from_plan(scan.plan, resolution=0.1)
+    scan.attach_map(live_map)
+    ## from another thread or a notebook cell
+    plt.imshow(live_map.image, origin='lower', extent=live_map.extent)
+
+Needs numpy, which is only imported when this module is.
+"""
+import threading
+
+import numpy as np
+
+
+class LiveMap(object):
+    """
+    Gridded accumulator turning scattered (x, y, value) samples into an
+    interpolated image. Cells further than `radius` from every sample are
+    NaN.
+    """
+    def __init__(self, x_range, y_range, resolution, sigma=None, radius=None):
+        '''
+        Args:
+            x_range, y_range -- (min, max) of the map in cm
+            resolution -- cell size in cm
+            sigma -- width of the Gaussian kernel in cm, defaults to the
+                resolution
+            radius -- cm around a sample that it contributes to, defaults
+                to 3 sigma
+        '''
+        if resolution <= 0:
+            raise ValueError("resolution must be positive")
+        self.resolution = resolution
+        self.sigma = resolution if sigma is None else sigma
+        self.radius = 3*self.sigma if radius is None else radius
+        self.x = np.arange(x_range[0], x_range[1] + resolution/2, resolution)
+        self.y = np.arange(y_range[0], y_range[1] + resolution/2, resolution)
+
+        shape = (len(self.y), len(self.x))
+        self.sum = np.zeros(shape)
+        self.weight = np.zeros(shape)
+        self.image = np.full(shape, np.nan)
+        self.n_points = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_plan(cls, plan, resolution, margin=None, **kwargs):
+        '''
+        Size the map to cover every point of a compiled scan plan
+
+        Args:
+            margin -- cm added around the points, defaults to the resolution
+        '''
+        positions = [entry['position'] for entry in plan['entries']
+                                        if entry['type'] == 'point']
+        if len(positions) == 0:
+            raise ValueError("Plan has no points to map")
+        if margin is None:
+            margin = resolution
+        xs, ys = zip(*positions)
+        return cls((min(xs)-margin, max(xs)+margin),
+                   (min(ys)-margin, max(ys)+margin), resolution, **kwargs)
+
+    @property
+    def extent(self):
+        '''
+        Returns: (left, right, bottom, top) for matplotlib's imshow
+        '''
+        half = self.resolution/2
+        return (self.x[0]-half, self.x[-1]+half, self.y[0]-half, self.y[-1]+half)
+
+    def _window(self, coords, value):
+        lo = np.searchsorted(coords, value - self.radius, side='left')
+        hi = np.searchsorted(coords, value + self.radius, side='right')
+        return slice(lo, hi)
+
+    def add(self, x, y, value):
+        '''
+        Add one sample and update the cells around it
+
+        Returns: the (row, column) slices of the cells that changed
+        '''
+        rows = self._window(self.y, y)
+        cols = self._window(self.x, x)
+        dx = self.x[cols] - x
+        dy = self.y[rows] - y
+        kernel = np.exp(-(dy[:, None]**2 + dx[None, :]**2)/(2*self.sigma**2))
+
+        with self.lock:
+            self.sum[rows, cols] += kernel*value
+            self.weight[rows, cols] += kernel
+            weight = self.weight[rows, cols]
+            image = self.image[rows, cols]
+            np.divide(self.sum[rows, cols], weight, out=image, where=weight > 0)
+            self.n_points += 1
+        return rows, cols
+
+    def snapshot(self):
+        '''
+        Returns: a copy of the current map, safe to keep while the scan
+            continues
+        '''
+        with self.lock:
+            return self.image.copy()
+
+    def clear(self):
+        with self.lock:
+            self.sum[:] = 0
+            self.weight[:] = 0
+            self.image[:] = np.nan
+            self.n_points = 0
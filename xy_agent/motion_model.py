@@ -0,0 +1,267 @@
+"""
+Client side model of the stage's motion.
+
+The server runs the moves of a stage one after the other at a constant
+step rate, after waiting for the driver to settle whenever the driver was
+re-enabled or changed direction. Knowing the moves a client sent, their
+velocities and where the stage was at the last server update is enough
+to extrapolate the position and whether the stage is still moving.
+
+The estimate comes with an error bound that grows with the time since the
+last update (timing_error) and with every settle the model had to guess
+(settle). The client asks the server again once the bound is larger than
+it can accept, and every update re-aligns the model.
+"""
+import time
+from threading import Lock
+
+
+class MotionModel(object):
+    def __init__(self, max_velocity=1.27, settle=0.25, timing_error=0.05,
+                 uncalibrated_error=0.5, resolution=0.001, agreement=0.1):
+        '''
+        Args:
+            max_velocity -- cm/s, the server's speed limit and the speed of
+                moves sent without a velocity
+            settle -- seconds the driver may wait before a move starts
+            timing_error -- smallest fraction of the elapsed time the real
+                motion may be ahead or behind the model. Raised whenever an
+                update shows the model was further off
+            uncalibrated_error -- timing error of an axis until its real
+                speed has been measured. The step loop usually runs slower
+                than the commanded velocity
+            resolution -- cm, positions closer than this to a move's target
+                count as arrived (about a step)
+            agreement -- an axis' speed counts as measured once two
+                measurements in a row agree to this fraction. Until then
+                it keeps uncalibrated_error
+        '''
+        self.max_velocity = max_velocity
+        self.settle = settle
+        self.min_timing_error = timing_error
+        self.timing_error = timing_error
+        self.uncalibrated_error = uncalibrated_error
+        self.resolution = resolution
+        self.lock = Lock()
+        self.anchor = None
+        self.synced = None
+        self.segments = []
+        self.agreement = agreement
+        ## axis -> measured speed / commanded speed
+        self.speed_scale = {}
+        ## axis -> the last measured scale
+        self.last_scale = {}
+        ## axes whose speed_scale has converged
+        self.calibrated = set()
+
+    def invalidate(self):
+        '''
+        Forget everything, the next estimate needs a server update
+        '''
+        with self.lock:
+            self.anchor = None
+            self.segments = []
+
+    def _velocity(self, axis, velocity):
+        if velocity is None:
+            velocity = self.max_velocity
+        return min(abs(velocity), self.max_velocity)*self.speed_scale.get(axis, 1)
+
+    def _append(self, axis, origin, target, velocity, now):
+        last = self.segments[-1] if self.segments else None
+        start = now if last is None else max(now, last['end'])
+        ## the driver is released between moves of different axes and has
+        ## to settle after a direction change
+        settle = (last is None or last['axis'] != axis or
+                    (last['target'] > last['origin']) != (target > origin))
+        if settle:
+            start += self.settle
+        self.segments.append({'axis': axis, 'origin': origin, 'target': target,
+                              'velocity': velocity, 'settle': settle,
+                              'under_way': False, 'start': start,
+                              'end': start + abs(target - origin)/velocity})
+
+    def finish(self, positions, now=None):
+        '''
+        The server reported that every move is done
+
+        Args:
+            positions -- dictionary of axis name -> position in cm where
+                the stage stopped. Moves cut short by a limit switch or a
+                stop end away from their targets, so the targets are not
+                trusted
+        '''
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.anchor = dict(positions)
+            self.segments = []
+            self.synced = now
+
+    def add_move(self, axis, distance, velocity=None, now=None):
+        '''
+        Add a move that was just sent to the server
+        '''
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if self.anchor is None or axis not in self.anchor:
+                return
+            origin = self.anchor[axis]
+            for segment in self.segments:
+                if segment['axis'] == axis:
+                    origin = segment['target']
+            self._append(axis, origin, origin + distance,
+                         self._velocity(axis, velocity), now)
+
+    def sync(self, positions, moving, now=None):
+        '''
+        Re-align the model with a server update
+
+        Args:
+            positions -- dictionary of axis name -> position in cm
+            moving -- whether the server reported the stage as moving
+        '''
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if self.anchor is not None and self.segments:
+                self._check_error(positions, now)
+            segments = self.segments
+            previous = self.anchor, self.synced
+            self.anchor = dict(positions)
+            self.synced = now
+            self.segments = []
+            if not moving:
+                return
+
+            current = None
+            for segment in segments:
+                axis = segment['axis']
+                if current is None:
+                    remaining = segment['target'] - positions[axis]
+                    travel = segment['target'] - segment['origin']
+                    if abs(remaining) < self.resolution or \
+                            (remaining > 0) != (travel > 0):
+                        continue
+                    current = segment
+                    started = abs(positions[axis] - segment['origin']) >= self.resolution
+                    if started and segment['under_way']:
+                        self._learn_speed(segment, previous[0][axis],
+                                          positions[axis], now - previous[1])
+                    start = now + (0 if started else self.settle)
+                    self.segments.append(dict(segment, origin=positions[axis],
+                                              settle=not started, start=start,
+                                              under_way=started,
+                                              end=start + abs(remaining)/segment['velocity']))
+                else:
+                    self._append(axis, segment['origin'], segment['target'],
+                                 segment['velocity'], now)
+            if current is None:
+                ## moving, but not with moves this client knows about
+                self.anchor = None
+
+    def _learn_speed(self, segment, before, after, elapsed):
+        '''
+        Scale the axis' speed by what was measured between two updates
+        that both saw the move under way
+        '''
+        if elapsed < 0.05:
+            return
+        axis = segment['axis']
+        scale = self.speed_scale.get(axis, 1)
+        commanded = segment['velocity']/scale
+        measured = abs(after - before)/elapsed/commanded
+        last = self.last_scale.get(axis)
+        self.last_scale[axis] = measured
+        if last is None:
+            self.speed_scale[axis] = measured
+        else:
+            self.speed_scale[axis] = 0.5*scale + 0.5*measured
+            if abs(measured - last) <= self.agreement*last:
+                self.calibrated.add(axis)
+            else:
+                ## the speed changed, the scale is a guess again
+                self.calibrated.discard(axis)
+        segment['velocity'] = commanded*self.speed_scale[axis]
+
+    def _check_error(self, positions, now):
+        '''
+        Compare the extrapolated position with an update and widen the
+        timing error if the model was further off than it claimed
+        '''
+        elapsed = now - self.synced
+        if elapsed <= 0:
+            return
+        predicted = self._estimate(now)[0]
+        for axis, position in positions.items():
+            speeds = [s['velocity'] for s in self.segments if s['axis'] == axis]
+            if not speeds:
+                continue
+            implied = abs(predicted[axis] - position)/(max(speeds)*elapsed)
+            if implied > self.timing_error:
+                self.timing_error = implied
+            else:
+                self.timing_error = max(self.min_timing_error,
+                                        0.9*self.timing_error + 0.1*implied)
+
+    def estimate(self, now=None):
+        '''
+        Returns: (positions, bounds, moving). positions and bounds are
+            dictionaries of axis name -> cm. moving is None when the model
+            can't tell. Returns None if there has been no usable update.
+        '''
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if self.anchor is None:
+                return None
+            return self._estimate(now)
+
+    def _estimate(self, now):
+        positions = dict(self.anchor)
+        bounds = {axis: 0.0 for axis in positions}
+        if not self.segments:
+            return positions, bounds, False
+
+        ## seconds the real motion may be ahead or behind the model
+        uncertainty = {}
+        settles = sum(self.settle for segment in self.segments
+                        if segment['settle'] and segment['start'] - self.settle <= now)
+        for segment in self.segments:
+            axis = segment['axis']
+            error = self.timing_error
+            if axis not in self.calibrated:
+                error = max(error, self.uncalibrated_error)
+            uncertainty[axis] = error*(now - self.synced) + settles
+        worst = max(uncertainty.values())
+        end = self.segments[-1]['end']
+        if now > end + worst:
+            for segment in self.segments:
+                positions[segment['axis']] = segment['target']
+            return positions, bounds, False
+
+        speed = {}
+        for segment in self.segments:
+            axis = segment['axis']
+            speed[axis] = max(speed.get(axis, 0), segment['velocity'])
+            if now >= segment['end']:
+                positions[axis] = segment['target']
+            elif now > segment['start']:
+                fraction = (now - segment['start'])/(segment['end'] - segment['start'])
+                positions[axis] = segment['origin'] + fraction*(
+                                    segment['target'] - segment['origin'])
+        for axis, velocity in speed.items():
+            final = [s['target'] for s in self.segments if s['axis'] == axis][-1]
+            pending = max(abs(final - positions[axis]),
+                          abs(positions[axis] - self.anchor[axis]))
+            bounds[axis] = min(velocity*uncertainty[axis], pending)
+        moving = True if now < end - worst else None
+        return positions, bounds, moving
+
+    def age(self, now=None):
+        if self.synced is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return now - self.synced
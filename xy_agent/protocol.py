@@ -0,0 +1,197 @@
+"""
+Wire encodings shared by the XY stage server and the client.
+
+Messages are dictionaries like {'property': name} or
+{'function': name, 'kwargs': {...}} and responses are {'resp': value}
+or {'error': message}. By default these are sent as JSON.
+
+A connection can switch to the binary encoding by calling the
+'set_encoding' function right after connecting. After that every message
+in both directions is a frame:
+
+    magic (B) | opcode (B) | payload length (I) | payload
+
+The high rate commands (position, moving, limits and the moves) have fixed
+struct layouts. Anything else is sent as JSON inside an OP_JSON frame, so
+the binary encoding never limits which commands can be used.
+"""
+import json
+import math
+import struct
+
+ENCODINGS = ('json', 'binary')
+
+MAGIC = 0xB1
+HEADER = struct.Struct('!BBI')
+
+OP_JSON = 0
+OP_POSITION = 1
+OP_MOVING = 2
+OP_LIMITS = 3
+OP_MOVE_X = 4
+OP_MOVE_Y = 5
+OP_ERROR = 255
+
+## message key -> opcode for the commands with fixed layouts
+FIXED_REQUESTS = {
+    ('function', 'get_position'): OP_POSITION,
+    ('property', 'moving'): OP_MOVING,
+    ('property', 'limits'): OP_LIMITS,
+    ('function', 'move_x_cm'): OP_MOVE_X,
+    ('function', 'move_y_cm'): OP_MOVE_Y,
+}
+FIXED_MESSAGES = {op: key for key, op in FIXED_REQUESTS.items()}
+
+MOVE = struct.Struct('!dd')
+POSITION = struct.Struct('!dd')
+MOVING = struct.Struct('!?')
+LIMITS = struct.Struct('!????')
+
+
+def frame(opcode, payload=b''):
+    return HEADER.pack(MAGIC, opcode, len(payload)) + payload
+
+def recv_exact(sock, nbytes):
+    '''
+    Read exactly nbytes from the socket. Returns None if the other side
+    closed the connection before anything was read.
+    '''
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError('Connection closed mid-frame')
+            return None
+        data += chunk
+    return bytes(data)
+
+def recv_frame(sock):
+    '''
+    Returns: (opcode, payload) or None if the connection was closed
+    '''
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    magic, opcode, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Bad frame magic {:#x}'.format(magic))
+    payload = b''
+    if length > 0:
+        payload = recv_exact(sock, length)
+        if payload is None:
+            raise ConnectionError('Connection closed mid-frame')
+    return opcode, payload
+
+def recv_json(sock, bufsize=65536, parse=json.loads):
+    '''
+    Read one JSON encoded message from the socket. JSON has no length
+    prefix, so this reads until the data parses. Messages are objects, so
+    parsing is only tried when the data ends in a closing brace, which
+    keeps a long message from being parsed again after every read.
+
+    Args:
+        parse -- function decoding the text, e.g. to time the parse
+            without the wait for data
+
+    Returns: (message, raw bytes) or None if the connection was closed
+    '''
+    data = b''
+    while True:
+        chunk = sock.recv(bufsize)
+        if not chunk:
+            if data:
+                raise ConnectionError('Connection closed mid-message')
+            return None
+        data += chunk
+        if data.rstrip().endswith(b'}'):
+            try:
+                return parse(data.decode('utf-8')), data
+            except ValueError:
+                continue
+
+def _fixed_opcode(message):
+    if set(message) == {'property'}:
+        return FIXED_REQUESTS.get(('property', message['property']), OP_JSON)
+    if set(message) == {'function', 'kwargs'}:
+        opcode = FIXED_REQUESTS.get(('function', message['function']), OP_JSON)
+        if opcode in (OP_MOVE_X, OP_MOVE_Y):
+            if not set(message['kwargs']) <= {'distance', 'velocity'}:
+                return OP_JSON
+        elif message['kwargs']:
+            return OP_JSON
+        return opcode
+    return OP_JSON
+
+def encode_request(message):
+    '''
+    Build the binary frame for a request message
+    '''
+    opcode = _fixed_opcode(message)
+    if opcode in (OP_MOVE_X, OP_MOVE_Y):
+        kwargs = message['kwargs']
+        velocity = kwargs.get('velocity')
+        if velocity is None:
+            velocity = math.nan
+        return frame(opcode, MOVE.pack(kwargs['distance'], velocity))
+    if opcode == OP_JSON:
+        return frame(opcode, bytes(json.dumps(message), 'utf-8'))
+    return frame(opcode)
+
+def decode_request(opcode, payload):
+    '''
+    Turn a binary request back into the same message dictionary the JSON
+    encoding would have produced
+    '''
+    if opcode == OP_JSON:
+        return json.loads(payload.decode('utf-8'))
+    if opcode not in FIXED_MESSAGES:
+        raise ValueError('Unknown opcode {}'.format(opcode))
+    key, name = FIXED_MESSAGES[opcode]
+    if key == 'property':
+        return {'property': name}
+    kwargs = {}
+    if opcode in (OP_MOVE_X, OP_MOVE_Y):
+        distance, velocity = MOVE.unpack(payload)
+        if math.isnan(velocity):
+            velocity = None
+        kwargs = {'distance': distance, 'velocity': velocity}
+    return {'function': name, 'kwargs': kwargs}
+
+def encode_response(opcode, resp):
+    '''
+    Build the binary frame answering a request with the given opcode
+    '''
+    if 'error' in resp:
+        return frame(OP_ERROR, bytes(str(resp['error']), 'utf-8'))
+    value = resp.get('resp')
+    if opcode == OP_POSITION:
+        return frame(opcode, POSITION.pack(*value))
+    if opcode == OP_MOVING:
+        return frame(opcode, MOVING.pack(bool(value)))
+    if opcode == OP_LIMITS:
+        (x_cw, x_ccw), (y_cw, y_ccw) = value
+        return frame(opcode, LIMITS.pack(x_cw, x_ccw, y_cw, y_ccw))
+    if opcode in (OP_MOVE_X, OP_MOVE_Y):
+        return frame(opcode)
+    return frame(OP_JSON, bytes(json.dumps(resp), 'utf-8'))
+
+def decode_response(opcode, payload):
+    '''
+    Returns: the response dictionary, {'resp': value} or {'error': message}.
+        The values are the same as JSON gives, lists rather than tuples
+    '''
+    if opcode == OP_ERROR:
+        return {'error': payload.decode('utf-8')}
+    if opcode == OP_JSON:
+        return json.loads(payload.decode('utf-8'))
+    if opcode == OP_POSITION:
+        return {'resp': list(POSITION.unpack(payload))}
+    if opcode == OP_MOVING:
+        return {'resp': MOVING.unpack(payload)[0]}
+    if opcode == OP_LIMITS:
+        x_cw, x_ccw, y_cw, y_ccw = LIMITS.unpack(payload)
+        return {'resp': [[x_cw, x_ccw], [y_cw, y_ccw]]}
+    if opcode in (OP_MOVE_X, OP_MOVE_Y):
+        return {'resp': None}
+    raise ValueError('Unknown opcode {}'.format(opcode))
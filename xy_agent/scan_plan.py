@@ -0,0 +1,268 @@
+"""
+Declarative scan definitions.
+
+A scan is described in a JSON or TOML file, for example
+
+    {
+        "pattern": "grid",
+        "distance_x": 10, "distance_y": 10,
+        "n_x": 3, "n_y": 3,
+        "x_vel": 1, "y_vel": 1,
+        "scan_dir": "x",
+        "step_raster": true,
+        "dwell": 2,
+        "hooks": {"during": "my_experiment.acquire:take_data"}
+    }
+
+With "target_snr" and "max_dwell" set, each point calls the "acquire"
+hook repeatedly instead of running "during" and sleeping the dwell, until
+the mean reaches the SNR (see dwell).
+
+The definition is validated up front and compiled into a plan, a list of
+moves (with step counts from the axis calibration) and points. Compiled
+plans are cached on disk under a hash of the definition and calibration
+so they are only planned once.
+"""
+import os
+import json
+import hashlib
+import importlib
+
+## bump when compile_plan changes so old cached plans are not used
+PLAN_VERSION = 2
+
+PATTERNS = ('grid', 'raster_y')
+
+DEFAULTS = {
+    'pattern': 'grid',
+    'distance_x': 0,
+    'distance_y': 0,
+    'n_x': 1,
+    'n_y': 1,
+    'x_vel': 0.5,
+    'y_vel': 0.5,
+    'x_vel_reset': None,
+    'y_vel_reset': None,
+    'scan_dir': 'x',
+    'step_raster': False,
+    'dwell': 0,
+    'target_snr': None,
+    'max_dwell': None,
+    'min_samples': 3,
+    'hooks': {},
+}
+
+HOOKS = ('before', 'during', 'after', 'acquire')
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'xy_stage', 'plans')
+
+
+def load_definition(path):
+    '''
+    Read a scan definition from a .json or .toml file and validate it
+
+    Returns: the definition with defaults filled in
+    '''
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, 'rb') as def_file:
+            definition = tomllib.load(def_file)
+    else:
+        with open(path, 'r') as def_file:
+            definition = json.load(def_file)
+    return validate(definition)
+
+def validate(definition):
+    '''
+    Check a scan definition and fill in the defaults. Every problem is
+    reported at once.
+
+    Returns: the completed definition
+    '''
+    errors = []
+    unknown = set(definition) - set(DEFAULTS)
+    if unknown:
+        errors.append('unknown keys {}'.format(sorted(unknown)))
+    full = dict(DEFAULTS)
+    full.update(definition)
+
+    if full['pattern'] not in PATTERNS:
+        errors.append('pattern must be one of {}'.format(PATTERNS))
+    if full['scan_dir'] not in ('x', 'y'):
+        errors.append("scan_dir must be 'x' or 'y'")
+    for key in ('distance_x', 'distance_y', 'dwell'):
+        if not isinstance(full[key], (int, float)) or full[key] < 0:
+            errors.append('{} must be a number >= 0'.format(key))
+    for key in ('n_x', 'n_y'):
+        if not isinstance(full[key], int) or full[key] < 1:
+            errors.append('{} must be a positive integer'.format(key))
+        elif full['pattern'] == 'grid' and full[key] % 2 == 0:
+            errors.append('{} must be odd'.format(key))
+    for key in ('x_vel', 'y_vel', 'x_vel_reset', 'y_vel_reset'):
+        if full[key] is None and key.endswith('reset'):
+            continue
+        if not isinstance(full[key], (int, float)) or full[key] <= 0:
+            errors.append('{} must be a positive number'.format(key))
+    if full['target_snr'] is not None:
+        ## adaptive dwell, see dwell.adaptive_dwell
+        for key in ('target_snr', 'max_dwell'):
+            if not isinstance(full[key], (int, float)) or full[key] <= 0:
+                errors.append('{} must be a positive number'.format(key))
+        if not isinstance(full['min_samples'], int) or full['min_samples'] < 2:
+            errors.append('min_samples must be an integer >= 2')
+        if isinstance(full['hooks'], dict) and 'acquire' not in full['hooks']:
+            errors.append('target_snr needs an acquire hook')
+    if not isinstance(full['hooks'], dict):
+        errors.append('hooks must be a table of name -> import path')
+    else:
+        for name, path in full['hooks'].items():
+            if name not in HOOKS:
+                errors.append('unknown hook {}'.format(name))
+            elif not isinstance(path, str) or ':' not in path:
+                errors.append("hook {} must look like 'module:function'".format(name))
+
+    if errors:
+        raise ValueError('Bad scan definition: ' + '; '.join(errors))
+    if full['x_vel_reset'] is None:
+        full['x_vel_reset'] = full['x_vel']
+    if full['y_vel_reset'] is None:
+        full['y_vel_reset'] = full['y_vel']
+    return full
+
+def resolve_hook(path):
+    '''
+    Import a hook given as 'module:function'
+    '''
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+def plan_key(definition, calibration=None):
+    '''
+    Returns: hash of the definition and axis calibration
+    '''
+    content = json.dumps({'version': PLAN_VERSION, 'definition': definition,
+                          'calibration': calibration}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class _Planner(object):
+    def __init__(self, calibration):
+        self.calibration = calibration or {}
+        self.position = {'x': 0.0, 'y': 0.0}
+        self.entries = []
+
+    def move(self, axis, distance, velocity):
+        steps = None
+        steps_per_cm = self.calibration.get(axis.upper())
+        if steps_per_cm is not None:
+            steps = int(round(abs(distance)*steps_per_cm))
+        self.position[axis] += distance
+        self.entries.append({'type': 'move', 'axis': axis, 'distance': distance,
+                             'velocity': velocity, 'steps': steps})
+
+    def point(self, index):
+        self.entries.append({'type': 'point', 'index': index,
+                             'position': [self.position['x'], self.position['y']]})
+
+
+def compile_plan(definition, calibration=None):
+    '''
+    Turn a validated definition into the list of moves and points the scan
+    will run, matching what XY_Scan.execute does. Positions are relative to
+    the starting point, which is the center of the scan. entries before
+    lead_in move to the first point (start) and entries from lead_out on
+    return from the last point (end) to the center.
+
+    Args:
+        calibration: dictionary of axis name -> steps per cm, used to add
+            step counts to the moves
+
+    Returns: the plan dictionary
+    '''
+    d = definition
+    plan = _Planner(calibration)
+
+    if d['pattern'] == 'raster_y':
+        x_step = d['distance_x']/(d['n_x']-1) if d['n_x'] > 1 else 0
+        total = {'x': x_step*(d['n_x']-1), 'y': d['distance_y']}
+    else:
+        x_step = d['distance_x']/(d['n_x']-1) if d['n_x'] > 1 else 0
+        y_step = d['distance_y']/(d['n_y']-1) if d['n_y'] > 1 else 0
+        step = {'x': x_step, 'y': y_step}
+        total = {'x': x_step*(d['n_x']-1), 'y': y_step*(d['n_y']-1)}
+    vel = {'x': d['x_vel'], 'y': d['y_vel']}
+    reset = {'x': d['x_vel_reset'], 'y': d['y_vel_reset']}
+
+    for axis in ('x', 'y'):
+        if total[axis] > 0:
+            plan.move(axis, -total[axis]/2, reset[axis])
+    ## the moves to the first point and back to the center are marked so a
+    ## job queue can replace them with a direct move between scans
+    lead_in = len(plan.entries)
+    start = [plan.position['x'], plan.position['y']]
+
+    if d['pattern'] == 'raster_y':
+        direction = 1
+        for x in range(d['n_x']):
+            if x > 0:
+                plan.move('x', x_step, vel['x'])
+            plan.move('y', direction*total['y'], vel['y'])
+            direction *= -1
+    else:
+        inner = d['scan_dir']
+        outer = 'y' if inner == 'x' else 'x'
+        n = {'x': d['n_x'], 'y': d['n_y']}
+        direction = 1
+        for i_out in range(n[outer]):
+            if i_out > 0:
+                plan.move(outer, step[outer], vel[outer])
+            for i_in in range(n[inner]):
+                if i_in > 0:
+                    plan.move(inner, step[inner]*direction, vel[inner])
+                if direction < 0:
+                    index = {outer: i_out, inner: n[inner]-1-i_in}
+                else:
+                    index = {outer: i_out, inner: i_in}
+                plan.point([index['x'], index['y']])
+            if i_out < n[outer]-1:
+                if d['step_raster']:
+                    direction *= -1
+                else:
+                    plan.move(inner, -step[inner]*(n[inner]-1), reset[inner])
+    lead_out = len(plan.entries)
+    end = [plan.position['x'], plan.position['y']]
+    if d['pattern'] != 'raster_y':
+        for axis in ('x', 'y'):
+            if total[axis] > 0:
+                plan.move(axis, -total[axis]/2, reset[axis])
+
+    return {'version': PLAN_VERSION, 'key': plan_key(definition, calibration),
+            'calibration': calibration, 'entries': plan.entries,
+            'lead_in': lead_in, 'lead_out': lead_out, 'start': start,
+            'end': end}
+
+def get_plan(definition, calibration=None, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Load the compiled plan from the cache, or compile and cache it.
+    Set cache_dir to None to skip the cache.
+    '''
+    key = plan_key(definition, calibration)
+    if cache_dir is None:
+        return compile_plan(definition, calibration)
+    path = os.path.join(cache_dir, key + '.json')
+    if os.path.exists(path):
+        with open(path, 'r') as plan_file:
+            return json.load(plan_file)
+
+    plan = compile_plan(definition, calibration)
+    os.makedirs(cache_dir, exist_ok=True)
+    ## write then rename so a crash never leaves half a plan in the cache
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as plan_file:
+        json.dump(plan, plan_file)
+    os.replace(tmp, path)
+    return plan
@@ -0,0 +1,148 @@
+"""
+Opt-in span tracing shared by the client, the server and the motion code.
+
+Spans are recorded as Chrome trace events, so a trace can be opened in
+chrome://tracing or Perfetto. Spans on one thread nest by time. Requests
+carry a correlation id over the socket ('trace' key of the message) and
+each layer adds a flow event with that id. The viewer then draws arrows
+from the client RPC to the server dispatch to the move on the motion
+thread.
+
+Nothing is recorded until tracer.start() is called, and span() is a
+no-op returning a shared object while tracing is off.
+"""
+import os
+import json
+import time
+import itertools
+import threading
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, trace_id, flow, args):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.flow = flow
+        self.args = args
+
+    def __enter__(self):
+        local = self.tracer.local
+        self.parent_id = getattr(local, 'trace_id', None)
+        if self.trace_id is not None:
+            local.trace_id = self.trace_id
+        self.start = _now()
+        if self.flow is not None and self.trace_id is not None:
+            self.tracer.flow(self.flow, self.trace_id, self.start)
+        return self
+
+    def __exit__(self, *exc):
+        end = _now()
+        if self.trace_id is not None:
+            self.args['trace_id'] = self.trace_id
+        self.tracer.add({'name': self.name, 'ph': 'X', 'ts': self.start,
+                         'dur': end - self.start, 'args': self.args})
+        self.tracer.local.trace_id = self.parent_id
+        return False
+
+
+def _now():
+    ## wall clock microseconds, so traces from the client and the server
+    ## line up on one timeline
+    return time.time()*1e6
+
+
+class Tracer(object):
+    def __init__(self, process_name):
+        self.process_name = process_name
+        self.enabled = False
+        self.events = []
+        self.local = threading.local()
+        self._ids = itertools.count(1)
+        self._threads = set()
+
+    def start(self, process_name=None):
+        '''
+        Clear any old events and start recording
+        '''
+        if process_name is not None:
+            self.process_name = process_name
+        self.events = []
+        self._threads = set()
+        self.events.append({'name': 'process_name', 'ph': 'M',
+                            'pid': os.getpid(), 'tid': 0,
+                            'args': {'name': self.process_name}})
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        return len(self.events)
+
+    def new_id(self):
+        return '{}-{}'.format(os.getpid(), next(self._ids))
+
+    @property
+    def current_id(self):
+        '''
+        Correlation id of the innermost span on this thread that has one
+        '''
+        return getattr(self.local, 'trace_id', None)
+
+    def span(self, name, trace_id=None, flow=None, **args):
+        '''
+        Context manager timing a block of code.
+
+        Args:
+            trace_id -- correlation id. Nested spans on the same thread
+                inherit it through current_id
+            flow -- 's', 't' or 'f' to start, continue or finish the flow
+                arrow for trace_id
+            args -- extra values shown with the span
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name, trace_id, flow, args)
+
+    def flow(self, phase, trace_id, timestamp):
+        event = {'name': 'request', 'cat': 'rpc', 'ph': phase, 'id': trace_id,
+                 'ts': timestamp}
+        if phase == 'f':
+            event['bp'] = 'e'
+        self.add(event)
+
+    def add(self, event):
+        tid = threading.get_ident()
+        event['pid'] = os.getpid()
+        event['tid'] = tid
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self.events.append({'name': 'thread_name', 'ph': 'M',
+                                'pid': event['pid'], 'tid': tid,
+                                'args': {'name': threading.current_thread().name}})
+        self.events.append(event)
+
+
+tracer = Tracer('xy_stage')
+
+def span(name, trace_id=None, flow=None, **args):
+    return tracer.span(name, trace_id, flow, **args)
+
+def export(path, events=None):
+    '''
+    Write events (default: everything recorded in this process) as a
+    Chrome trace-event JSON file
+    '''
+    if events is None:
+        events = tracer.events
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
@@ -1,46 +1,338 @@
 import socket
 import json
 import time
+import itertools
+from collections import namedtuple
+from threading import Lock
 
-class XY_Stage(object):
-    def __init__(self, ip_address, port, timeout=10):
+from . import protocol
+from . import tracing
+from .motion_model import MotionModel
+
+LATRT_HOST = '192.168.10.15'
+LATRT_PORT = 3010
+
+## cheap queries that go out on the status channels so they never queue
+## up behind a long command like wait
+STATUS_COMMANDS = ('get_position', 'get_positions', 'limits', 'moving',
+                   'homed', 'is_enabled', 'stop', 'queue', 'clear_queue',
+                   'ping', 'calibration', 'capture_window',
+                   'drift_report', 'metrics', 'trigger_log', 'snapshot')
+
+## commands that are safe to send again if the connection dropped after
+## they were sent
+IDEMPOTENT_COMMANDS = STATUS_COMMANDS + ('init', 'set_encoding', 'wait',
+                                         'enable', 'disable')
+
+
+AxisState = namedtuple('AxisState', ['position', 'step_position',
+                                     'steps_per_cm', 'moving', 'velocity',
+                                     'target_step', 'move_started', 'limits',
+                                     'homed', 'needs_home', 'drift',
+                                     'hold_enable', 'driver_enabled',
+                                     'driver_dir'])
+
+class Snapshot(namedtuple('Snapshot', ['time', 'stage', 'moving', 'homed',
+                                       'enabled', 'queue', 'last_error',
+                                       'axes'])):
+    """
+    State of a stage returned by the snapshot command. axes maps the axis
+    names, in order, to AxisState tuples.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, state):
+        axes = {name: AxisState(**{field: axis.get(field)
+                                        for field in AxisState._fields})
+                    for name, axis in state['axes'].items()}
+        return cls(**dict({field: state.get(field) for field in cls._fields},
+                          axes=axes))
+
+    @property
+    def position(self):
+        return tuple(axis.position for axis in self.axes.values())
+
+    @property
+    def limits(self):
+        return tuple((axis.limits['cw'], axis.limits['ccw'])
+                        for axis in self.axes.values())
+
+
+def wait_until_ready(ip_address=LATRT_HOST, port=LATRT_PORT, timeout=60,
+                     interval=0.2):
+    '''
+    Readiness probe. Polls the server with ping until it answers.
+
+    Returns: seconds spent waiting
+    '''
+    start = time.monotonic()
+    message = bytes(json.dumps({'function':'ping', 'kwargs':{}}), 'utf-8')
+    while True:
+        try:
+            with socket.create_connection((ip_address, port),
+                                          timeout=max(interval, 1)) as comm:
+                comm.sendall(message)
+                if 'resp' in json.loads(comm.recv(1025)):
+                    return time.monotonic() - start
+        except (OSError, ValueError):
+            pass
+        if time.monotonic() - start > timeout:
+            raise TimeoutError('{}:{} not ready after {} s'.format(
+                                ip_address, port, timeout))
+        time.sleep(interval)
+
+
+class Channel(object):
+    """
+    One socket connection to the XY server.
+
+    If the connection drops the channel reconnects with exponential backoff
+    and replays its handshake (the encoding and any messages added with
+    add_handshake) before resuming. A channel handles one request at a time.
+    """
+    def __init__(self, ip_address, port, timeout=10, encoding='json',
+                 backoff=0.5, max_backoff=30, retries=10):
+        '''
+        Args:
+            timeout -- seconds to wait for a response
+            encoding -- 'json' or 'binary'. If the server refuses the
+                binary encoding the connection stays on JSON.
+            backoff -- first wait between reconnect attempts, in s.
+                Doubles after every failed attempt up to max_backoff
+            retries -- reconnect attempts before giving up
+        '''
         self.ip_address = ip_address
         self.port = port
+        self.timeout = timeout
+        self.requested_encoding = encoding
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = retries
 
+        self.lock = Lock()
+        self.handshake = []
+        self.comm = None
+        self.encoding = 'json'
+        self.connect()
 
-        self.comm = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.comm.connect((ip_address, port))
-        self.comm.settimeout(timeout)
+    def connect(self):
+        delay = self.backoff
+        for attempt in range(self.retries+1):
+            try:
+                comm = socket.create_connection((self.ip_address, self.port),
+                                                timeout=self.timeout)
+                break
+            except OSError as err:
+                if attempt == self.retries:
+                    raise
+                print('Cannot connect to {}:{} ({}), retrying in {} s'.format(
+                        self.ip_address, self.port, err, delay))
+                time.sleep(delay)
+                delay = min(2*delay, self.max_backoff)
+        self.comm = comm
+        self.encoding = 'json'
+        if self.requested_encoding != 'json':
+            self._negotiate(self.requested_encoding)
+        for message in self.handshake:
+            self._exchange(message)
 
-    def send(self, message):
-        try:
-            msg = bytes(json.dumps(message), 'utf-8')
-        except:
-            msg = json.dumps(message)
-        self.comm.sendall(msg)
-        try:
-            data = self.comm.recv(1025)
-            resp = json.loads(data)
-            if 'error' in resp:
-                raise Exception(resp['error'])
-            return resp['resp']
-        except socket.timeout:
-            return None
+    def reconnect(self):
+        self.close()
+        self.connect()
 
     def close(self):
-        self.comm.close()
+        if self.comm is not None:
+            self.comm.close()
+            self.comm = None
 
-    def wait_for_response(self):
+    def add_handshake(self, message):
+        '''
+        Send a message now and again after every reconnect
+
+        Returns: the response dictionary
+        '''
+        if message not in self.handshake:
+            self.handshake.append(message)
+        return self.request(message)
+
+    def set_encoding(self, encoding):
+        '''
+        Ask the server to switch this connection to a new encoding.
+
+        Returns: the encoding now in use
+        '''
+        with self.lock:
+            self.requested_encoding = encoding
+            self._negotiate(encoding)
+        return self.encoding
+
+    def _negotiate(self, encoding):
+        resp = self._exchange({'function':'set_encoding',
+                               'kwargs':{'encoding':encoding}})
+        if 'error' in resp:
+            print('Server refused {} encoding, using {}: {}'.format(
+                    encoding, self.encoding, resp['error']))
+        else:
+            self.encoding = resp['resp']
+
+    def _send(self, message):
+        if self.encoding == 'binary':
+            self.comm.sendall(protocol.encode_request(message))
+        else:
+            self.comm.sendall(bytes(json.dumps(message), 'utf-8'))
+
+    def _read(self, block=False):
         while True:
             try:
-                data = self.comm.recv(1025)
-                resp = json.loads(data)
-                if 'error' in resp:
-                    raise Exception(resp['error'])
-                return resp['resp']
+                if self.encoding == 'binary':
+                    frame = protocol.recv_frame(self.comm)
+                    if frame is None:
+                        raise ConnectionError('Server closed the connection')
+                    return protocol.decode_response(*frame)
+                ## large responses like capture windows span several reads
+                message = protocol.recv_json(self.comm)
+                if message is None:
+                    raise ConnectionError('Server closed the connection')
+                return message[0]
             except socket.timeout:
-                #print('still waiting')
-                continue
+                if not block:
+                    raise
+
+    def _exchange(self, message, block=False):
+        self._send(message)
+        return self._read(block)
+
+    def request(self, message, block=False, idempotent=True):
+        '''
+        Send a message and read its response.
+
+        Args:
+            block -- keep waiting past the timeout for the response
+            idempotent -- if false, the message is not sent again when
+                the connection drops after it was sent
+
+        Returns: the response dictionary, or None if it timed out
+        '''
+        with self.lock:
+            while True:
+                sent = False
+                try:
+                    if self.comm is None:
+                        self.connect()
+                    self._send(message)
+                    sent = True
+                    return self._read(block)
+                except socket.timeout:
+                    ## a late response would be read as the answer to the
+                    ## next request, so start over on a fresh connection
+                    self.reconnect()
+                    return None
+                except OSError as err:
+                    print('Lost connection to {}:{} ({}), reconnecting'.format(
+                            self.ip_address, self.port, err))
+                    self.reconnect()
+                    if sent and not idempotent:
+                        raise ConnectionError('Connection dropped after sending'
+                                              ' {}, not resending'.format(message))
+
+    def read_response(self):
+        '''
+        Block until the next response arrives
+
+        Returns: the response dictionary
+        '''
+        with self.lock:
+            return self._read(block=True)
+
+
+class XY_Stage(object):
+    def __init__(self, ip_address, port, timeout=10, encoding='json',
+                 status_channels=1, stage=None, motion_model=False,
+                 position_tolerance=0.05, max_age=5, **reconnect):
+        '''
+        Client for the XY server. Commands go over one command channel and
+        the status queries are spread over the status channels so they never
+        block behind a move or a wait.
+
+        Args:
+            stage -- id of the stage to control on a server hosting several.
+                None uses the server's default XY stage. Messages naming a
+                stage are sent as JSON frames under the binary encoding.
+            encoding -- 'json' or 'binary'. If the server refuses the
+                binary encoding the connection stays on JSON.
+            status_channels -- number of status connections to keep open
+            motion_model -- answer position and moving from a local model
+                of the moves sent by this client (see motion_model), only
+                asking the server when the estimate may be off by more
+                than position_tolerance (cm) or is older than max_age (s)
+            reconnect -- backoff, max_backoff and retries for each Channel
+        '''
+        self.ip_address = ip_address
+        self.port = port
+        self.stage = stage
+
+        self.command = Channel(ip_address, port, timeout, encoding, **reconnect)
+        self.status = [Channel(ip_address, port, timeout, encoding, **reconnect)
+                            for i in range(status_channels)]
+        self._status_cycle = itertools.cycle(self.status)
+
+        self.model = MotionModel() if motion_model else None
+        self.position_tolerance = position_tolerance
+        self.max_age = max_age
+
+    @property
+    def channels(self):
+        return [self.command] + self.status
+
+    @property
+    def comm(self):
+        return self.command.comm
+
+    @property
+    def encoding(self):
+        return self.command.encoding
+
+    def set_encoding(self, encoding):
+        '''
+        Returns: the encoding now in use on the command channel
+        '''
+        for channel in self.channels:
+            channel.set_encoding(encoding)
+        return self.encoding
+
+    def send(self, message, block=False):
+        name = message.get('property', message.get('function'))
+        if self.stage is not None:
+            message = dict(message, stage=self.stage)
+        if name in STATUS_COMMANDS:
+            channel = next(self._status_cycle)
+        else:
+            channel = self.command
+        trace_id = None
+        if tracing.tracer.enabled:
+            ## traced messages go as JSON frames under the binary encoding
+            trace_id = tracing.tracer.new_id()
+            message = dict(message, trace=trace_id)
+        with tracing.span('rpc:{}'.format(name), trace_id=trace_id, flow='s',
+                          encoding=channel.encoding):
+            resp = channel.request(message, block=block,
+                                   idempotent=name in IDEMPOTENT_COMMANDS)
+        if resp is None:
+            return None
+        if 'error' in resp:
+            raise Exception(resp['error'])
+        return resp['resp']
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+    def wait_for_response(self):
+        resp = self.command.read_response()
+        if 'error' in resp:
+            raise Exception(resp['error'])
+        return resp['resp']
 
     def build_text(self, func, prop=False, kwargs={}):
         if prop:
@@ -50,7 +342,18 @@ class XY_Stage(object):
         return resp
 
     def init_stages(self):
-        self.build_text('init', kwargs={})
+        '''
+        Initializes the stages on the server. Replayed whenever a channel
+        reconnects in case the server was restarted.
+        '''
+        for channel in self.channels:
+            resp = channel.add_handshake({'function':'init', 'kwargs':{}})
+            if resp is None:
+                raise TimeoutError('Timed out initializing the stages on '
+                                   '{}:{}'.format(channel.ip_address, channel.port))
+            if 'error' in resp:
+                raise Exception(resp['error'])
+        return resp['resp']
 
     @property
     def limits(self):
@@ -58,57 +361,295 @@ class XY_Stage(object):
 
     @property
     def position(self):
-        return self.build_text( 'get_position', prop=False)
-    
+        if self.model is None:
+            return self.build_text( 'get_position', prop=False)
+        estimate = self._estimate()
+        if estimate is None or max(estimate[1].values()) > self.position_tolerance:
+            estimate = self.sync_model()
+        return tuple(estimate[0].values())
+
     @position.setter
     def position(self, value):
         if len(value) != 2:
             raise ValueError("Must supply position for x and y")
-        return self.build_text( 'set_position', 
+        self._forget_motion()
+        return self.build_text( 'set_position',
                                 kwargs={'value': value})
-    
+
     def wait(self):
-        resp = self.build_text( 'wait', kwargs={})    
-        if resp is None:
-            resp = self.wait_for_response()
+        resp = self.send({'function':'wait', 'kwargs':{}}, block=True)
+        if self.model is not None:
+            ## re-anchor on where the moves really ended
+            start = time.monotonic()
+            try:
+                state = self.snapshot()
+            except Exception:
+                self._forget_motion()
+                return resp
+            if state.moving:
+                ## moves from another client, the next read asks the server
+                self._forget_motion()
+            else:
+                self.model.finish({name: axis.position
+                                        for name, axis in state.axes.items()},
+                                  (start + time.monotonic())/2)
         return resp
-    
+
     @property
     def moving(self):
-        return self.build_text('moving', prop=True)
-   
-    def is_enabled(self):    
+        if self.model is None:
+            return self.build_text('moving', prop=True)
+        estimate = self._estimate()
+        if estimate is None or estimate[2] is None:
+            estimate = self.sync_model()
+        return estimate[2]
+
+    def _estimate(self):
+        age = self.model.age()
+        if age is None or age > self.max_age:
+            return None
+        return self.model.estimate()
+
+    def snapshot(self):
+        '''
+        Everything about the stage in one request: position, step
+        positions, limits, moving, velocities of the moves in progress,
+        the move queue, homed and enabled
+
+        Returns: a Snapshot
+        '''
+        return Snapshot.from_dict(self.build_text('snapshot', kwargs={}))
+
+    def sync_model(self):
+        '''
+        Update the motion model from the server
+
+        Returns: (positions, bounds, moving) like MotionModel.estimate
+        '''
+        start = time.monotonic()
+        state = self.snapshot()
+        positions = {name: axis.position for name, axis in state.axes.items()}
+        self.model.sync(positions, state.moving, (start + time.monotonic())/2)
+        return positions, {axis: 0.0 for axis in positions}, state.moving
+
+    def _forget_motion(self):
+        if self.model is not None:
+            self.model.invalidate()
+
+    def position_estimate(self):
+        '''
+        Returns: the position extrapolated by the motion model and its
+            error bound (cm), without asking the server. None if the model
+            has nothing to go on
+        '''
+        if self.model is None:
+            raise ValueError("Client was created without motion_model")
+        estimate = self.model.estimate()
+        if estimate is None:
+            return None
+        positions, bounds, moving = estimate
+        return tuple(positions.values()), tuple(bounds.values())
+
+    def is_enabled(self):
         return self.build_text('is_enabled', kwargs={})
-    
+
     def enable(self):
         self.build_text('enable', kwargs={})
- 
+
     def disable(self):
         self.build_text('disable', kwargs={})
-    
+
     def stop(self):
-        self.build_text('stop', kwargs={})
+        '''
+        Flush the queue and ramp the running move down. Goes out on a
+        status channel so it never waits behind a command
+
+        Returns: stop latency, time to standstill and the final position
+        '''
+        resp = self.build_text('stop', kwargs={})
+        self._forget_motion()
+        return resp
 
     def move_x_cm( self, distance, velocity=None):
-        self.build_text('move_x_cm', kwargs={'distance':distance, 
+        self.build_text('move_x_cm', kwargs={'distance':distance,
                                              'velocity':velocity})
+        if self.model is not None:
+            self.model.add_move('X', distance, velocity)
 
     def move_y_cm( self, distance, velocity=None):
-        self.build_text('move_y_cm', kwargs={'distance':distance, 
+        self.build_text('move_y_cm', kwargs={'distance':distance,
                                              'velocity':velocity})
-    @classmethod
-    def latrt_xy_stage(cls):
-        HOST = '192.168.10.15'
-        PORT = 3010
+        if self.model is not None:
+            self.model.add_move('Y', distance, velocity)
+
+    def move_cm(self, axis, distance, velocity=None):
+        self.build_text('move_cm', kwargs={'axis':axis, 'distance':distance,
+                                           'velocity':velocity})
+        if self.model is not None:
+            self.model.add_move(axis, distance, velocity)
+
+    def get_positions(self):
+        '''
+        Returns: dictionary of axis name -> position in cm
+        '''
+        return self.build_text('get_positions', kwargs={})
+
+    @property
+    def calibration(self):
+        '''
+        Returns: dictionary of axis name -> steps per cm
+        '''
+        return self.build_text('calibration', prop=True)
+
+    @property
+    def queue(self):
+        '''
+        Returns: the running move and the moves queued behind it
+        '''
+        return self.build_text('queue', prop=True)
+
+    def clear_queue(self):
+        '''
+        Returns: number of queued moves dropped
+        '''
+        resp = self.build_text('clear_queue', kwargs={})
+        self._forget_motion()
+        return resp
+
+    def enable_capture(self, size=100000, decimation=1, axes=None):
+        '''
+        Start recording timestamped step positions on the server
+        '''
+        self.build_text('enable_capture', kwargs={'size':size,
+                                                  'decimation':decimation,
+                                                  'axes':axes})
+
+    def disable_capture(self, axes=None):
+        self.build_text('disable_capture', kwargs={'axes':axes})
+
+    def capture_window(self, axis, start=None, end=None):
+        '''
+        Args:
+            axis -- axis name
+            start, end -- time.time() timestamps bounding the window
+
+        Returns: dictionary with the sample times, step positions and
+            steps_per_cm of the axis
+        '''
+        return self.build_text('capture_window', kwargs={'axis':axis,
+                                                         'start':start,
+                                                         'end':end})
+
+    def drift_report(self):
+        '''
+        Returns: per axis limit switch references, the last measured drift
+            and whether the axis needs to be homed again
+        '''
+        return self.build_text('drift_report', kwargs={})
 
-        xy_stage = cls(HOST, PORT)
+    def set_auto_correct(self, enabled=True, tolerance=None):
+        self.build_text('set_auto_correct', kwargs={'enabled':enabled,
+                                                    'tolerance':tolerance})
+
+    def home(self, **kwargs):
+        '''
+        Home every axis. Blocks until homing is done
+
+        Returns: homing time and per axis stats
+        '''
+        self._forget_motion()
+        return self.send({'function':'home', 'kwargs':kwargs}, block=True)
+
+    def home_if_needed(self, **kwargs):
+        '''
+        Home only the axes whose position can't be trusted anymore
+        '''
+        self._forget_motion()
+        return self.send({'function':'home_if_needed', 'kwargs':kwargs},
+                         block=True)
+
+    def settle_stats(self):
+        '''
+        Returns: per axis count of moves, seconds spent waiting for the
+            drivers to settle and seconds saved by skipping needless waits
+        '''
+        return self.build_text('settle_stats', kwargs={})
+
+    def reset_settle_stats(self):
+        self.build_text('reset_settle_stats', kwargs={})
+
+    def set_trigger(self, pin, width=1e-5, active_high=True, on_move_end=True):
+        '''
+        Pulse a GPIO output from the server's motion thread when the stage
+        stops, so detectors don't wait for a network round trip. None
+        removes the trigger
+        '''
+        self.build_text('set_trigger', kwargs={'pin':pin, 'width':width,
+                                               'active_high':active_high,
+                                               'on_move_end':on_move_end})
+
+    def set_trigger_positions(self, axis, positions):
+        '''
+        Also pulse the trigger as the axis passes each position (cm)
+        '''
+        self.build_text('set_trigger_positions', kwargs={'axis':axis,
+                                                         'positions':list(positions)})
+
+    def trigger_log(self, since=0):
+        '''
+        Returns: the trigger pulses after index since, with their times
+        '''
+        return self.build_text('trigger_log', kwargs={'since':since})
+
+    def metrics(self):
+        '''
+        Returns: the server metrics in the Prometheus text format
+        '''
+        return self.build_text('metrics', kwargs={})
+
+    def ping(self):
+        '''
+        Returns: whether the stages are initialized, the server uptime and
+            how long the server took to start
+        '''
+        return self.build_text('ping', kwargs={})
+
+    def trace_start(self, server=True):
+        '''
+        Start recording spans here and, if server is true, on the server
+        '''
+        tracing.tracer.start('xy_client')
+        if server:
+            self.build_text('trace_start', kwargs={})
+
+    def export_trace(self, path, server=True):
+        '''
+        Stop tracing and write the client spans, plus the server's if server
+        is true, to one Chrome trace-event JSON file
+        '''
+        events = list(tracing.tracer.events)
+        tracing.tracer.stop()
+        if server:
+            self.build_text('trace_stop', kwargs={})
+            events += self.build_text('trace_events', kwargs={})
+        tracing.export(path, events)
+        return len(events)
+
+    def list_stages(self):
+        '''
+        Returns: dictionary of stage id -> axis names on the server
+        '''
+        return self.build_text('list_stages', kwargs={})
+    @classmethod
+    def latrt_xy_stage(cls, host=LATRT_HOST, port=LATRT_PORT, **kwargs):
+        xy_stage = cls(host, port, **kwargs)
         xy_stage.init_stages()
-        return xy_stage        
+        return xy_stage
 
 
 #class XY_Agent:
 #    def __init__(self):
-#        pass    
+#        pass
 '''
 if __name__ == '__main__':
     #xy_stage.send('Hello')
@@ -1,26 +1,15 @@
-import numpy as np
 import time
-import datetime as dt
-import scipy.interpolate as spint
-import argparse
-
-try:
-    import ocs
-    from ocs import matched_client
-    from ocs.ocs_widgets import TaskWidget, ProcessWidget
-    from twisted.python import log
-    from twisted.logger import formatEvent, FileLogObserver
-except ImportError:
-    import xy_agent.xy_connect as connect
-    WITH_OCS = False
-else:
-    WITH_OCS = True
-
-if WITH_OCS:
-    try:
-        import xy_agent.xy_connect as connect
-    except ImportError:
-        pass
+import numbers
+import importlib.util
+
+import xy_agent.xy_connect as connect
+from xy_agent import scan_plan
+from xy_agent import tracing
+from xy_agent import dwell
+
+## only check that ocs is installed, importing it (and twisted) is slow so
+## that waits until a scan actually uses it
+WITH_OCS = importlib.util.find_spec('ocs') is not None
 
 class XY_Scan:
     """Class for defining scan patterns with the XY Stages. There are several
@@ -36,14 +25,18 @@ class XY_Scan:
         continuously scans in the x direction.
         
       """
-    def __init__(self, with_ocs=WITH_OCS ):
+    def __init__(self, with_ocs=WITH_OCS, **connect_kwargs):
         """Connects to the Agent
+
+        connect_kwargs are passed to XY_Stage.latrt_xy_stage when not
+        using ocs (host, port, encoding, ...)
         """
         self.ocs = with_ocs
         if self.ocs:
+            from ocs import matched_client
             self.xy_stage = matched_client.MatchedClient('XYWing', args=[])
         else:
-            self.xy_stage = connect.XY_Stage.latrt_xy_stage()
+            self.xy_stage = connect.XY_Stage.latrt_xy_stage(**connect_kwargs)
 
         self.before_function = None
         self.during_function = None
@@ -51,6 +44,14 @@ class XY_Scan:
         self.is_setup = False
         self.step_raster = False
         self.is_raster_setup = False
+        self.plan = None
+        self.dwell = 0
+        self.live_map = None
+        self.results = []
+        ## settings of the adaptive dwell, None for a fixed dwell
+        self.adaptive = None
+        ## commanded position relative to where the scan started
+        self.offset = [0.0, 0.0]
 
     def setup_scan(self, total_distance_x, total_distance_y,
                     N_pts_x, N_pts_y, x_vel=0.5, y_vel=0.5, 
@@ -110,25 +111,185 @@ class XY_Scan:
         if self.step_raster:
             print('I plan to raster the scan')
 
-        if np.mod(self.N_pts_x, 2) == 0 or np.mod(self.N_pts_y, 2)== 0:
+        if self.N_pts_x % 2 == 0 or self.N_pts_y % 2 == 0:
             raise ValueError("I only know how to deal with an odd number of data point")
         self.is_setup = True
 
-    def move_x(self, dist, vel):
-        if self.ocs:
-            self.xy_stage.move_x_cm.start(distance=dist, velocity=vel)
-            self.xy_stage.move_x_cm.wait()
+    def load_definition(self, definition, cache_dir=scan_plan.DEFAULT_CACHE_DIR):
+        """ Set up the scan from a declarative definition (see scan_plan)
+
+        Arguments
+        -----------
+        definition : str or dict
+            path to a .json/.toml definition file, or the definition itself
+        cache_dir : str
+            where compiled plans are cached, None to always recompile
+        """
+        if isinstance(definition, str):
+            definition = scan_plan.load_definition(definition)
         else:
-            self.xy_stage.move_x_cm(dist, vel)
-            self.xy_stage.wait()
+            definition = scan_plan.validate(definition)
+
+        calibration = None
+        if not self.ocs:
+            calibration = self.xy_stage.calibration
+        self.plan = scan_plan.get_plan(definition, calibration, cache_dir)
+        self.dwell = definition['dwell']
+
+        hooks = definition['hooks']
+        for name in scan_plan.HOOKS:
+            if name in hooks:
+                function = scan_plan.resolve_hook(hooks[name])
+            else:
+                function = lambda: None
+            setattr(self, name + '_function', function)
+        if definition['target_snr'] is not None:
+            self.set_adaptive_dwell(self.acquire_function,
+                                    definition['target_snr'],
+                                    definition['max_dwell'],
+                                    definition['min_samples'])
+        else:
+            self.adaptive = None
 
-    def move_y(self, dist, vel):
-        if self.ocs:
-            self.xy_stage.move_y_cm.start(distance=dist, velocity=vel)
-            self.xy_stage.move_y_cm.wait()
+        n_moves = sum(entry['type'] == 'move' for entry in self.plan['entries'])
+        n_points = len(self.plan['entries']) - n_moves
+        print('Plan {}: {} moves, {} points'.format(self.plan['key'][:12],
+                                                    n_moves, n_points))
+        return self.plan
+
+    def execute_plan(self, test_scan=False, lead_in=True, lead_out=True):
+        """Execute a plan loaded with load_definition
+
+        Arguments
+        ----------
+        test_scan : bool
+            If true, does not call functions and instead just sleeps for a
+            second at each point.
+        lead_in : bool
+            If false, the stage is already at the plan's first point and
+            the moves from the center are skipped. The caller then sets
+            offset to that point
+        lead_out : bool
+            If false, the stage stays at the last point instead of
+            returning to the center
+
+        Returns the points with the values the during function returned
+        """
+        if self.plan is None:
+            raise ValueError("Scan needs to be setup with load_definition")
+
+        if not test_scan:
+            self.before_function()
         else:
-            self.xy_stage.move_y_cm(dist, vel)
-            self.xy_stage.wait()
+            time.sleep(1)
+
+        if lead_in:
+            self.offset = [0.0, 0.0]
+        entries = self.plan['entries']
+        first = 0 if lead_in else self.plan['lead_in']
+        last = len(entries) if lead_out else self.plan['lead_out']
+        self.results = []
+        for entry in entries[first:last]:
+            if entry['type'] == 'move':
+                self.run_move(entry)
+            elif not test_scan:
+                self.at_point(index=entry['index'])
+                if self.adaptive is None:
+                    time.sleep(self.dwell)
+            else:
+                time.sleep(1)
+
+        if not test_scan:
+            self.after_function()
+        else:
+            time.sleep(1)
+        return self.results
+
+    def run_move(self, entry):
+        """Run a move entry of a plan"""
+        if entry['axis'] == 'x':
+            self.move_x(entry['distance'], entry['velocity'])
+        else:
+            self.move_y(entry['distance'], entry['velocity'])
+
+    def move_x(self, dist, vel):
+        self.offset[0] += dist
+        with tracing.span('scan_move', axis='x', distance=dist):
+            if self.ocs:
+                self.xy_stage.move_x_cm.start(distance=dist, velocity=vel)
+                self.xy_stage.move_x_cm.wait()
+            else:
+                self.xy_stage.move_x_cm(dist, vel)
+                self.xy_stage.wait()
+
+    def move_y(self, dist, vel):
+        self.offset[1] += dist
+        with tracing.span('scan_move', axis='y', distance=dist):
+            if self.ocs:
+                self.xy_stage.move_y_cm.start(distance=dist, velocity=vel)
+                self.xy_stage.move_y_cm.wait()
+            else:
+                self.xy_stage.move_y_cm(dist, vel)
+                self.xy_stage.wait()
+
+    def at_point(self, **info):
+        """Measure at the current position and add the point to results.
+        With an adaptive dwell (set_adaptive_dwell) the acquire function is
+        called until the point is good enough, and the dwell used is
+        recorded. Otherwise the during function runs once.
+
+        If a live map is attached and the value is a number, it is added to
+        the map at the commanded position
+        """
+        point = dict(info, position=list(self.offset))
+        with tracing.span('scan_point'):
+            if self.adaptive is not None:
+                stats = dwell.adaptive_dwell(**self.adaptive)
+                point.update(stats)
+                value = stats['value']
+            else:
+                value = self.during_function()
+                point['value'] = value
+        self.results.append(point)
+        if self.live_map is not None and isinstance(value, numbers.Real):
+            self.live_map.add(self.offset[0], self.offset[1], value)
+        return value
+
+    def set_adaptive_dwell(self, acquire, target_snr, max_dwell, min_samples=3):
+        """Measure each point with repeated short acquisitions instead of
+        the during function (see dwell.adaptive_dwell). Set acquire to None
+        to go back to the during function.
+
+        Arguments
+        -----------
+        acquire : function taking one short acquisition, returns a number
+        target_snr : float, move on once the mean over its standard error
+            reaches this
+        max_dwell : float, most seconds spent at a point
+        min_samples : int, acquisitions taken before the SNR is trusted
+        """
+        if acquire is None:
+            self.adaptive = None
+            return
+        self.adaptive = {'acquire': acquire, 'target_snr': target_snr,
+                         'max_dwell': max_dwell, 'min_samples': min_samples}
+
+    def dwell_report(self):
+        """Summary of the dwell used at the points of the last scan"""
+        dwells = [point['dwell'] for point in self.results if 'dwell' in point]
+        if not dwells:
+            return None
+        return {'points': len(dwells), 'total': sum(dwells),
+                'mean': sum(dwells)/len(dwells), 'max': max(dwells),
+                'reached': sum(point['reached'] for point in self.results
+                                    if 'dwell' in point)}
+
+    def attach_map(self, live_map):
+        """Add the value returned by the during function at every point
+        to a live_map.LiveMap. Positions are relative to the start of the
+        scan, the center of the scanned area.
+        """
+        self.live_map = live_map
 
     def set_before_scan_function(self, function):
         """Function will run once at the begining of the scan
@@ -145,12 +306,27 @@ class XY_Scan:
         self.after_function = function
 
     def execute(self, test_scan = False):
+        self.results = []
+        if not self.ocs:
+            self.xy_stage.reset_settle_stats()
         if self.scan_dir == 'x':
             self.execute_xscan(test_scan)
         elif self.scan_dir == 'y':
             self.execute_yscan(test_scan)
         else:
             raise ValueError("How did scan_dir get set incorrectly?")
+        if not self.ocs:
+            self.report_settle_stats()
+
+    def report_settle_stats(self):
+        """Print how long the drivers spent settling during the scan and
+        how much time was saved by only settling after a state change
+        """
+        stats = self.xy_stage.settle_stats()
+        for name, axis in stats.items():
+            print('{}: {} moves, {:.2f} s settling, {:.2f} s saved'.format(
+                    name, axis['moves'], axis['spent'], axis['saved']))
+        return stats
     
     def execute_xscan(self, test_scan = False):
         """Execute Planned Scan
@@ -166,13 +342,14 @@ class XY_Scan:
         if self.before_function is None:
             raise ValueError("Need a defined before function, use \
                             set_before_scan_function")        
-        if self.during_function is None:
+        if self.during_function is None and self.adaptive is None:
             raise ValueError("Need a defined during function, use \
                             set_during_scan_function")        
         if self.after_function is None:
             raise ValueError("Need a defined before function, use \
                             set_after_scan_function")        
 
+        self.offset = [0.0, 0.0]
         print('Moving to start position')
         if self.total_x_move > 0:
             self.move_x( -(self.N_pts_x-1)*self.x_step/2, self.x_vel_reset )
@@ -195,7 +372,7 @@ class XY_Scan:
 
                 ## call function as each position
                 if not test_scan:
-                    self.during_function()
+                    self.at_point()
                 else:
                     time.sleep(1)
 
@@ -230,13 +407,14 @@ class XY_Scan:
         if self.before_function is None:
             raise ValueError("Need a defined before function, use \
                             set_before_scan_function")        
-        if self.during_function is None:
+        if self.during_function is None and self.adaptive is None:
             raise ValueError("Need a defined during function, use \
                             set_during_scan_function")        
         if self.after_function is None:
             raise ValueError("Need a defined before function, use \
                             set_after_scan_function")        
 
+        self.offset = [0.0, 0.0]
         print('Moving to start position')
         if self.total_x_move > 0:
             self.move_x( -(self.N_pts_x-1)*self.x_step/2, self.x_vel_reset )
@@ -259,7 +437,7 @@ class XY_Scan:
 
                 ## call function as each position
                 if not test_scan:
-                    self.during_function()
+                    self.at_point()
                 else:
                     time.sleep(1)
 
@@ -334,6 +512,7 @@ class XY_Scan:
             raise ValueError("Need a defined before function, use \
                             set_after_scan_function")   
         
+        self.offset = [0.0, 0.0]
         if self.total_x_move > 0:
             self.move_x( -(self.N_pts_x-1)*self.x_step/2, self.x_vel_reset )
         if self.total_y_move > 0:
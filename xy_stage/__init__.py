@@ -1,3 +1,5 @@
 from . import axis
+from . import scheduler
+from . import stage
 from . import xy_stage
 from . import server
@@ -1,6 +1,16 @@
-import RPi.GPIO as GPIO
+from .gpio import GPIO
 import time
 import os
+import math
+from collections import deque
+from threading import Event
+
+from .capture import CaptureBuffer
+from . import metrics
+from xy_agent import tracing
+
+## settle time every move used to sleep for, used to report savings
+FIXED_SETTLE = 0.25
 
 class Axis:
     """
@@ -10,8 +20,31 @@ class Axis:
     
     self.position and/or self.step position can safely be queried
         while the axis is moving. 
+
+    The axis keeps track of the driver's enable and direction outputs and
+    only waits for the driver to settle after one of them actually changed.
+
+    Every time a move runs into a limit switch the step position is
+    compared to where that switch was after homing. The difference is the
+    drift of the dead reckoned position, which can optionally be corrected
+    on the spot.
     """
-    def __init__(self, name, pin_list, steps_per_cm, logfile=None):
+    def __init__(self, name, pin_list, steps_per_cm, logfile=None,
+                 enable_settle=FIXED_SETTLE, dir_settle=FIXED_SETTLE,
+                 drift_tolerance=0.05, auto_correct=False, decel=5.0,
+                 stop_velocity=0.25):
+        '''
+        Args:
+            enable_settle -- seconds the driver needs after being enabled
+            dir_settle -- seconds the driver needs after a direction change
+            drift_tolerance -- cm of limit switch drift that can be
+                corrected without homing again
+            auto_correct -- reset the position when a limit switch trips
+                within drift_tolerance of its reference
+            decel -- cm/s^2 used to ramp down a move that is stopped
+            stop_velocity -- cm/s the motor can stop from without losing
+                steps, moves at or below it stop at once
+        '''
         self.name = name
         self.ena = pin_list['ena']
         self.pul = pin_list['pul']
@@ -21,9 +54,18 @@ class Axis:
         self.eot_cw = pin_list['eot_cw']
 
         self.setup_pins()
+        ## setup_pins leaves every output high, so the driver is disabled
+        self.driver_enabled = False
+        self.driver_dir = True
+        self.enable_changed = 0
+        self.dir_changed = 0
+        self.enable_settle = enable_settle
+        self.dir_settle = dir_settle
+        self.reset_settle_stats()
         
         self.hold_enable = False
         self.keep_moving = False
+        self.set_limits()
         self.step_position = 0
         self.logfile = logfile
         if self.logfile is not None and os.path.exists(self.logfile):
@@ -33,6 +75,34 @@ class Axis:
         self.steps_per_cm = steps_per_cm
         self.max_vel = 1.27 ## cm / s
         self.homed = False
+        self.home_stats = None
+        self.capture = None
+
+        self.drift_tolerance = drift_tolerance
+        self.auto_correct = auto_correct
+        self.homing = False
+        ## step positions of the switches after homing. The far switch is
+        ## learned the first time a move reaches it
+        self.limit_refs = {'cw': None, 'ccw': None}
+        self.limit_trips = deque(maxlen=100)
+        self.drift = None
+
+        ## pulsed when the step loop reaches one of trigger_steps
+        self.trigger = None
+        self.trigger_steps = frozenset()
+
+        ## set by stop, wakes a settle and ramps the step loop down
+        self.stop_event = Event()
+        self.stop_requested = None
+        self.last_stop = None
+        self.decel = decel
+        self.stop_velocity = stop_velocity
+        self._ramps = {}
+
+        ## the move in progress, for snapshot
+        self.velocity = 0.0
+        self.target_step = None
+        self.move_started = None
 
     @property
     def position(self):
@@ -42,7 +112,13 @@ class Axis:
     def position(self, value):
         if self.keep_moving:
             raise ValueError("Cannot update position while moving")
-        self.step_position = value*self.steps_per_cm
+        ## whole steps, the step loop and the trigger positions count in them
+        step_position = int(round(value*self.steps_per_cm))
+        shift = step_position - self.step_position
+        for switch, ref in self.limit_refs.items():
+            if ref is not None:
+                self.limit_refs[switch] = ref + shift
+        self.step_position = step_position
 
     @property
     def limits(self):
@@ -67,8 +143,10 @@ class Axis:
         self.lim_cw =  GPIO.input(self.eot_cw) == GPIO.LOW 
         return self.lim_ccw or self.lim_cw
 
-    def home(self, max_dist=150, reset_pos=True):
-        """Move axis at 1 cm/s toward the home limit.
+    def home(self, max_dist=150, reset_pos=True, fast_vel=None, slow_vel=0.1,
+             backoff=0.5, checks=1):
+        """Find the home limit in two phases. Approach it quickly, back off,
+        then re-approach slowly so the final trip point is repeatable.
         
         Arguments
         ----------
@@ -76,14 +154,81 @@ class Axis:
             the maximum number of cm to move for homing
         reset_pos : bool
             if true, axis position is reset to zero
-        """    
-        while not self.lim_cw:
-            self.move_cm(True, max_dist, velocity=1)
+        fast_vel : float
+            speed of the first approach in cm/s. Defaults to max_vel
+        slow_vel : float
+            speed of the final approach in cm/s
+        backoff : float
+            cm to back away from the switch before the slow approach
+        checks : int
+            number of slow approaches. The spread of the trip points
+            measures how repeatable the switch is
+
+        Returns
+        -------
+        dictionary with the homing time in s, the step positions where the
+        switch tripped and their spread in steps
+        """
+        if checks < 1:
+            raise ValueError("checks must be at least 1")
+        start = time.time()
+        if fast_vel is None:
+            fast_vel = self.max_vel
+
+        ## keep the driver enabled between the homing moves so they only
+        ## settle after the direction changes
+        held = self.hold_enable
+        self.hold_enable = True
+        self.homing = True
+        try:
+            stats = self._home(max_dist, fast_vel, slow_vel, backoff, checks)
+        finally:
+            self.homing = False
+            self.hold_enable = held
+            if not held:
+                self.set_driver(False)
+        stats['time'] = time.time() - start
+
+        ## how far the dead reckoned position was off from the last homing
+        if self.homed and self.limit_refs['cw'] is not None:
+            stats['error'] = stats['slow_trips'][-1] - self.limit_refs['cw']
         if reset_pos:
             self.step_position = 0
+        self.limit_refs = {'cw': self.step_position, 'ccw': None}
+        self.drift = 0
         self.homed = True
+        self.home_stats = stats
+        return stats
+
+    def _home(self, max_dist, fast_vel, slow_vel, backoff, checks):
+        self.set_limits()
+        if not self.lim_cw:
+            self.move_cm(True, max_dist, velocity=fast_vel)
+        self.check_stopped()
+        if not self.lim_cw:
+            raise ValueError("{} did not reach the home limit within {} cm".format(
+                                self.name, max_dist))
+        fast_trip = self.step_position
 
-    def move_cm(self, dir, distance, velocity=None):
+        slow_trips = []
+        for i in range(checks):
+            self.move_cm(False, backoff, velocity=fast_vel)
+            self.check_stopped()
+            self.move_cm(True, 2*backoff, velocity=slow_vel)
+            self.check_stopped()
+            if not self.lim_cw:
+                raise ValueError("{} lost the home limit after backing off".format(
+                                    self.name))
+            slow_trips.append(self.step_position)
+
+        return {
+            'fast_trip': fast_trip,
+            'slow_trips': slow_trips,
+            'spread': max(slow_trips) - min(slow_trips),
+            'overshoot': slow_trips[-1] - fast_trip,
+        }
+
+    def move_cm(self, dir, distance, velocity=None, release=True):
         '''
         Axis Moves the commanded number of cm. Converts to steps 
             and calls the move_step function
@@ -92,6 +237,8 @@ class Axis:
             dir -- True goes toward home (the motors)
             distance -- number of cm to move
             velocity -- how quickly to move
+            release -- disable the driver after the move unless it is held
+                enabled. False leaves that to the caller
         '''
         steps = distance*self.steps_per_cm
         if velocity is None:
@@ -102,7 +249,7 @@ class Axis:
             velocity = self.max_vel
 
         wait = 1.0/(2*velocity*self.steps_per_cm)
-        success, steps = self.move_step(dir, steps, wait)
+        success, steps = self.move_step(dir, steps, wait, release)
         return success, steps/self.steps_per_cm
 
     def move_to_cm(self, new_position, velocity=None, require_home=True):
@@ -120,21 +267,82 @@ class Axis:
                 print('ERROR -- Axis Position Not Calibrated')
                 return False
             print('WARNING -- Axis Position Not calibrated')
+        if self.stop_event.is_set():
+            ## stopped before this axis' turn came up
+            return False, 0.0
         distance = new_position - self.position         
         if distance < 0:
             return self.move_cm( True, abs(distance), velocity)
         
         return self.move_cm(False, abs(distance), velocity)
 
+    def enable_capture(self, size=100000, decimation=1):
+        '''
+        Start recording (time, step position) samples while moving
+
+        Args:
+            size -- number of samples kept in the ring buffer
+            decimation -- record every Nth step
+        '''
+        self.capture = CaptureBuffer(size, decimation)
+        return self.capture
+
+    def disable_capture(self):
+        self.capture = None
+
     def enable(self):
         self.hold_enable = True
-        GPIO.output(self.ena, GPIO.LOW)
+        self.set_driver(True)
 
     def disable(self):
         self.hold_enable = False
-        GPIO.output(self.ena, GPIO.HIGH)
+        self.set_driver(False)
+
+    def set_driver(self, enabled):
+        """Write the enable pin if the driver isn't already in that state"""
+        if enabled == self.driver_enabled:
+            return
+        ## enable pin is active low
+        GPIO.output(self.ena, GPIO.LOW if enabled else GPIO.HIGH)
+        self.driver_enabled = enabled
+        self.enable_changed = time.monotonic()
 
-    def move_step(self, dir, steps=100, wait=0.005):
+    def set_direction(self, dir):
+        """Write the direction pin if it changed"""
+        if dir == self.driver_dir:
+            return
+        GPIO.output(self.dir, dir)
+        self.driver_dir = dir
+        self.dir_changed = time.monotonic()
+
+    def settle(self):
+        """Sleep for whatever is left of the settle time after the last
+        enable or direction change"""
+        ready = max(self.enable_changed + self.enable_settle,
+                    self.dir_changed + self.dir_settle)
+        wait = max(ready - time.monotonic(), 0)
+        if wait > 0:
+            ## returns early if the move is stopped
+            self.stop_event.wait(wait)
+            metrics.SETTLE.inc(wait, self.name)
+        self.settle_moves += 1
+        self.settle_spent += wait
+        self.settle_saved += max(FIXED_SETTLE - wait, 0)
+
+    def reset_settle_stats(self):
+        self.settle_moves = 0
+        self.settle_spent = 0.0
+        self.settle_saved = 0.0
+
+    def settle_stats(self):
+        """
+        Returns: number of moves, seconds spent settling and seconds saved
+            compared to a fixed settle on every move
+        """
+        return {'moves': self.settle_moves, 'spent': self.settle_spent,
+                'saved': self.settle_saved}
+
+    def move_step(self, dir, steps=100, wait=0.005, release=True):
         ## direction = False is toward the CCW limit
         ## direction = True is toward the CW limit
         steps = int(round(steps))
@@ -144,38 +352,78 @@ class Axis:
             increment = -1
         else:
             increment = 1
-        if not self.hold_enable:
-            GPIO.output( self.ena, GPIO.LOW)
-        GPIO.output(self.dir, dir)
-        
-        time.sleep(0.25)
-
-        while steps > 0 and self.keep_moving:
+        self.set_driver(True)
+        self.set_direction(dir)
+        with tracing.span('settle', axis=self.name):
+            self.settle()
+        requested = steps
+        loop_start = time.monotonic()
+        self.velocity = 1.0/(2*wait*self.steps_per_cm)
+        self.target_step = self.step_position + increment*steps
+        self.move_started = time.time()
+        ramp = self.decel_ramp(wait)
+        stopping = None
+        ramp_steps = 0
+        with tracing.span('step_loop', axis=self.name, steps=steps):
+            while steps > 0 and self.keep_moving:
+                if self.stop_event.is_set():
+                    if stopping is None:
+                        ## ramp down from full speed, or halt if the motor
+                        ## has not started stepping yet
+                        reacted = time.monotonic()
+                        stopping = iter(ramp if requested > steps else ())
+                    wait = next(stopping, None)
+                    if wait is None:
+                        self.keep_moving = False
+                        break
+                    ramp_steps += 1
        
-            if self.set_limits():
-                if (not dir) and self.lim_ccw:
-                    #print('Hit CCW limti with {} steps left'.format(steps))
-                    self.keep_moving = False
-                    break
-                elif dir and self.lim_cw:
-                    ### true goes to home
-                    self.keep_moving = False
-                    break
-                #print('LIMIT!')
-                #print('CCW: ', self.lim_ccw, 'CW:', self.lim_cw)
+                if self.set_limits():
+                    if (not dir) and self.lim_ccw:
+                        #print('Hit CCW limti with {} steps left'.format(steps))
+                        self.keep_moving = False
+                        self.limit_tripped('ccw')
+                        break
+                    elif dir and self.lim_cw:
+                        ### true goes to home
+                        self.keep_moving = False
+                        self.limit_tripped('cw')
+                        break
+                    #print('LIMIT!')
+                    #print('CCW: ', self.lim_ccw, 'CW:', self.lim_cw)
             
-            GPIO.output(self.pul, GPIO.HIGH)
-            time.sleep(wait)
-            GPIO.output(self.pul, GPIO.LOW)
-            time.sleep(wait)
-            self.step_position += increment
-            steps -= 1
-            if self.logfile is not None:
-                with open(self.logfile, "w") as pos_file:
-                    pos_file.write(self.step_position)
-
-        if not self.hold_enable:
-            GPIO.output(self.ena, GPIO.HIGH)
+                GPIO.output(self.pul, GPIO.HIGH)
+                time.sleep(wait)
+                GPIO.output(self.pul, GPIO.LOW)
+                time.sleep(wait)
+                self.step_position += increment
+                steps -= 1
+                if self.trigger is not None and self.step_position in self.trigger_steps:
+                    self.trigger.pulse('position', self.name, self.step_position)
+                if self.capture is not None:
+                    self.capture.record(time.monotonic(), self.step_position)
+                if self.logfile is not None:
+                    with open(self.logfile, "w") as pos_file:
+                        pos_file.write(str(self.step_position))
+        metrics.STEPS.inc(requested - steps, self.name)
+        metrics.MOVING.inc(time.monotonic() - loop_start, self.name)
+        self.velocity = 0.0
+        self.target_step = None
+        if self.stop_requested is not None:
+            if stopping is None:
+                ## stopped before the step loop started
+                reacted = time.monotonic()
+            stopped = time.monotonic()
+            self.last_stop = {'requested': self.stop_requested,
+                              'latency': reacted - self.stop_requested,
+                              'stop_time': stopped - self.stop_requested,
+                              'ramp_steps': ramp_steps,
+                              'step_position': self.step_position,
+                              'position': self.position}
+            self.stop_requested = None
+
+        if release and not self.hold_enable:
+            self.set_driver(False)
         if not self.keep_moving:
             #print('I think I hit a limit with {} steps left'.format(steps))
             return False, steps
@@ -183,8 +431,131 @@ class Axis:
         self.keep_moving = False
         return True, steps
     
-    def stop(self):
-        self.keep_moving = False
+    def snapshot(self):
+        '''
+        Returns: the axis state in one dictionary. The limit switches are
+            only read if the axis is idle, while moving the step loop
+            reads them on every step.
+        '''
+        if not self.keep_moving:
+            self.set_limits()
+        return {'position': self.step_position/self.steps_per_cm,
+                'step_position': self.step_position,
+                'steps_per_cm': self.steps_per_cm,
+                'moving': self.keep_moving,
+                'velocity': self.velocity,
+                'target_step': self.target_step,
+                'move_started': self.move_started,
+                'limits': {'cw': self.lim_cw, 'ccw': self.lim_ccw},
+                'homed': self.homed,
+                'needs_home': self.needs_home,
+                'drift': self.drift,
+                'hold_enable': self.hold_enable,
+                'driver_enabled': self.driver_enabled,
+                'driver_dir': self.driver_dir}
+
+    def set_trigger_positions(self, trigger, positions):
+        '''
+        Pulse trigger whenever a move steps onto one of the positions (cm)
+        '''
+        self.trigger_steps = frozenset(int(round(position*self.steps_per_cm))
+                                            for position in positions)
+        self.trigger = trigger if self.trigger_steps else None
+
+    def limit_tripped(self, switch):
+        '''
+        Called when a move runs into a limit switch. Compares the step
+        position to the switch's reference and corrects the position if
+        auto_correct is on and the drift is within tolerance.
+        '''
+        trip = {'time': time.time(), 'switch': switch,
+                'step_position': self.step_position, 'drift': None,
+                'corrected': False}
+        metrics.LIMIT_TRIPS.inc(1, self.name, switch)
+        if self.homed and not self.homing:
+            ref = self.limit_refs[switch]
+            if ref is None:
+                self.limit_refs[switch] = self.step_position
+            else:
+                drift = self.step_position - ref
+                trip['drift'] = drift
+                self.drift = drift
+                if self.auto_correct and abs(drift) <= self.drift_tolerance*self.steps_per_cm:
+                    self.step_position = ref
+                    trip['corrected'] = True
+        self.limit_trips.append(trip)
+        return trip
+
+    @property
+    def needs_home(self):
+        '''
+        True if the axis was never homed or the last limit switch trip was
+        further than drift_tolerance from its reference
+        '''
+        if not self.homed:
+            return True
+        if self.drift is None:
+            return False
+        return abs(self.drift) > self.drift_tolerance*self.steps_per_cm
+
+    def drift_report(self):
+        '''
+        Returns: the switch references, the last drift (steps and cm), whether
+            the axis needs homing and the recent limit trips
+        '''
+        drift_cm = None
+        if self.drift is not None:
+            drift_cm = self.drift/self.steps_per_cm
+        return {'refs': dict(self.limit_refs), 'drift': self.drift,
+                'drift_cm': drift_cm, 'needs_home': self.needs_home,
+                'trips': list(self.limit_trips)}
+
+    def decel_ramp(self, wait):
+        '''
+        Half step waits to go from the speed given by wait down to
+        stop_velocity at decel. Computed once per speed.
+        '''
+        if wait not in self._ramps:
+            velocity = 1.0/(2*wait*self.steps_per_cm)
+            waits = []
+            step = 1
+            while True:
+                squared = velocity**2 - 2*self.decel*step/self.steps_per_cm
+                if squared <= self.stop_velocity**2:
+                    break
+                waits.append(1.0/(2*math.sqrt(squared)*self.steps_per_cm))
+                step += 1
+            self._ramps[wait] = waits
+        return self._ramps[wait]
+
+    def check_stopped(self):
+        '''
+        Raise if the running move, or the job it is part of, was stopped
+        '''
+        if self.stop_event.is_set():
+            raise ValueError("{} was stopped".format(self.name))
+
+    def arm(self):
+        '''
+        Clear a previous stop before starting new moves
+        '''
+        self.stop_requested = None
+        self.stop_event.clear()
+
+    def stop(self, requested=None):
+        '''
+        Ramp the running move down. Also wakes the axis if it is waiting
+        for the driver to settle. Applies to the running move only, the
+        next call to arm clears it.
+
+        Args:
+            requested -- time.monotonic() of the stop request, to measure
+                the stop latency
+        '''
+        if requested is None:
+            requested = time.monotonic()
+        self.stop_requested = requested
+        self.stop_event.set()
     
     def cleanup(self):
         GPIO.cleanup()
@@ -0,0 +1,76 @@
+import time
+
+
+class CaptureBuffer(object):
+    """
+    Preallocated ring buffer of (monotonic time, step position) samples.
+
+    Filled from the motion thread while the axis steps. The arrays are
+    allocated once so recording a sample never allocates. Only the newest
+    `size` samples are kept.
+
+    Readers on other threads get views of the underlying arrays, a sample
+    being written while a view is read may be from the next wrap.
+    """
+    def __init__(self, size=100000, decimation=1):
+        '''
+        Args:
+            size -- number of samples to keep
+            decimation -- record every Nth step
+        '''
+        ## numpy is only needed on the Pi if capture is used
+        import numpy as np
+        if size < 1 or decimation < 1:
+            raise ValueError("size and decimation must be at least 1")
+        self.size = size
+        self.decimation = decimation
+        self.times = np.zeros(size, dtype=np.float64)
+        self.steps = np.zeros(size, dtype=np.int64)
+        self.index = 0
+        self.count = 0
+        self.skipped = 0
+        ## add to a monotonic time to get a time.time() timestamp
+        self.clock_offset = time.time() - time.monotonic()
+
+    def record(self, timestamp, step_position):
+        self.skipped += 1
+        if self.skipped < self.decimation:
+            return
+        self.skipped = 0
+        self.times[self.index] = timestamp
+        self.steps[self.index] = step_position
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+        self.skipped = 0
+
+    def views(self):
+        '''
+        Zero-copy access to the samples.
+
+        Returns: list of (times, steps) array views, oldest first. There are
+            two once the buffer has wrapped around.
+        '''
+        if self.count < self.size:
+            return [(self.times[:self.count], self.steps[:self.count])]
+        return [(self.times[self.index:], self.steps[self.index:]),
+                (self.times[:self.index], self.steps[:self.index])]
+
+    def window(self, start=None, end=None):
+        '''
+        Copy out the samples with start <= time <= end (monotonic seconds)
+
+        Returns: (times, steps) arrays
+        '''
+        import numpy as np
+        times, steps = [], []
+        for t, s in self.views():
+            lo = 0 if start is None else np.searchsorted(t, start, side='left')
+            hi = len(t) if end is None else np.searchsorted(t, end, side='right')
+            times.append(t[lo:hi])
+            steps.append(s[lo:hi])
+        return np.concatenate(times), np.concatenate(steps)
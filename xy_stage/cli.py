@@ -0,0 +1,169 @@
+"""
+Entry point for the xy_server command
+"""
+import argparse
+import inspect
+import json
+import time
+import socket
+
+from .server import XY_Server
+from .axis import Axis
+from . import gpio
+
+LATRT_HOST = '192.168.10.15'
+LATRT_PORT = 3010
+
+STEP_PER_CM = 1574.80316
+
+LATRT_XPINS = {
+        'ena':2,
+        'pul':4,
+        'dir':3,
+        'eot_ccw':[17,23],
+        'eot_cw':[27,24],
+    }
+LATRT_YPINS = {
+        'ena':16,
+        'pul':21,
+        'dir':20,
+        'eot_ccw':19,
+        'eot_cw':26,
+    }
+
+## settings --x-axis and --y-axis may set, the keyword arguments of Axis
+AXIS_SETTINGS = set(inspect.signature(Axis).parameters) - {
+                    'name', 'pin_list', 'steps_per_cm', 'logfile'}
+
+
+def wait_for_address(host, port, timeout=100, interval=0.5):
+    '''
+    Probe until the server address can be bound, for example while the
+    network interface comes up at boot.
+
+    Returns: seconds spent waiting
+    '''
+    start = time.monotonic()
+    while True:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            probe.bind((host, port))
+            return time.monotonic() - start
+        except OSError as err:
+            if time.monotonic() - start > timeout:
+                raise
+            print('Waiting for {}:{} ({})'.format(host, port, err))
+            time.sleep(interval)
+        finally:
+            probe.close()
+
+
+def axis_kwargs(text):
+    '''
+    Parse the JSON object of extra Axis arguments given on the command line
+    '''
+    try:
+        kwargs = json.loads(text)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError('not valid JSON: {}'.format(err))
+    if not isinstance(kwargs, dict):
+        raise argparse.ArgumentTypeError('must be a JSON object')
+    unknown = set(kwargs) - AXIS_SETTINGS
+    if unknown:
+        raise argparse.ArgumentTypeError('unknown axis settings {}'.format(
+                                            ', '.join(sorted(unknown))))
+    return kwargs
+
+
+def stage_configs(path):
+    '''
+    Read the extra stages to host from a JSON file, an object of
+    stage id -> list of axis objects (see Stage.from_config)
+    '''
+    try:
+        with open(path) as config_file:
+            configs = json.load(config_file)
+    except (OSError, ValueError) as err:
+        raise argparse.ArgumentTypeError('cannot read {}: {}'.format(path, err))
+    if not isinstance(configs, dict):
+        raise argparse.ArgumentTypeError('{} must hold a JSON object'.format(path))
+    required = {'name', 'pin_list', 'steps_per_cm'}
+    for stage_id, axes in configs.items():
+        if not isinstance(axes, list) or not all(
+                isinstance(axis, dict) and required <= set(axis) for axis in axes):
+            raise argparse.ArgumentTypeError(
+                'stage {} must be a list of axes with a name, pin_list '
+                'and steps_per_cm'.format(stage_id))
+    return configs
+
+
+def simulate_latrt(travel_cm=50):
+    '''
+    Switch the axes to simulated pins wired like the LATRt stage, each
+    carriage starting in the middle of travel_cm
+    '''
+    sim = gpio.use('sim')
+    sim.reset()
+    for pins in (LATRT_XPINS, LATRT_YPINS):
+        sim.add_axis(pins, STEP_PER_CM, travel_cm)
+    return sim
+
+
+def main(args=None):
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(description='Run the XY stage server')
+    parser.add_argument('--host', default=LATRT_HOST)
+    parser.add_argument('--port', type=int, default=LATRT_PORT)
+    parser.add_argument('--timeout', type=float, default=100,
+                        help='seconds to wait for the address to come up')
+    parser.add_argument('--init', action='store_true',
+                        help='initialize the stages before accepting clients')
+    parser.add_argument('--json-only', action='store_true',
+                        help='do not let clients switch to the binary encoding')
+    parser.add_argument('--log-dir', default='/data/logs')
+    parser.add_argument('--record',
+                        help='write every request and response to this command log')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this local port')
+    parser.add_argument('--trigger-pin', type=int,
+                        help='BCM pin pulsed when the XY stage stops after a move')
+    parser.add_argument('--config', type=stage_configs, default={},
+                        metavar='STAGES_JSON',
+                        help='JSON file of extra stages to host, stage id -> '
+                             'list of axes')
+    parser.add_argument('--x-axis', type=axis_kwargs, default={},
+                        metavar='JSON',
+                        help='X axis settings, e.g. \'{"dir_settle": 0.001, '
+                             '"decel": 8}\' (see Axis)')
+    parser.add_argument('--y-axis', type=axis_kwargs, default={},
+                        metavar='JSON', help='Y axis settings, like --x-axis')
+    parser.add_argument('--simulate', action='store_true',
+                        help='run on simulated pins instead of the GPIO')
+    args = parser.parse_args(args)
+
+    wait_for_address(args.host, args.port, args.timeout)
+
+    if args.simulate:
+        simulate_latrt()
+    encodings = ('json',) if args.json_only else ('json', 'binary')
+    server = XY_Server(args.host, args.port, LATRT_XPINS, LATRT_YPINS,
+                       STEP_PER_CM, encodings=encodings,
+                       stage_configs=args.config, log_dir=args.log_dir,
+                       record=args.record, metrics_port=args.metrics_port,
+                       trigger_pin=args.trigger_pin,
+                       x_axis_kwargs=args.x_axis, y_axis_kwargs=args.y_axis)
+    if args.init:
+        server.init_stages()
+
+    server.startup_time = time.perf_counter() - start
+    server.logger.info('Server ready in {:.3f} s'.format(server.startup_time))
+    print('Server ready in {:.3f} s'.format(server.startup_time))
+    try:
+        server.work()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+GPIO backend used by the axes.
+
+On the Pi this is RPi.GPIO. Setting XY_STAGE_GPIO=sim in the environment,
+or calling use('sim') before any axis touches its pins, swaps in the
+simulated pins from sim_gpio so the server runs on any machine.
+"""
+import os
+
+BACKENDS = ('rpi', 'sim')
+
+
+class _Backend(object):
+    """Forwards GPIO.<name> to whichever backend is in use"""
+    module = None
+    name = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            use(os.environ.get('XY_STAGE_GPIO', 'rpi'))
+        return getattr(self.module, attr)
+
+GPIO = _Backend()
+
+
+def use(name):
+    '''
+    Select the GPIO backend, 'rpi' or 'sim'
+    '''
+    if name == 'rpi':
+        import RPi.GPIO as module
+    elif name == 'sim':
+        from . import sim_gpio as module
+    else:
+        raise ValueError("Unknown GPIO backend {}, expected one of {}".format(
+                            name, BACKENDS))
+    GPIO.module = module
+    GPIO.name = name
+    return module
@@ -0,0 +1,197 @@
+"""
+Operational metrics of the server, in the Prometheus text format.
+
+Counters and histograms are aggregated as they are updated, so recording
+a value is a dictionary update under a lock and reading the metrics never
+walks any history. Histograms have fixed buckets.
+
+The metrics are module level objects updated from the server, the motion
+thread and the axes. They are read with the 'metrics' server command or
+over HTTP (serve, xy_server --metrics-port).
+"""
+import time
+import bisect
+from threading import Lock, Thread
+
+## seconds, from a status poll up to a long blocking command
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MOVE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def collect(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append('{}{} {}'.format(
+                    self.name, _format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        ## label values -> [per bucket counts (last is +Inf), sum, count]
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = [[0]*(len(self.buckets)+1), 0.0, 0]
+                self.values[label_values] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            values = sorted((key, (list(counts), total, count))
+                                for key, (counts, total, count) in self.values.items())
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(self.name,
+                        _format_labels(self.labels, label_values, ('le', bound)),
+                        cumulative))
+            labels = _format_labels(self.labels, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Gauge(object):
+    """Value computed when the metrics are read"""
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def collect(self):
+        return ['# HELP {} {}'.format(self.name, self.help),
+                '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, self.function())]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric {} already registered".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, function):
+        self.metrics.pop(name, None)
+        return self.register(Gauge(name, help, function))
+
+    def exposition(self):
+        '''
+        Returns: every metric in the Prometheus text format
+        '''
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.counter('xy_requests_total',
+                            'Requests handled, by command', ('command',))
+REQUEST_ERRORS = registry.counter('xy_request_errors_total',
+                                  'Requests answered with an error', ('command',))
+REQUEST_LATENCY = registry.histogram('xy_request_latency_seconds',
+                                     'Time to answer a request', ('command',))
+MOVES = registry.counter('xy_moves_total',
+                         'Moves run by the motion threads', ('stage', 'axis'))
+MOVE_DURATION = registry.histogram('xy_move_duration_seconds',
+                                   'Time from starting a move to its end',
+                                   ('stage',), MOVE_BUCKETS)
+STAGE_BUSY = registry.counter('xy_stage_busy_seconds_total',
+                              'Seconds the motion thread spent running moves',
+                              ('stage',))
+STEPS = registry.counter('xy_steps_total', 'Step pulses issued', ('axis',))
+MOVING = registry.counter('xy_axis_moving_seconds_total',
+                          'Seconds spent in the step loop', ('axis',))
+SETTLE = registry.counter('xy_settle_seconds_total',
+                          'Seconds spent waiting for the driver to settle',
+                          ('axis',))
+LIMIT_TRIPS = registry.counter('xy_limit_trips_total',
+                               'Moves stopped by a limit switch',
+                               ('axis', 'switch'))
+TRIGGERS = registry.counter('xy_trigger_pulses_total',
+                            'Trigger output pulses', ('trigger', 'source'))
+
+_started = time.time()
+registry.gauge('xy_uptime_seconds', 'Seconds since the server started',
+               lambda: time.time() - _started)
+
+
+def serve(port, host='127.0.0.1'):
+    '''
+    Serve the metrics over HTTP on a daemon thread. Any path answers with
+    the exposition text.
+
+    Returns: the HTTP server
+    '''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+    return httpd
@@ -0,0 +1,111 @@
+"""
+Compact binary log of the command stream a server handled.
+
+The log starts with a short file header followed by one record per
+request:
+
+    time (d) | latency (f) | connection (I) | encoding (B) | opcode (B)
+        | request length (I) | response length (I) | request | response
+
+time is the wall clock time the request arrived and latency the seconds
+the server took to answer it. The request and response are the bytes seen
+on the wire (the payload only for binary frames, the opcode is stored in
+the record) so a replay sends exactly what the client sent.
+"""
+import json
+import struct
+import itertools
+from threading import Lock
+
+from xy_agent import protocol
+
+FILE_MAGIC = b'XYREC'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('!5sB')
+RECORD = struct.Struct('!dfIBBII')
+
+ENCODING_IDS = {name: i for i, name in enumerate(protocol.ENCODINGS)}
+
+
+class CommandRecorder(object):
+    """
+    Appends records to a log file. Shared by every connection thread of a
+    server, writes are serialized with a lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.count = 0
+        self._connections = itertools.count()
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+
+    def new_connection(self):
+        return next(self._connections)
+
+    def record(self, timestamp, latency, connection, encoding, opcode,
+               request, response):
+        header = RECORD.pack(timestamp, latency, connection,
+                             ENCODING_IDS[encoding], opcode, len(request),
+                             len(response))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header)
+            self.file.write(request)
+            self.file.write(response)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        return self.count
+
+
+def read_log(path):
+    '''
+    Read a command log
+
+    Returns: list of record dictionaries, in the order they were written
+    '''
+    records = []
+    with open(path, 'rb') as log:
+        magic, version = FILE_HEADER.unpack(log.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC:
+            raise ValueError("{} is not a command log".format(path))
+        if version != FILE_VERSION:
+            raise ValueError("Unsupported command log version {}".format(version))
+        while True:
+            header = log.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            (timestamp, latency, connection, encoding, opcode, n_request,
+                n_response) = RECORD.unpack(header)
+            request = log.read(n_request)
+            response = log.read(n_response)
+            if len(response) < n_response:
+                ## the server stopped in the middle of a write
+                break
+            records.append({'time': timestamp, 'latency': latency,
+                            'connection': connection,
+                            'encoding': protocol.ENCODINGS[encoding],
+                            'opcode': opcode, 'request': request,
+                            'response': response})
+    return records
+
+def decode_record(record):
+    '''
+    Returns: the request message dictionary of a record
+    '''
+    if record['encoding'] == 'binary':
+        return protocol.decode_request(record['opcode'], record['request'])
+    return json.loads(record['request'].decode('utf-8'))
+
+def command_name(record):
+    try:
+        msg = decode_record(record)
+    except ValueError:
+        return '?'
+    return msg.get('property', msg.get('function', '?'))
@@ -0,0 +1,217 @@
+"""
+Replay a command log (see recorder) against a server.
+
+Every recorded connection gets its own connection again and sends the same
+bytes, either at the original times or as fast as the server answers.
+As fast as possible, the requests go out one at a time in the recorded
+order, so a request never overtakes one it depended on. By default the
+log is replayed against a server on simulated pins started in this
+process, so a stream recorded on the Pi becomes a repeatable performance
+test on any machine.
+
+Recorded latencies are the time the original server took to answer.
+Replay latencies are measured around the request on the client side.
+"""
+import json
+import time
+import socket
+import tempfile
+from threading import Thread
+
+from xy_agent import protocol
+from . import recorder
+
+
+def _receive(sock, encoding):
+    '''
+    Returns: True if the server answered with an error
+    '''
+    if encoding == 'binary':
+        frame = protocol.recv_frame(sock)
+        if frame is None:
+            raise ConnectionError('Server closed the connection')
+        return 'error' in protocol.decode_response(*frame)
+    message = protocol.recv_json(sock)
+    if message is None:
+        raise ConnectionError('Server closed the connection')
+    return 'error' in message[0]
+
+def _send_record(sock, record, start, results):
+    sent = time.perf_counter()
+    if record['encoding'] == 'binary':
+        sock.sendall(protocol.frame(record['opcode'], record['request']))
+    else:
+        sock.sendall(record['request'])
+    error = _receive(sock, record['encoding'])
+    results.append({'name': recorder.command_name(record),
+                    'original': record['latency'],
+                    'replay': time.perf_counter() - sent,
+                    'sent': sent - start,
+                    'error': error})
+
+def _replay_connection(records, host, port, start, first, speed, results):
+    sock = socket.create_connection((host, port))
+    try:
+        for record in records:
+            wait = start + (record['time'] - first)/speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            _send_record(sock, record, start, results)
+    finally:
+        sock.close()
+
+def _replay_in_order(records, host, port, start, results):
+    '''
+    Send every request after the one recorded before it was answered, on
+    the connection it was recorded on. Keeps requests on different
+    connections in order, like enable_capture on the command channel
+    before capture_window on a status channel.
+    '''
+    socks = {}
+    try:
+        for record in sorted(records, key=lambda record: record['time']):
+            sock = socks.get(record['connection'])
+            if sock is None:
+                sock = socket.create_connection((host, port))
+                socks[record['connection']] = sock
+            _send_record(sock, record, start, results)
+    finally:
+        for sock in socks.values():
+            sock.close()
+
+def replay(records, host, port, speed=1.0):
+    '''
+    Send the recorded requests to a server
+
+    Args:
+        speed -- replay the original timing sped up by this factor, each
+            connection on its own thread. None to send the requests in
+            the order they were recorded, each as soon as the one before
+            was answered
+
+    Returns: (list of per request results, seconds the replay took)
+    '''
+    results = []
+    start = time.perf_counter()
+    if speed is None:
+        _replay_in_order(records, host, port, start, results)
+        return results, time.perf_counter() - start
+
+    connections = {}
+    for record in records:
+        connections.setdefault(record['connection'], []).append(record)
+    first = min(record['time'] for record in records)
+    threads = [Thread(target=_replay_connection,
+                      args=(conn_records, host, port, start, first, speed, results))
+                    for conn_records in connections.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q*len(values)), len(values)-1)]
+
+def compare(records, results, duration):
+    '''
+    Returns: per command and overall latency and throughput of the
+        original stream and the replay
+    '''
+    summary = {}
+    for result in results:
+        summary.setdefault(result['name'], []).append(result)
+    commands = {}
+    for name, rows in summary.items():
+        original = [row['original'] for row in rows]
+        replayed = [row['replay'] for row in rows]
+        commands[name] = {
+            'count': len(rows),
+            'original_mean': sum(original)/len(rows),
+            'original_p95': _percentile(original, 0.95),
+            'replay_mean': sum(replayed)/len(rows),
+            'replay_p95': _percentile(replayed, 0.95),
+            'errors': sum(row['error'] for row in rows),
+        }
+    original_duration = max(r['time'] + r['latency'] for r in records) - \
+                            min(r['time'] for r in records)
+    return {'commands': commands,
+            'original_duration': original_duration,
+            'replay_duration': duration,
+            'original_rate': len(records)/max(original_duration, 1e-9),
+            'replay_rate': len(results)/max(duration, 1e-9)}
+
+def print_report(report):
+    print('{:<20} {:>6} {:>12} {:>12} {:>12} {:>12} {:>7}'.format(
+            'command', 'count', 'orig mean ms', 'orig p95 ms', 'repl mean ms',
+            'repl p95 ms', 'errors'))
+    for name, row in sorted(report['commands'].items()):
+        print('{:<20} {:>6} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f} {:>7}'.format(
+                name, row['count'], 1e3*row['original_mean'],
+                1e3*row['original_p95'], 1e3*row['replay_mean'],
+                1e3*row['replay_p95'], row['errors']))
+    print('Original: {:.3f} s, {:.1f} requests/s'.format(
+            report['original_duration'], report['original_rate']))
+    print('Replay:   {:.3f} s, {:.1f} requests/s'.format(
+            report['replay_duration'], report['replay_rate']))
+
+def start_simulated_server(travel_cm=50, record=None):
+    '''
+    Start an initialized server on simulated LATRt pins on a free local port
+
+    Returns: the XY_Server, serving on a daemon thread
+    '''
+    from .cli import simulate_latrt, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM
+    from .server import XY_Server
+    simulate_latrt(travel_cm)
+    server = XY_Server('127.0.0.1', 0, LATRT_XPINS, LATRT_YPINS, STEP_PER_CM,
+                       log_dir=tempfile.mkdtemp(prefix='xy_replay'),
+                       record=record)
+    server.init_stages()
+    Thread(target=server.work, daemon=True).start()
+    return server
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a recorded command log')
+    parser.add_argument('log', help='command log written by xy_server --record')
+    parser.add_argument('--host',
+                        help='replay against this server instead of a simulated one')
+    parser.add_argument('--port', type=int, default=3010)
+    parser.add_argument('--fast', action='store_true',
+                        help='send requests in the recorded order as fast as '
+                             'they are answered')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed up the original timing by this factor')
+    parser.add_argument('--travel', type=float, default=50,
+                        help='cm of travel of the simulated axes')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args(args)
+
+    records = recorder.read_log(args.log)
+    if len(records) == 0:
+        print('{} has no records'.format(args.log))
+        return 1
+
+    if args.host is None:
+        server = start_simulated_server(args.travel)
+        host, port = server.server.getsockname()
+    else:
+        host, port = args.host, args.port
+
+    print('Replaying {} requests on {} connections to {}:{}'.format(
+            len(records), len({r['connection'] for r in records}), host, port))
+    results, duration = replay(records, host, port,
+                               None if args.fast else args.speed)
+    report = compare(records, results, duration)
+    print_report(report)
+    if args.json is not None:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import time
+import itertools
+from collections import deque
+from threading import Thread, Condition, Event
+
+from xy_agent import tracing
+from . import metrics
+
+
+class Move(object):
+    """One queued relative move of a single axis"""
+    _ids = itertools.count()
+
+    def __init__(self, axis, dir, distance, velocity=None):
+        self.id = next(self._ids)
+        self.axis = axis
+        self.dir = dir
+        self.distance = distance
+        self.velocity = velocity
+        self.merged = 1
+        self.result = None
+        self.queued = time.time()
+        ## correlation id of the request that queued the move
+        self.trace_id = tracing.tracer.current_id
+
+    def blends_with(self, axis, dir, velocity):
+        return (axis is self.axis and dir == self.dir
+                    and velocity == self.velocity)
+
+    def as_dict(self):
+        return {'id': self.id, 'axis': self.axis.name, 'dir': self.dir,
+                'distance': self.distance, 'velocity': self.velocity,
+                'merged': self.merged}
+
+
+class Job(object):
+    """
+    Work that needs the axes to itself, like homing. It runs on the motion
+    thread in queue order, so no queued move can step the same axes at the
+    same time.
+    """
+    def __init__(self, name, function, axes, move_end=False):
+        self.id = next(Move._ids)
+        self.name = name
+        self.function = function
+        self.axes = axes
+        ## pulse the trigger if function returns True, like a move
+        self.move_end = move_end
+        self.result = None
+        self.error = None
+        self.done = Event()
+        self.trace_id = tracing.tracer.current_id
+
+    def blends_with(self, axis, dir, velocity):
+        return False
+
+    def as_dict(self):
+        return {'id': self.id, 'job': self.name,
+                'axes': [axis.name for axis in self.axes]}
+
+
+class MotionScheduler(object):
+    """
+    Runs the moves for one stage, in order, on a long lived thread.
+
+    Moves can be queued ahead of time. A move in the same direction and at
+    the same speed as the last queued move of the same axis is merged into
+    it, so the motor keeps going instead of stopping and settling between
+    the two. The driver is kept enabled between back to back moves of the
+    same axis.
+
+    Every stage owns its own scheduler so separate devices served by the
+    same process move in parallel, while the moves of one stage never
+    overlap each other.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.moves = deque()
+        self.current = None
+        self.changed = Condition()
+        self.last_error = None
+        ## pulsed when the queue drains, see trigger.Trigger
+        self.trigger = None
+
+        self.thread = Thread(target=self.run, name='{}-motion'.format(name),
+                             daemon=True)
+        self.thread.start()
+
+    @property
+    def busy(self):
+        return self.current is not None or len(self.moves) > 0
+
+    @property
+    def queue(self):
+        '''
+        Returns: the running move followed by the queued ones, as dictionaries
+        '''
+        with self.changed:
+            moves = list(self.moves)
+            if self.current is not None:
+                moves.insert(0, self.current)
+        return [move.as_dict() for move in moves]
+
+    def enqueue(self, axis, dir, distance, velocity=None):
+        '''
+        Queue a move of axis.move_cm
+
+        Returns: id of the queued move, or of the move it was merged into
+        '''
+        with self.changed:
+            if len(self.moves) > 0 and self.moves[-1].blends_with(axis, dir, velocity):
+                move = self.moves[-1]
+                move.distance += distance
+                move.merged += 1
+            else:
+                move = Move(axis, dir, distance, velocity)
+                self.moves.append(move)
+                self.changed.notify_all()
+        return move.id
+
+    def run_exclusive(self, name, function, axes, move_end=False):
+        '''
+        Run function on the motion thread and wait for it. Refused unless
+        the stage is idle, moves queued meanwhile run after it.
+
+        Args:
+            move_end -- the job is a move, function returns whether it
+                arrived. Pulses the trigger like the end of a queued move
+
+        Returns: what function returned, its exception is raised here
+        '''
+        with self.changed:
+            if self.busy or any(axis.keep_moving for axis in axes):
+                raise ValueError("Cannot {} while the stage is moving".format(name))
+            job = Job(name, function, axes, move_end)
+            self.moves.append(job)
+            self.changed.notify_all()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run_job(self, job):
+        start = time.monotonic()
+        try:
+            with tracing.span(job.name, trace_id=job.trace_id, flow='f'):
+                job.result = job.function()
+            if job.move_end and job.result is True:
+                self.move_ended(job.axes[-1])
+        except Exception as err:
+            job.error = err
+        metrics.STAGE_BUSY.inc(time.monotonic() - start, self.name)
+        with self.changed:
+            self.current = None
+            self.changed.notify_all()
+        job.done.set()
+
+    def move_ended(self, axis):
+        '''
+        Pulse the trigger if the move that just arrived left the queue empty
+        '''
+        trigger = self.trigger
+        if (trigger is not None and trigger.on_move_end
+                and len(self.moves) == 0):
+            trigger.pulse('move_end', axis.name, axis.step_position)
+
+    def clear(self):
+        '''
+        Drop every queued move. The running move is not stopped.
+
+        Returns: number of moves dropped
+        '''
+        with self.changed:
+            count = len(self.moves)
+            self.moves.clear()
+            self.changed.notify_all()
+        return count
+
+    def run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: len(self.moves) > 0)
+                move = self.moves.popleft()
+                self.current = move
+                ## under the lock so a stop can't be lost between taking
+                ## the move and starting it
+                if isinstance(move, Job):
+                    for axis in move.axes:
+                        axis.arm()
+                else:
+                    move.axis.arm()
+            if isinstance(move, Job):
+                self._run_job(move)
+                continue
+            axis = move.axis
+            start = time.monotonic()
+            try:
+                with tracing.span('move', trace_id=move.trace_id, flow='f',
+                                  axis=axis.name, distance=move.distance,
+                                  merged=move.merged,
+                                  queued=time.time() - move.queued):
+                    move.result = axis.move_cm(move.dir, move.distance,
+                                               move.velocity, release=False)
+                self.last_error = None
+                ## only a move that got to its target, not one cut short
+                ## by a stop or a limit switch
+                if move.result[0]:
+                    self.move_ended(axis)
+            except Exception as err:
+                print('{} move failed: {}'.format(self.name, err))
+                self.last_error = err
+            duration = time.monotonic() - start
+            metrics.MOVES.inc(1, self.name, axis.name)
+            metrics.MOVE_DURATION.observe(duration, self.name)
+            metrics.STAGE_BUSY.inc(duration, self.name)
+            with self.changed:
+                self.current = None
+                next_same = (len(self.moves) > 0 and
+                             getattr(self.moves[0], 'axis', None) is axis)
+                if not next_same and not axis.hold_enable:
+                    axis.set_driver(False)
+                self.changed.notify_all()
+
+    def wait(self, timeout=None):
+        '''
+        Block until every queued move has finished
+
+        Returns: True if the scheduler is idle
+        '''
+        with self.changed:
+            return self.changed.wait_for(lambda: not self.busy, timeout)
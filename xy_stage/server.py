@@ -1,78 +1,316 @@
 #!/user/bin/env python3
 
 from .xy_stage import XY_Stage
+from .stage import Stage
+from .recorder import CommandRecorder
+from . import metrics
+from xy_agent import protocol
+from xy_agent import tracing
+import os
 import socket
 import json
+import time
 import logging
 import logging.handlers as handlers
+from threading import Thread, Lock
+
+
+## functions run by the server itself instead of a stage
+SERVER_FUNCTIONS = {
+    'init': 'init_stages',
+    'set_encoding': 'set_encoding',
+    'list_stages': 'list_stages',
+    'ping': 'ping',
+    'trace_start': 'trace_start',
+    'trace_stop': 'trace_stop',
+    'trace_events': 'trace_events',
+    'metrics': 'metrics',
+}
+
+
+def _decode_json(text):
+    ## only the parse is timed, not the wait for the request
+    with tracing.span('decode', encoding='json'):
+        return json.loads(text)
 
 
 class XY_Server(object):
-    def __init__(self, HOST, PORT, xpin_list, ypin_list, steps_per_cm):
-        
+    def __init__(self, HOST, PORT, xpin_list, ypin_list, steps_per_cm,
+                 encodings=protocol.ENCODINGS, stage_configs=None,
+                 default_stage='xy', log_dir='/data/logs', record=None,
+                 metrics_port=None, trigger_pin=None, x_axis_kwargs=None,
+                 y_axis_kwargs=None):
+        '''
+        Args:
+            encodings -- the wire encodings clients are allowed to switch to
+                with set_encoding. JSON is always available.
+            stage_configs -- extra stages to host, as a dictionary of
+                stage id -> list of axis dictionaries (see Stage.from_config)
+            default_stage -- id of the XY stage built from the x and y pins.
+                Messages without a 'stage' key go to this stage.
+            log_dir -- directory for the server log and position logs
+            record -- path of a command log to write every request and
+                response to (see recorder), None to not record
+            metrics_port -- local port to serve the metrics on over HTTP,
+                None to only answer the metrics command
+            trigger_pin -- pin of the XY stage's trigger output, pulsed
+                when a move ends (see Stage.set_trigger)
+            x_axis_kwargs, y_axis_kwargs -- extra arguments for the XY
+                stage's axes, like the settle times or decel (see Axis)
+        '''
+        self.encodings = encodings
+        if stage_configs is None:
+            stage_configs = {}
+        if default_stage in stage_configs:
+            raise ValueError("Stage id {} is already used by the XY stage".format(
+                                default_stage))
+        self.stage_configs = stage_configs
+        self.default_stage = default_stage
+
+        self.started = time.time()
+        self.startup_time = None
+
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        ## lets a restarted server bind while old connections are closing
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((HOST, PORT))
-        self.server.listen(1)
+        self.server.listen(5)
         
         ## set up logging        
         self.logger = logging.getLogger('xy_server')
         self.logger.setLevel(logging.INFO)
-        handler = handlers.TimedRotatingFileHandler('/data/logs/xy_server_log.log',
+        handler = handlers.TimedRotatingFileHandler(os.path.join(log_dir, 'xy_server_log.log'),
                                                     when='D', interval=1,
                                                     backupCount=1)
         handler.setLevel(logging.INFO)
         handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s:%(message)s' ))
         self.logger.addHandler(handler)                                                
 
+        self.trigger_pin = trigger_pin
         self.xpins = xpin_list
         self.ypins = ypin_list
         self.steps_per_cm = steps_per_cm
+        self.x_axis_kwargs = x_axis_kwargs
+        self.y_axis_kwargs = y_axis_kwargs
         self.stages = None
-        self.xlog = '/data/logs/xpos.txt'
-        self.ylog = '/data/logs/ypos.txt'
+        self.init_lock = Lock()
+        self.xlog = os.path.join(log_dir, 'xpos.txt')
+        self.ylog = os.path.join(log_dir, 'ypos.txt')
+
+        self.recorder = None
+        if record is not None:
+            self.recorder = CommandRecorder(record)
+
+        self.metrics_http = None
+        if metrics_port is not None:
+            self.metrics_http = metrics.serve(metrics_port)
 
     def work(self):
+        '''
+        Accept connections forever. Each client connection is served on
+        its own thread so status queries are not stuck behind a wait.
+        '''
         self.logger.info("Initialize Server")
         while True:
             try:
                 conn, addr = self.server.accept()
-                with conn:
-                    self.logger.info('Connected to {}'.format(addr))
-                    while True:
-                        msg = conn.recv(1024)
-                        if not msg:
-                            break
-                        resp = self.process(msg.decode('utf-8'))
-                        conn.sendall(bytes(resp, 'utf-8'))
             except:
                 self.server.close()
                 raise
+            self.logger.info('Connected to {}'.format(addr))
+            thrd = Thread(target=self.serve, args=(conn, addr), daemon=True)
+            thrd.start()
+
+    def serve(self, conn, addr):
+        with conn:
+            try:
+                self.handle(conn)
+            except Exception as err:
+                self.logger.warning('Connection to {} failed: {}'.format(addr, err))
+        self.logger.info('Disconnected from {}'.format(addr))
+
+    def handle(self, conn):
+        '''
+        Serve one client connection until it closes. Every connection
+        starts out speaking JSON and may switch with set_encoding.
+        '''
+        encoding = 'json'
+        if self.recorder is not None:
+            connection = self.recorder.new_connection()
+        while True:
+            if encoding == 'binary':
+                frame = protocol.recv_frame(conn)
+                if frame is None:
+                    break
+                received, start = time.time(), time.perf_counter()
+                opcode, payload = frame
+                try:
+                    with tracing.span('decode', encoding=encoding):
+                        msg = protocol.decode_request(opcode, payload)
+                except Exception as err:
+                    conn.sendall(protocol.encode_response(opcode, {'error': str(err)}))
+                    continue
+                ## the fixed layout commands are polled at high rates
+                resp = self.dispatch(msg, verbose=(opcode == protocol.OP_JSON))
+                with tracing.span('encode', encoding=encoding):
+                    out = protocol.encode_response(opcode, resp)
+                    conn.sendall(out)
+                request, response = payload, out[protocol.HEADER.size:]
+            else:
+                ## requests with long argument lists span several reads
+                message = protocol.recv_json(conn, parse=_decode_json)
+                if message is None:
+                    break
+                received, start = time.time(), time.perf_counter()
+                opcode = protocol.OP_JSON
+                msg, data = message
+                resp = self.dispatch(msg)
+                with tracing.span('encode', encoding=encoding):
+                    out = bytes(json.dumps(resp), 'utf-8')
+                    conn.sendall(out)
+                request, response = data, out
+            if self.recorder is not None:
+                self.recorder.record(received, time.perf_counter() - start,
+                                     connection, encoding, opcode, request,
+                                     response)
+            if msg.get('function') == 'set_encoding' and 'resp' in resp:
+                encoding = resp['resp']
 
     def process(self, msg):
-        msg = json.loads(msg)
-        self.logger.info('Received {}'.format(msg))
+        '''
+        Handle one JSON encoded message and return the JSON encoded response
+        '''
+        return json.dumps(self.dispatch(json.loads(msg)))
+
+    def dispatch(self, msg, verbose=True):
+        '''
+        Run a decoded message against the stages.
+
+        Returns: {'resp': value} or {'error': message}
+        '''
+        if verbose:
+            self.logger.info('Received {}'.format(msg))
+        else:
+            self.logger.debug('Received {}'.format(msg))
+        name = msg.get('property', msg.get('function'))
+        trace_id = msg.get('trace')
+        start = time.perf_counter()
         try:
-            if 'property' in msg:
-                resp = {'resp': getattr(self.stages, msg['property'])}
-            elif 'function' in msg:
-                if msg['function'] == 'init':
-                    resp = {'resp':self.init_stages()}
-                else:
-                    f = getattr(self.stages, msg['function'])
+            with tracing.span('dispatch:{}'.format(name), trace_id=trace_id,
+                              flow='t'):
+                if 'property' in msg:
+                    stage = self.get_stage(msg.get('stage'))
+                    resp = {'resp': getattr(stage, msg['property'])}
+                elif 'function' in msg:
+                    if msg['function'] in SERVER_FUNCTIONS:
+                        f = getattr(self, SERVER_FUNCTIONS[msg['function']])
+                    else:
+                        stage = self.get_stage(msg.get('stage'))
+                        f = getattr(stage, msg['function'])
                     resp = {'resp': f(**msg['kwargs'])}
             if resp is None:
                 resp = {'resp': None }
         except Exception as err:
             resp = {'error': err.args[0]}     
-        self.logger.info('Returned {}'.format(resp))
-        return json.dumps(resp)
+        metrics.REQUESTS.inc(1, name)
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, name)
+        if 'error' in resp:
+            metrics.REQUEST_ERRORS.inc(1, name)
+        if verbose:
+            self.logger.info('Returned {}'.format(resp))
+        else:
+            self.logger.debug('Returned {}'.format(resp))
+        return resp
+
+    def close(self):
+        '''
+        Stop accepting connections and finish the command log
+        '''
+        self.server.close()
+        if self.metrics_http is not None:
+            self.metrics_http.shutdown()
+        if self.recorder is not None:
+            count = self.recorder.close()
+            self.logger.info('Recorded {} commands to {}'.format(
+                                count, self.recorder.path))
+
+    def ping(self):
+        '''
+        Readiness probe. Answers as soon as the server is accepting
+        connections.
+        '''
+        return {'initialized': self.stages is not None,
+                'uptime': time.time() - self.started,
+                'startup_time': self.startup_time}
+
+    def metrics(self):
+        '''
+        Returns: the server metrics in the Prometheus text format
+        '''
+        return metrics.registry.exposition()
+
+    def trace_start(self):
+        '''
+        Start recording spans on the server (see xy_agent.tracing)
+        '''
+        tracing.tracer.start('xy_server')
+
+    def trace_stop(self):
+        '''
+        Returns: number of trace events recorded
+        '''
+        return tracing.tracer.stop()
+
+    def trace_events(self):
+        '''
+        Returns: the recorded Chrome trace events
+        '''
+        return tracing.tracer.events
+
+    def set_encoding(self, encoding):
+        '''
+        Check the encoding a client asked for. The connection switches
+        after this response has been sent.
+        '''
+        if encoding not in protocol.ENCODINGS or (
+                encoding != 'json' and encoding not in self.encodings):
+            raise ValueError('Encoding {} not supported'.format(encoding))
+        return encoding
 
     def init_stages(self):
-        if self.stages is not None:
-            return 'Stages already Initialized'
-        self.stages = XY_Stage(self.xpins, self.ypins, self.steps_per_cm,
-                                self.xlog, self.ylog)
+        with self.init_lock:
+            if self.stages is not None:
+                return 'Stages already Initialized'
+            stages = {self.default_stage: XY_Stage(self.xpins, self.ypins,
+                                            self.steps_per_cm,
+                                            xlogfile=self.xlog, ylogfile=self.ylog,
+                                            name=self.default_stage,
+                                            x_axis_kwargs=self.x_axis_kwargs,
+                                            y_axis_kwargs=self.y_axis_kwargs)}
+            if self.trigger_pin is not None:
+                stages[self.default_stage].set_trigger(self.trigger_pin)
+            for stage_id, axes in self.stage_configs.items():
+                stages[stage_id] = Stage.from_config(stage_id, axes)
+            self.stages = stages
         return 'Stages Initialized'
+
+    def get_stage(self, stage_id=None):
+        if self.stages is None:
+            raise ValueError("Stages not Initialized")
+        if stage_id is None:
+            stage_id = self.default_stage
+        if stage_id not in self.stages:
+            raise ValueError("Unknown stage {}".format(stage_id))
+        return self.stages[stage_id]
+
+    def list_stages(self):
+        '''
+        Returns: dictionary of stage id -> axis names
+        '''
+        if self.stages is None:
+            raise ValueError("Stages not Initialized")
+        return {stage_id: stage.axis_names
+                    for stage_id, stage in self.stages.items()}
 '''        
 if __name__ == '__main__':
     HOST = '192.168.10.15'
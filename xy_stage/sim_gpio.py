@@ -0,0 +1,126 @@
+"""
+Simulated stand-in for RPi.GPIO.
+
+Pins behave like latches. Axes registered with add_axis get a simple
+mechanical model: every pulse (falling edge of the pulse pin) moves the
+carriage one step while the driver is enabled, in the direction set by
+the direction pin, and the limit switch inputs read LOW when the carriage
+is at either end of its travel. Motion timing comes from the axis' own step
+loop, so a simulated move takes as long as a real one.
+
+Outputs like the trigger can be watched, every level change is then
+recorded with its time.
+"""
+import time
+from threading import Lock
+
+BCM = 'BCM'
+BOARD = 'BOARD'
+OUT = 'OUT'
+IN = 'IN'
+HIGH = 1
+LOW = 0
+
+_lock = Lock()
+_levels = {}
+_pulses = {}
+_switches = {}
+_edges = {}
+
+
+class SimAxis(object):
+    def __init__(self, pin_list, travel_steps, position):
+        self.ena = pin_list['ena']
+        self.dir = pin_list['dir']
+        self.travel = travel_steps
+        self.position = position
+        self.pulses = 0
+
+    def pulse(self):
+        self.pulses += 1
+        ## enable is active low
+        if _levels.get(self.ena, HIGH) != LOW:
+            return
+        ## direction high moves toward the CW (home) switch
+        if _levels.get(self.dir, HIGH):
+            self.position = max(self.position - 1, 0)
+        else:
+            self.position = min(self.position + 1, self.travel)
+
+    def tripped(self, switch):
+        if switch == 'cw':
+            return self.position <= 0
+        return self.position >= self.travel
+
+
+def add_axis(pin_list, steps_per_cm, travel_cm=50, position_cm=None):
+    '''
+    Model the carriage driven by an axis' pins
+
+    Args:
+        pin_list -- the same pin dictionary given to the Axis
+        travel_cm -- distance between the two limit switches
+        position_cm -- start position from the CW switch, defaults to the
+            middle of the travel
+
+    Returns: the SimAxis
+    '''
+    if position_cm is None:
+        position_cm = travel_cm/2
+    axis = SimAxis(pin_list, int(round(travel_cm*steps_per_cm)),
+                   int(round(position_cm*steps_per_cm)))
+    with _lock:
+        _pulses[pin_list['pul']] = axis
+        for switch in ('cw', 'ccw'):
+            pins = pin_list['eot_' + switch]
+            if not isinstance(pins, (list, tuple)):
+                pins = [pins]
+            for pin in pins:
+                _switches[pin] = (axis, switch)
+    return axis
+
+def watch(pin):
+    '''
+    Start recording the level changes of an output pin
+    '''
+    _edges[pin] = []
+
+def edges(pin):
+    '''
+    Returns: list of (time.time(), level) changes of a watched pin
+    '''
+    return list(_edges.get(pin, []))
+
+def reset():
+    with _lock:
+        _levels.clear()
+        _pulses.clear()
+        _switches.clear()
+        _edges.clear()
+
+def setmode(mode):
+    pass
+
+def setwarnings(flag):
+    pass
+
+def setup(pin, mode, **kwargs):
+    _levels.setdefault(pin, HIGH)
+
+def output(pin, value):
+    value = HIGH if value else LOW
+    falling = value == LOW and _levels.get(pin) == HIGH
+    if pin in _edges and _levels.get(pin) != value:
+        _edges[pin].append((time.time(), value))
+    _levels[pin] = value
+    if falling and pin in _pulses:
+        _pulses[pin].pulse()
+
+def input(pin):
+    if pin in _switches:
+        axis, switch = _switches[pin]
+        return LOW if axis.tripped(switch) else HIGH
+    return _levels.get(pin, HIGH)
+
+def cleanup():
+    pass
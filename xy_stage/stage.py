@@ -0,0 +1,394 @@
+from .axis import Axis, CombinedAxis
+from .scheduler import MotionScheduler
+from .trigger import Trigger
+
+import time
+from collections import OrderedDict
+from threading import Thread
+
+
+class Stage(object):
+    """
+    A device made of any number of named axes.
+
+    Moves are queued on the stage's MotionScheduler and run one at a time,
+    so several can be sent ahead. stop flushes the queue. Positions, limits,
+    etc. are reported in the order the axes were given.
+    """
+    def __init__(self, axes, name='stage'):
+        '''
+        Args:
+            axes: list of Axis objects, each with a unique name
+            name: name of the stage, used for the motion thread
+        '''
+        self.name = name
+        self.axes = OrderedDict()
+        for axis in axes:
+            if axis.name in self.axes:
+                raise ValueError("Duplicate axis name {}".format(axis.name))
+            self.axes[axis.name] = axis
+        self.scheduler = MotionScheduler(name)
+        self.trigger = None
+
+    @classmethod
+    def from_config(cls, name, axes):
+        '''
+        Build a stage from a list of axis dictionaries with the keys
+        name, pin_list, steps_per_cm and optionally logfile, enable_settle,
+        dir_settle, drift_tolerance and auto_correct. Axes with
+        lists of limit pins are built as CombinedAxis.
+        '''
+        return cls([build_axis(**config) for config in axes], name=name)
+
+    def axis(self, name):
+        if name not in self.axes:
+            raise ValueError("No axis named {} in {}".format(name, self.name))
+        return self.axes[name]
+
+    @property
+    def axis_names(self):
+        return list(self.axes)
+
+    @property
+    def calibration(self):
+        '''
+        Returns: dictionary of axis name -> steps per cm
+        '''
+        return {name: axis.steps_per_cm for name, axis in self.axes.items()}
+
+    def get_position(self):
+        return tuple(axis.position for axis in self.axes.values())
+
+    def get_positions(self):
+        return {name: axis.position for name, axis in self.axes.items()}
+
+    def set_position(self, value):
+        if len(value) != len(self.axes):
+            raise ValueError("Must supply a position for each of {}".format(
+                                self.axis_names))
+        if self.moving:
+            raise ValueError("Cannot set position while axis is moving")
+        for axis, position in zip(self.axes.values(), value):
+            axis.position = position
+
+    @property
+    def moving(self):
+        return self.scheduler.busy or any(axis.keep_moving
+                                          for axis in self.axes.values())
+
+    @property
+    def limits(self):
+        return tuple(axis.limits for axis in self.axes.values())
+
+    @property
+    def homed(self):
+        return all(axis.homed for axis in self.axes.values())
+
+    def is_enabled(self):
+        return all(axis.hold_enable for axis in self.axes.values())
+
+    def snapshot(self):
+        '''
+        The whole stage state in one read, instead of asking for the
+        position, limits, moving, homed and is_enabled separately. The move
+        queue is locked while the axes are read so the queue and the axis
+        states agree.
+
+        Returns: dictionary with the time, stage flags, the running and
+            queued moves and each axis' state (see Axis.snapshot)
+        '''
+        with self.scheduler.changed:
+            axes = OrderedDict((name, axis.snapshot())
+                                    for name, axis in self.axes.items())
+            queue = self.scheduler.queue
+            busy = self.scheduler.busy
+            last_error = self.scheduler.last_error
+        return {'time': time.time(),
+                'stage': self.name,
+                'moving': busy or any(axis['moving'] for axis in axes.values()),
+                'homed': all(axis['homed'] for axis in axes.values()),
+                'enabled': all(axis['hold_enable'] for axis in axes.values()),
+                'queue': queue,
+                'last_error': None if last_error is None else str(last_error),
+                'axes': axes}
+
+    def enable(self):
+        """Holds the motors enabled between moves"""
+        for axis in self.axes.values():
+            axis.enable()
+
+    def disable(self):
+        for axis in self.axes.values():
+            axis.disable()
+
+    def home(self, max_dist=150, reset_pos=True, parallel=True, axes=None,
+             **kwargs):
+        '''
+        Home every axis, or the named axes. The axes are homed at the same
+        time on separate threads unless parallel is False. Extra arguments
+        are passed to Axis.home
+
+        Homing runs as a job of the motion thread (see
+        MotionScheduler.run_exclusive), moves sent meanwhile wait for it.
+
+        Returns: dictionary with the total time and each axis' homing stats
+        '''
+        if axes is None:
+            axes = self.axis_names
+        axes = [self.axis(name) for name in axes]
+        return self.scheduler.run_exclusive('home', lambda: self._home(
+                            axes, max_dist, reset_pos, parallel, **kwargs), axes)
+
+    def _home(self, axes, max_dist, reset_pos, parallel, **kwargs):
+        start = time.time()
+        results = {}
+        errors = []
+        def home_axis(axis):
+            try:
+                results[axis.name] = axis.home(max_dist=max_dist,
+                                               reset_pos=reset_pos, **kwargs)
+            except Exception as err:
+                errors.append(err)
+
+        if parallel:
+            threads = [Thread(target=home_axis, args=(axis,)) for axis in axes]
+            for thrd in threads:
+                thrd.start()
+            for thrd in threads:
+                thrd.join()
+        else:
+            for axis in axes:
+                ## a stop ends the whole homing, not just the running axis
+                if errors or axis.stop_event.is_set():
+                    break
+                home_axis(axis)
+        missing = [axis.name for axis in axes if axis.name not in results]
+        if missing and any(axis.stop_event.is_set() for axis in axes):
+            raise ValueError("Homing was stopped, {} not homed".format(
+                                ', '.join(missing)))
+        if errors:
+            raise errors[0]
+        return {'time': time.time() - start, 'axes': results}
+
+    def home_if_needed(self, **kwargs):
+        '''
+        Home only the axes that were never homed or whose limit switch drift
+        is beyond tolerance. Arguments are passed to home
+
+        Returns: dictionary with the total time and each homed axis' stats
+        '''
+        axes = [name for name, axis in self.axes.items() if axis.needs_home]
+        return self.home(axes=axes, **kwargs)
+
+    def drift_report(self):
+        '''
+        Returns: each axis' limit switch drift report (see Axis.drift_report)
+        '''
+        return {name: axis.drift_report() for name, axis in self.axes.items()}
+
+    def set_auto_correct(self, enabled=True, tolerance=None):
+        '''
+        Turn on or off correcting the position when a limit switch trips
+        within tolerance (cm) of where it was at homing
+        '''
+        for axis in self.axes.values():
+            axis.auto_correct = enabled
+            if tolerance is not None:
+                axis.drift_tolerance = tolerance
+
+    def wait(self):
+        return self.scheduler.wait()
+
+    def enable_capture(self, size=100000, decimation=1, axes=None):
+        '''
+        Start recording step positions on the named axes (all by default).
+        See Axis.enable_capture
+        '''
+        if axes is None:
+            axes = self.axis_names
+        for name in axes:
+            self.axis(name).enable_capture(size, decimation)
+
+    def disable_capture(self, axes=None):
+        if axes is None:
+            axes = self.axis_names
+        for name in axes:
+            self.axis(name).disable_capture()
+
+    def capture_window(self, axis, start=None, end=None):
+        '''
+        Copy out the recorded samples of one axis between start and end,
+        given as time.time() timestamps.
+
+        Returns: dictionary with the sample times (time.time() seconds),
+            step positions and steps_per_cm
+        '''
+        axis = self.axis(axis)
+        if axis.capture is None:
+            raise ValueError("Capture is not enabled on {}".format(axis.name))
+        offset = axis.capture.clock_offset
+        if start is not None:
+            start = start - offset
+        if end is not None:
+            end = end - offset
+        times, steps = axis.capture.window(start, end)
+        return {'times': (times + offset).tolist(), 'steps': steps.tolist(),
+                'steps_per_cm': axis.steps_per_cm}
+
+    def settle_stats(self):
+        '''
+        Returns: each axis' settle stats (see Axis.settle_stats)
+        '''
+        return {name: axis.settle_stats() for name, axis in self.axes.items()}
+
+    def reset_settle_stats(self):
+        for axis in self.axes.values():
+            axis.reset_settle_stats()
+
+    def move_cm(self, axis, distance, velocity=None):
+        '''
+        Args:
+            axis -- name of the axis to move
+            distance -- number of cm to move
+                     -- negative numbers go toward home
+            velocity, how quickly to move, in cm/s
+                     -- (Speed really, always positive)
+        '''
+        axis = self.axis(axis)
+
+        if distance > 0:
+            dir = False
+        else:
+            dir = True
+        if velocity is not None:
+            velocity = abs(velocity)
+
+        self.scheduler.enqueue(axis, dir, abs(distance), velocity)
+
+    @property
+    def queue(self):
+        '''
+        Returns: the running move and the queued moves
+        '''
+        return self.scheduler.queue
+
+    def clear_queue(self):
+        '''
+        Drop the queued moves without stopping the running one
+
+        Returns: number of moves dropped
+        '''
+        return self.scheduler.clear()
+
+    def move_to_cm(self, new_position, velocity=None, require_home=True):
+        '''
+        Move every axis to an absolute position, one after the other. Runs
+        as a job of the motion thread once the stage is idle.
+
+        Returns: True if every axis got to its position
+        '''
+        assert len(new_position) == len(self.axes)
+        if velocity is None:
+            velocity = [None]*len(self.axes)
+        else:
+            assert len(velocity) == len(self.axes)
+        def move_to():
+            for axis, position, vel in zip(self.axes.values(), new_position,
+                                           velocity):
+                ## a stop drops the axes that haven't moved yet
+                if axis.stop_event.is_set():
+                    return False
+                result = axis.move_to_cm(position, vel, require_home)
+                if not result or not result[0]:
+                    return False
+            return True
+        return self.scheduler.run_exclusive('move_to_cm', move_to,
+                                            list(self.axes.values()),
+                                            move_end=True)
+
+    def stop(self, timeout=2):
+        '''
+        Flush the move queue and ramp the running move down (see
+        Axis.decel_ramp). This runs on the requesting connection's thread,
+        so it doesn't wait behind other requests, and waits until the
+        stage is at rest.
+
+        Returns: the stop latency (request to the motion thread reacting)
+            and time to standstill in s, the final position and each
+            stopped axis' report
+        '''
+        requested = time.monotonic()
+        with self.scheduler.changed:
+            self.scheduler.clear()
+            for axis in self.axes.values():
+                axis.stop(requested)
+        deadline = requested + timeout
+        self.scheduler.wait(timeout)
+        while any(axis.keep_moving for axis in self.axes.values()) and \
+                time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        reports = {name: axis.last_stop for name, axis in self.axes.items()
+                        if axis.last_stop is not None and
+                            axis.last_stop['requested'] == requested}
+        latency, stop_time = None, None
+        if reports:
+            latency = max(report['latency'] for report in reports.values())
+            stop_time = max(report['stop_time'] for report in reports.values())
+        return {'latency': latency, 'stop_time': stop_time,
+                'position': self.get_position(), 'axes': reports}
+
+    def set_trigger(self, pin, width=1e-5, active_high=True, on_move_end=True):
+        '''
+        Drive a trigger output from the motion thread (see trigger.Trigger).
+        A pin of None removes the trigger.
+
+        Args:
+            pin -- BCM number of the trigger output
+            width -- pulse length in seconds
+            on_move_end -- pulse every time the stage stops after the
+                queued moves
+        '''
+        if self.moving:
+            raise ValueError("Cannot change the trigger while moving")
+        trigger = None
+        if pin is not None:
+            trigger = Trigger(pin, width, active_high, on_move_end,
+                              name=self.name)
+        self.trigger = trigger
+        self.scheduler.trigger = trigger
+        for axis in self.axes.values():
+            if axis.trigger is not None:
+                axis.set_trigger_positions(trigger, [])
+
+    def set_trigger_positions(self, axis, positions):
+        '''
+        Also pulse the trigger when the axis passes each of the positions (cm)
+        during a move. An empty list clears them.
+        '''
+        if self.trigger is None:
+            raise ValueError("No trigger set up, use set_trigger")
+        self.axis(axis).set_trigger_positions(self.trigger, positions)
+
+    def trigger_log(self, since=0):
+        '''
+        Returns: the pulses logged after index since, each with its time,
+            source, axis and step position
+        '''
+        if self.trigger is None:
+            return []
+        return self.trigger.entries(since)
+
+    def cleanup(self):
+        for axis in self.axes.values():
+            axis.cleanup()
+
+
+def build_axis(name, pin_list, steps_per_cm, logfile=None, **kwargs):
+    '''
+    Extra arguments (like the settle times or the drift tolerance) are
+    passed on to the Axis
+    '''
+    if isinstance(pin_list['eot_ccw'], (list, tuple)):
+        return CombinedAxis(name, pin_list, steps_per_cm, logfile, **kwargs)
+    return Axis(name, pin_list, steps_per_cm, logfile, **kwargs)
@@ -0,0 +1,70 @@
+import time
+from collections import deque
+
+from .gpio import GPIO
+from . import metrics
+
+## pulses shorter than this are timed by spinning instead of sleeping
+SPIN_LIMIT = 0.001
+
+
+class Trigger(object):
+    """
+    GPIO output pulsed from the motion thread, so a detector can start
+    acquiring as soon as the stage reaches a point instead of after the
+    client hears about it.
+
+    The stage pulses it when the move queue drains (if on_move_end) and
+    the axes pulse it when they step onto one of their trigger positions.
+    Every pulse is logged with its time and the step position.
+    """
+    def __init__(self, pin, width=1e-5, active_high=True, on_move_end=True,
+                 log_size=10000, name='trigger'):
+        '''
+        Args:
+            pin -- BCM number of the trigger output
+            width -- pulse length in seconds
+            active_high -- pulse high from a low idle level, or the reverse
+            on_move_end -- pulse when the stage stops after its queued moves
+            log_size -- number of pulses kept in the log
+        '''
+        self.pin = pin
+        self.width = width
+        self.active = GPIO.HIGH if active_high else GPIO.LOW
+        self.idle = GPIO.LOW if active_high else GPIO.HIGH
+        self.on_move_end = on_move_end
+        self.name = name
+        self.log = deque(maxlen=log_size)
+        self.count = 0
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.pin, GPIO.OUT)
+        GPIO.output(self.pin, self.idle)
+
+    def pulse(self, source, axis=None, step_position=None):
+        '''
+        Pulse the output and log it
+
+        Args:
+            source -- why the trigger fired, 'move_end' or 'position'
+        '''
+        GPIO.output(self.pin, self.active)
+        fired = time.time()
+        if self.width < SPIN_LIMIT:
+            end = time.perf_counter() + self.width
+            while time.perf_counter() < end:
+                pass
+        else:
+            time.sleep(self.width)
+        GPIO.output(self.pin, self.idle)
+
+        self.count += 1
+        self.log.append({'index': self.count, 'time': fired, 'source': source,
+                         'axis': axis, 'step_position': step_position})
+        metrics.TRIGGERS.inc(1, self.name, source)
+
+    def entries(self, since=0):
+        '''
+        Returns: the logged pulses with an index above since
+        '''
+        return [entry for entry in self.log if entry['index'] > since]